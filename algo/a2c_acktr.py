@@ -31,15 +31,15 @@ class A2C_ACKTR(object):
                 actor_critic.parameters(), lr, eps=eps, alpha=alpha)
 
     def update(self, rollouts):
-        obs_shape = rollouts.observations.size()[2:]
+        obs_shape = rollouts.obs_shape
         action_shape = rollouts.actions.size()[-1]
         num_steps, num_processes, _ = rollouts.rewards.size()
 
         values, action_log_probs, dist_entropy, states = self.actor_critic.evaluate_actions(
-            rollouts.observations[:-1].view(-1, *obs_shape),
+            rollouts.get_observations(slice(0,-1)).view(-1, *obs_shape),
             rollouts.states[0].view(-1, self.actor_critic.state_size),
-            rollouts.masks[:-1].view(-1, 1),
-            rollouts.actions.view(-1, action_shape))
+            rollouts.to_float(rollouts.masks[:-1]).view(-1, 1),
+            rollouts.to_action(rollouts.actions).view(-1, action_shape))
 
         values = values.view(num_steps, num_processes, 1)
         action_log_probs = action_log_probs.view(num_steps, num_processes, 1)
@@ -75,5 +75,6 @@ class A2C_ACKTR(object):
                                      self.max_grad_norm)
 
         self.optimizer.step()
+        self.actor_critic.version += 1
 
         return value_loss.item(), action_loss.item(), dist_entropy.item()
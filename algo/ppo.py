@@ -4,35 +4,48 @@ import torch.nn.functional as F
 import torch.optim as optim
 import utils
 import numpy as np
+from transition_replay import TransitionReplayBuffer
 
 class PPO(object):
 
     def set_this_layer(self, this_layer):
         self.this_layer = this_layer
-        self.init_actor_critic()
+        if not self.this_layer.inference_only:
+            self.init_actor_critic()
 
     def init_actor_critic(self):
         self.optimizer_actor_critic = optim.Adam(self.this_layer.actor_critic.parameters(), lr=self.this_layer.args.lr, eps=self.this_layer.args.eps)
-        self.one = torch.FloatTensor([1]).cuda()
+        self.one = torch.ones(1, device=self.this_layer.args.device)
         self.mone = self.one * -1
 
     def set_upper_layer(self, upper_layer):
         '''this method will be called if we have a transition_model to generate reward bounty'''
         self.upper_layer = upper_layer
-        if self.upper_layer.transition_model is not None:
+        if (self.upper_layer.transition_model is not None) and (not self.this_layer.inference_only):
             self.init_transition_model()
 
     def init_transition_model(self):
         '''build essential things for training transition_model'''
         self.optimizer_transition_model = optim.Adam(self.upper_layer.transition_model.parameters(), lr=1e-4, betas=(0.0, 0.9))
-        self.NLLLoss = nn.NLLLoss(reduction='elementwise_mean')
+        self.NLLLoss = nn.NLLLoss(reduction='none')
+        if self.this_layer.args.transition_model_replay_size > 0:
+            self.transition_model_replay = TransitionReplayBuffer(
+                size = self.this_layer.args.transition_model_replay_size,
+                observation_shape = self.upper_layer.rollouts.obs_shape,
+                next_observation_shape = self.upper_layer.rollouts.observation_space.shape,
+                observation_dtype = self.upper_layer.rollouts.observation_dtype,
+                action_space = self.upper_layer.rollouts.action_space,
+                alpha = self.this_layer.args.transition_model_replay_alpha,
+            ).to(self.this_layer.args.device)
+        else:
+            self.transition_model_replay = None
 
     def get_grad_norm(self, inputs, outputs):
 
         gradients = torch.autograd.grad(
             outputs=outputs,
             inputs=inputs,
-            grad_outputs=torch.ones(outputs.size()).cuda(),
+            grad_outputs=torch.ones_like(outputs),
             create_graph=True,
             retain_graph=True,
             only_inputs=True
@@ -43,7 +56,15 @@ class PPO(object):
 
         return gradients_norm
 
-    def update(self, update_type):
+    def transition_model_dataset(self):
+        '''collect the dataset for training transition_model from the recent steps of the upper layer'''
+        return self.upper_layer.rollouts.transition_model_dataset(
+            recent_steps = int(self.this_layer.rollouts.num_steps/self.this_layer.hierarchy_interval)-1,
+            recent_at = self.upper_layer.step_i,
+        )
+
+    def update(self, update_type, transition_model_dataset=None):
+        '''transition_model_dataset is collected by transition_model_dataset() if it is not given'''
 
         epoch_loss = {}
 
@@ -65,10 +86,13 @@ class PPO(object):
                     ))
                     epoch *= 0
 
+            '''flatten rollouts once for all epochs'''
+            flattened = self.this_layer.rollouts.flatten_for_feed_forward(advantages)
+
             for e in range(epoch):
 
                 data_generator = self.this_layer.rollouts.feed_forward_generator(
-                    advantages = advantages,
+                    flattened = flattened,
                     mini_batch_size = self.this_layer.args.actor_critic_mini_batch_size,
                 )
 
@@ -114,6 +138,8 @@ class PPO(object):
                                              self.this_layer.args.max_grad_norm)
 
                     self.optimizer_actor_critic.step()
+                    '''invalidate memoized features of actor_critic'''
+                    self.this_layer.actor_critic.version += 1
 
         '''train transition_model'''
         if update_type in ['transition_model','both']:
@@ -126,17 +152,43 @@ class PPO(object):
                     self.this_layer.update_i,
                 ))
                 if not self.this_layer.checkpoint_loaded:
-                    epoch = 800
+                    if self.transition_model_replay is None:
+                        epoch = 800
+                    else:
+                        epoch = self.this_layer.args.transition_model_replay_warmup_epoch
 
             self.upper_layer.transition_model.train()
 
+            '''collect the dataset once for all epochs'''
+            if transition_model_dataset is None:
+                dataset = self.transition_model_dataset()
+            else:
+                dataset = transition_model_dataset
+
+            mini_batch_size = int(self.this_layer.args.transition_model_mini_batch_size[self.this_layer.hierarchy_id])
+
+            if self.transition_model_replay is not None:
+                '''add recent transitions to replay buffer,
+                each epoch draws as many minibatches as the recent transitions would give'''
+                if dataset is not None:
+                    self.transition_model_replay.add(*self.upper_layer.rollouts.materialize_transition_dataset(dataset))
+                    num_mini_batch = max(dataset[0].size()[0]//mini_batch_size, 1)
+                else:
+                    num_mini_batch = 1
+
             for e in range(epoch):
 
-                data_generator = self.upper_layer.rollouts.transition_model_feed_forward_generator(
-                    mini_batch_size = int(self.this_layer.args.transition_model_mini_batch_size[self.this_layer.hierarchy_id]),
-                    recent_steps = int(self.this_layer.rollouts.num_steps/self.this_layer.hierarchy_interval)-1,
-                    recent_at = self.upper_layer.step_i,
-                )
+                if self.transition_model_replay is None:
+                    data_generator = self.upper_layer.rollouts.transition_model_feed_forward_generator(
+                        dataset = dataset,
+                        mini_batch_size = mini_batch_size,
+                    )
+                else:
+                    data_generator = self.transition_model_replay.feed_forward_generator(
+                        mini_batch_size = mini_batch_size,
+                        num_mini_batch = num_mini_batch,
+                        beta = self.this_layer.args.transition_model_replay_beta,
+                    )
 
                 for sample in data_generator:
 
@@ -144,7 +196,11 @@ class PPO(object):
                         print('# WARNING: No sample this update!')
                         return epoch_loss
 
-                    observations_batch, next_observations_batch, action_onehot_batch, reward_bounty_raw_batch = sample
+                    if self.transition_model_replay is None:
+                        observations_batch, next_observations_batch, action_onehot_batch, reward_bounty_raw_batch = sample
+                        weights_batch = 1.0
+                    else:
+                        observations_batch, next_observations_batch, action_onehot_batch, reward_bounty_raw_batch, weights_batch, idxes_batch = sample
 
                     self.optimizer_transition_model.zero_grad()
 
@@ -179,29 +235,35 @@ class PPO(object):
                         else:
                             raise NotImplemented
 
-                        '''compute mse loss'''
-                        loss_transition = F.mse_loss(
+                        '''compute mse loss of each transition, weighted by importance weights if sampled from replay buffer'''
+                        loss_transition_each = F.mse_loss(
                             input = predicted_next_observations_batch,
                             target = observation_delta,
-                            reduction='elementwise_mean',
-                        )/255.0
+                            reduction='none',
+                        ).view(observation_delta.size()[0],-1).mean(dim=1,keepdim=True)/255.0
+                        loss_transition = (loss_transition_each*weights_batch).mean()
 
                         loss_transition_final = loss_transition
+                        loss_each = loss_transition_each
 
                     else:
                         predicted_action_log_probs, reward_bounty = self.upper_layer.transition_model(
                             inputs = next_observations_batch,
                         )
                         '''compute nll loss'''
-                        loss_mutual_information = self.NLLLoss(predicted_action_log_probs, action_onehot_batch.nonzero()[:,1])
+                        loss_mutual_information_each = self.NLLLoss(predicted_action_log_probs, action_onehot_batch.nonzero()[:,1]).unsqueeze(1)
+                        loss_mutual_information = (loss_mutual_information_each*weights_batch).mean()
+                        loss_each = loss_mutual_information_each
 
                     if self.this_layer.update_i not in [0]:
                         '''for the first epoch, reward bounty is not accurate'''
-                        loss_reward_bounty = F.mse_loss(
+                        loss_reward_bounty_each = F.mse_loss(
                             input = reward_bounty,
                             target = reward_bounty_raw_batch,
-                            reduction='elementwise_mean',
+                            reduction='none',
                         )
+                        loss_reward_bounty = (loss_reward_bounty_each*weights_batch).mean()
+                        loss_each = loss_each + loss_reward_bounty_each
 
                     if not self.this_layer.args.mutual_information:
                         if self.this_layer.update_i not in [0]:
@@ -218,6 +280,12 @@ class PPO(object):
                     loss_final.backward()
 
                     self.optimizer_transition_model.step()
+                    '''invalidate memoized predictions of transition_model'''
+                    self.upper_layer.transition_model.version += 1
+
+                    if self.transition_model_replay is not None:
+                        '''prioritize by prediction error'''
+                        self.transition_model_replay.update_priorities(idxes_batch, loss_each.detach())
 
                 if self.this_layer.update_i in [0,1]:
                     print_str = ''
@@ -35,6 +35,10 @@ def get_args():
                         help='Random seed')
     parser.add_argument('--num-processes', type=int, default=16,
                         help='How many training CPU processes to use')
+    parser.add_argument('--device', type=str, default='cuda',
+                        help='Device to train on: cuda, cuda:<index>, cpu')
+    parser.add_argument('--num-threads', type=int, default=1,
+                        help='Number of intra-op threads of torch, consider more threads when training on cpu')
     parser.add_argument('--actor-critic-epoch', type=int, default=4,
                         help='Number of ppo epochs')
     parser.add_argument('--actor-critic-mini-batch-size', type=int, default=32,
@@ -87,6 +91,28 @@ def get_args():
                         help='Interval between the subpolicies, i.e., T^l')
     parser.add_argument('--num-steps',          type=int, nargs='*',
                         help='Number of forward steps before update agent')
+    parser.add_argument('--compact-rollouts', action='store_true',
+                        help='If store rollouts in compact dtypes, e.g., uint8 for image observations, bool for masks')
+    parser.add_argument('--share-observations', action='store_true',
+                        help='If keep frames once in a store shared by all layers, rollouts keep the index of frames instead of copies, requires --num-stack > 1, since with a single frame layers hardly refer to the same frames')
+    parser.add_argument('--intern-observations', action='store_true',
+                        help='If intern frames of the bottom env in a table, each distinct frame is kept once and referred by its id, frames are never freed, so only GridWorld and Explore2D are supported, implies --share-observations')
+    parser.add_argument('--memo-size', type=int, default=0,
+                        help='Size of LRU memo of actor_critic features and transition_model predictions per observation id, 0 to disable, requires --intern-observations')
+    parser.add_argument('--auto-reset', action='store_true',
+                        help='If reset each env as soon as it is done, instead of letting it sleep untill all envs are done')
+    parser.add_argument('--shared-memory-envs', action='store_true',
+                        help='If env workers write observations into shared memory, instead of sending them through pipes')
+    parser.add_argument('--envs-per-worker', type=int, default=None,
+                        help='Number of envs hosted by each env worker process, by default, envs are spread over as many workers as physical cores')
+    parser.add_argument('--native-envs', action='store_true',
+                        help='If step all envs together in the main process with a batched NumPy implementation, instead of one env per subprocess, only for Explore2D and Explore2DContinuous')
+    parser.add_argument('--env-groups', type=int, default=1,
+                        help='Number of groups the env workers are split into, actions of a group are sent as soon as they are sampled, so that it simulates while the bottom layer acts on the next group, 1 for the synchronous loop. It needs at least as many env workers, on nodes of fewer physical cores pass --envs-per-worker, e.g., 1')
+    parser.add_argument('--async-learner', action='store_true',
+                        help='If train each layer in a background thread on swapped-out rollouts, while acting continues on a slightly stale policy')
+    parser.add_argument('--max-staleness', type=int, default=1,
+                        help='With --async-learner, the maximum number of updates the acting policy may be behind, it takes as many additional rollouts')
 
     '''reward bounty details'''
     parser.add_argument('--reward-bounty', type=float,
@@ -109,6 +135,14 @@ def get_args():
                         help='Mode of clip reward bounty: each, all' )
     parser.add_argument('--transition-model-mini-batch-size', type=int, nargs='*',
                         help='Num of the subpolicies per hierarchy' )
+    parser.add_argument('--transition-model-replay-size', type=int, default=0,
+                        help='Size of the prioritized replay buffer for training transition_model, 0 to train on recent transitions only' )
+    parser.add_argument('--transition-model-replay-alpha', type=float, default=0.6,
+                        help='How much prioritization is used in the replay buffer (0 - no prioritization, 1 - full prioritization)' )
+    parser.add_argument('--transition-model-replay-beta', type=float, default=0.4,
+                        help='To what degree importance weights correct the prioritized sampling (0 - no corrections, 1 - full correction)' )
+    parser.add_argument('--transition-model-replay-warmup-epoch', type=int, default=800,
+                        help='Epochs to train transition_model for the first time when the replay buffer is used, 800 as without it' )
 
     parser.add_argument('--mutual-information', action='store_true',
                         help='Whether use mutual information as bounty reward (depreciated)' )
@@ -138,6 +172,12 @@ def get_args():
                         help='Whether only summarize one episode, if not None, log with it as a log_header')
     parser.add_argument('--act-deterministically', action='store_true',
                         help='Whether act deterministically when interactiong')
+    parser.add_argument('--inference-only-hierarchy', type=int, nargs='*', default=[],
+                        help='Ids of hierarchy layers that are already trained, they only act and predict, without being updated or saved')
+    parser.add_argument('--quantize-inference-only', action='store_true',
+                        help='Whether apply dynamic int8 quantization to the actor_critic and transition_model used only for inference (cpu only)')
+    parser.add_argument('--acting-policy', type=str, default='eager',
+                        help='How HierarchyLayer acts: eager (Policy.act), traced (ActingPolicy traced from the training weights), exported (hierarchy_{i}_acting_policy.pt produced by export.py, requires all layers in --inference-only-hierarchy)')
 
     '''for debug'''
     parser.add_argument('--test-action', action='store_true',
@@ -145,8 +185,20 @@ def get_args():
     parser.add_argument('--see-leg-fre', action='store_true',
                         help='See the frequency of each leg through tensorboard')
 
+    '''for benchmark.py'''
+    parser.add_argument('--benchmark', type=str, nargs='*', default=[],
+                        help='Benchmarks to run with benchmark.py: bounty, mass_center, transition_model, returns, multi_linear, inverse_mask, acting, quantize, frame_stack, observation_store, intern, auto_reset, async_learner, shared_memory_envs, envs_per_worker, sleeping_flags, env_groups, native_envs')
+    parser.add_argument('--benchmark-repeat', type=int, default=20,
+                        help='Times to repeat each benchmarked call')
+
+    '''for export.py'''
+    parser.add_argument('--export-onnx', action='store_true',
+                        help='Also export hierarchy_{i}_acting_policy.onnx with export.py')
+
     args = parser.parse_args()
 
+    args.device = torch.device(args.device)
+
     args.summarize_behavior = args.summarize_observation or args.summarize_rendered_behavior or args.summarize_state_prediction
 
     '''none = []'''
@@ -196,6 +248,8 @@ def get_args():
         args.save_dir = os.path.join(args.save_dir, 'e_d-{}'.format(args.extend_driven))
         '''transition_model training details'''
         # args.save_dir = os.path.join(args.save_dir, 't_m_e-{}'.format(args.transition_model_epoch))
+        if args.transition_model_replay_size > 0:
+            args.save_dir = os.path.join(args.save_dir, 't_m_r_s-{}'.format(args.transition_model_replay_size))
         '''train mode'''
         # args.save_dir = os.path.join(args.save_dir, 't_m-{}'.format(args.train_mode))
         '''mask value function'''
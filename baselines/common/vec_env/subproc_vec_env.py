@@ -1,48 +1,146 @@
+import os
 import numpy as np
 from multiprocessing import Process, Pipe
+from multiprocessing import resource_tracker
+from multiprocessing import shared_memory as shared_memory_module
 from baselines.common.vec_env import VecEnv, CloudpickleWrapper
 from baselines.common.tile_images import tile_images
 
 
+def attach_obs_buffer(name, shape, dtype):
+    '''attach the shared memory created by SubprocVecEnv, it is unlinked by SubprocVecEnv, not by this process'''
+    shm = shared_memory_module.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+class RandomStates(object):
+    '''bit generator of the global np.random of each env hosted in a process,
+    envs may draw from it, e.g., OverCooked seeds np.random. With more than one env in a process,
+    the bit generator of an env is swapped in while it runs, as if it was in a process of its own.
+    The random module is not swapped, since getstate and setstate of it are too slow to be done at each step.
+    np.random.set_bit_generator requires numpy 1.25, with an older numpy, envs of a process share np.random'''
+    def __init__(self):
+        self.isolated = hasattr(np.random, 'set_bit_generator')
+        if self.isolated:
+            '''envs are made from the same random state, as if each was made in a forked process'''
+            self.initial_state = np.random.get_bit_generator().state
+        self.bit_generators = []
+
+    def make(self, env_fn):
+        if self.isolated:
+            bit_generator = np.random.MT19937()
+            bit_generator.state = self.initial_state
+            np.random.set_bit_generator(bit_generator)
+            self.bit_generators += [bit_generator]
+        return env_fn()
+
+    def run(self, env_index, fn, *args):
+        if self.isolated and (len(self.bit_generators) > 1):
+            np.random.set_bit_generator(self.bit_generators[env_index])
+        return fn(*args)
+
+def get_sleeping(env):
+    '''sleeping flag of env, see SleepAfterDone in envs.py, False if env does not sleep'''
+    if hasattr(env, 'get_sleeping'):
+        return env.get_sleeping()
+    return False
+
 def worker(remote, parent_remote, env_fn_wrapper):
     parent_remote.close()
-    env = env_fn_wrapper.x()
+    '''this worker hosts the envs of env_fn_wrapper.x, a list of env_fn, they are stepped in a loop,
+    and results of all of them are sent in one message'''
+    random_states = RandomStates()
+    envs = [random_states.make(env_fn) for env_fn in env_fn_wrapper.x]
+    '''if attached, obs are written into obs_buffer[env_start:env_start+len(envs)] instead of being sent'''
+    shm, obs_buffer, env_start = None, None, None
     while True:
         cmd, data = remote.recv()
         if cmd == 'step':
-            ob, reward, done, info = env.step(data)
+            results = [random_states.run(i, env.step, action) for i, (env, action) in enumerate(zip(envs, data))]
             '''we have add a control to sleep after done,
             do not reset automatically'''
             # if done:
             #     ob = env.reset()
-            remote.send((ob, reward, done, info))
+            obs, rews, dones, infos = zip(*results)
+            if obs_buffer is not None:
+                for i, ob in enumerate(obs):
+                    obs_buffer[env_start+i] = ob
+                obs = None
+            '''sleeping flags are sent with the results, so that get_sleeping costs no round trip'''
+            remote.send((obs, rews, dones, infos, [get_sleeping(env) for env in envs]))
         elif cmd == 'reset':
-            ob = env.reset()
-            remote.send(ob)
+            obs = [random_states.run(i, env.reset) for i, env in enumerate(envs)]
+            if obs_buffer is not None:
+                for i, ob in enumerate(obs):
+                    obs_buffer[env_start+i] = ob
+                obs = None
+            remote.send((obs, [get_sleeping(env) for env in envs]))
+        elif cmd == 'attach_obs_buffer':
+            name, shape, dtype, env_start = data
+            shm, obs_buffer = attach_obs_buffer(name, shape, dtype)
+            remote.send(None)
         elif cmd == 'render':
-            remote.send(env.render(mode='rgb_array'))
+            remote.send(random_states.run(data, envs[data].render, 'rgb_array'))
         elif cmd == 'close':
             remote.close()
+            if shm is not None:
+                obs_buffer = None
+                shm.close()
             break
         elif cmd == 'get_spaces':
-            remote.send((env.observation_space, env.action_space))
+            remote.send((envs[0].observation_space, envs[0].action_space))
         elif cmd == 'get_sleeping':
-            remote.send(env.get_sleeping())
+            remote.send(get_sleeping(envs[data]))
         else:
             raise NotImplementedError
 
+def num_physical_cores():
+    '''number of physical cores, hyper-threads are not counted when it is known'''
+    try:
+        import psutil
+        num_cores = psutil.cpu_count(logical=False)
+        if num_cores is not None:
+            return num_cores
+    except ImportError:
+        pass
+    try:
+        with open('/proc/cpuinfo') as cpuinfo:
+            physical_id, cores = None, set()
+            for line in cpuinfo:
+                if line.startswith('physical id'):
+                    physical_id = line.split(':')[1].strip()
+                elif line.startswith('core id'):
+                    cores.add((physical_id, line.split(':')[1].strip()))
+        if len(cores) > 0:
+            return len(cores)
+    except IOError:
+        pass
+    return os.cpu_count() or 1
+
 
 class SubprocVecEnv(VecEnv):
-    def __init__(self, env_fns, spaces=None):
+    def __init__(self, env_fns, spaces=None, shared_memory=False, envs_per_worker=None):
         """
         envs: list of gym environments to run in subprocesses
+        shared_memory: if workers write observations into a buffer of [num_envs, *obs_shape] in shared memory,
+            so that only rewards, dones and infos go through pipes. Observations returned by step and reset
+            are then a view of the buffer, which is overwritten by the next step or reset
+        envs_per_worker: number of envs hosted by each subprocess, by default, envs are spread over
+            as many subprocesses as physical cores
         """
         self.waiting = False
         self.closed = False
         nenvs = len(env_fns)
-        self.remotes, self.work_remotes = zip(*[Pipe() for _ in range(nenvs)])
-        self.ps = [Process(target=worker, args=(work_remote, remote, CloudpickleWrapper(env_fn)))
-            for (work_remote, remote, env_fn) in zip(self.work_remotes, self.remotes, env_fns)]
+        if envs_per_worker is None:
+            envs_per_worker = int(np.ceil(nenvs/float(num_physical_cores())))
+        self.envs_per_worker = envs_per_worker
+        '''envs of each worker are contiguous, the last worker may have less envs'''
+        self.env_starts = list(range(0, nenvs, self.envs_per_worker))
+        self.remotes, self.work_remotes = zip(*[Pipe() for _ in self.env_starts])
+        if shared_memory:
+            '''workers share the resource tracker of this process, so that the shared memory is tracked once'''
+            resource_tracker.ensure_running()
+        self.ps = [Process(target=worker, args=(work_remote, remote, CloudpickleWrapper(env_fns[env_start:env_start+self.envs_per_worker])))
+            for (work_remote, remote, env_start) in zip(self.work_remotes, self.remotes, self.env_starts)]
         for p in self.ps:
             p.daemon = True # if the main process crashes, we should not cause things to hang
             p.start()
@@ -52,32 +150,82 @@ class SubprocVecEnv(VecEnv):
         self.remotes[0].send(('get_spaces', None))
         observation_space, action_space = self.remotes[0].recv()
         VecEnv.__init__(self, len(env_fns), observation_space, action_space)
+        '''sleeping flags of envs, updated by each step and reset, they are None before reset as in SleepAfterDone'''
+        self.sleeping = [None]*nenvs
+
+        self.shm = None
+        if shared_memory:
+            '''observations are kept in the dtype of observation_space, e.g., uint8 for images'''
+            shape = (nenvs, *observation_space.shape)
+            dtype = observation_space.dtype
+            self.shm = shared_memory_module.SharedMemory(create=True, size=max(int(np.prod(shape))*np.dtype(dtype).itemsize, 1))
+            self.obs_buffer = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf)
+            for env_start, remote in zip(self.env_starts, self.remotes):
+                remote.send(('attach_obs_buffer', (self.shm.name, shape, dtype, env_start)))
+            for remote in self.remotes:
+                remote.recv()
 
     def step_async(self, actions):
-        for remote, action in zip(self.remotes, actions):
-            remote.send(('step', action))
+        for remote, env_start in zip(self.remotes, self.env_starts):
+            remote.send(('step', actions[env_start:env_start+self.envs_per_worker]))
+        self.waiting = True
+
+    def split_groups(self, num_groups):
+        """
+        split workers into num_groups groups of contiguous workers, to be stepped by step_async_group,
+        returns the slice of envs of each group
+        """
+        assert 1 <= num_groups <= len(self.remotes), \
+            'cannot split {} workers into {} groups, see envs_per_worker'.format(len(self.remotes), num_groups)
+        self.group_workers = [list(workers) for workers in np.array_split(np.arange(len(self.remotes)), num_groups)]
+        return [
+            slice(self.env_starts[workers[0]], min(self.env_starts[workers[-1]]+self.envs_per_worker, self.num_envs))
+            for workers in self.group_workers
+        ]
+
+    def step_async_group(self, group, actions):
+        """
+        step the envs of group, a slice returned by split_groups, actions are of these envs only.
+        The workers of group simulate while the caller prepares actions of the other groups,
+        step_wait returns once all groups are stepped
+        """
+        env_start = self.env_starts[self.group_workers[group][0]]
+        for worker in self.group_workers[group]:
+            worker_start = self.env_starts[worker]-env_start
+            self.remotes[worker].send(('step', actions[worker_start:worker_start+self.envs_per_worker]))
         self.waiting = True
 
     def get_sleeping(self, env_index):
-        self.remotes[env_index].send(('get_sleeping', None))
-        sleeping = self.remotes[env_index].recv()
-        return sleeping
+        '''sleeping flag of env_index from the last step or reset, without a round trip to the worker'''
+        return self.sleeping[env_index]
 
     def get_one_render(self, env_index):
-        self.remotes[env_index].send(('render', None))
-        render = self.remotes[env_index].recv()
+        remote = self.remotes[env_index//self.envs_per_worker]
+        remote.send(('render', env_index%self.envs_per_worker))
+        render = remote.recv()
         return render
 
     def step_wait(self):
         results = [remote.recv() for remote in self.remotes]
         self.waiting = False
-        obs, rews, dones, infos = zip(*results)
+        '''results are batched by worker, flatten them in the order of envs'''
+        rews = [rew for _, rews_of_worker, _, _, _ in results for rew in rews_of_worker]
+        dones = [done for _, _, dones_of_worker, _, _ in results for done in dones_of_worker]
+        infos = tuple(info for _, _, _, infos_of_worker, _ in results for info in infos_of_worker)
+        self.sleeping = [sleeping for _, _, _, _, sleeping_of_worker in results for sleeping in sleeping_of_worker]
+        if self.shm is not None:
+            return self.obs_buffer, np.stack(rews), np.stack(dones), infos
+        obs = [ob for obs_of_worker, _, _, _, _ in results for ob in obs_of_worker]
         return np.stack(obs), np.stack(rews), np.stack(dones), infos
 
     def reset(self):
         for remote in self.remotes:
             remote.send(('reset', None))
-        return np.stack([remote.recv() for remote in self.remotes])
+        results = [remote.recv() for remote in self.remotes]
+        self.sleeping = [sleeping for _, sleeping_of_worker in results for sleeping in sleeping_of_worker]
+        if self.shm is not None:
+            return self.obs_buffer
+        return np.stack([ob for obs_of_worker, _ in results for ob in obs_of_worker])
 
     def reset_task(self):
         for remote in self.remotes:
@@ -94,12 +242,14 @@ class SubprocVecEnv(VecEnv):
             remote.send(('close', None))
         for p in self.ps:
             p.join()
+        if self.shm is not None:
+            self.obs_buffer = None
+            self.shm.close()
+            self.shm.unlink()
         self.closed = True
 
     def render(self, mode='human'):
-        for pipe in self.remotes:
-            pipe.send(('render', None))
-        imgs = [pipe.recv() for pipe in self.remotes]
+        imgs = [self.get_one_render(env_index) for env_index in range(self.num_envs)]
         bigimg = tile_images(imgs)
         if mode == 'human':
             import cv2
@@ -0,0 +1,970 @@
+'''
+Micro-benchmarks for the hot paths of main.py, the parity checks against the reference
+implementations live in tests/ and run with python -m pytest tests.
+Run with the same arguments as main.py, plus the benchmarks to run, e.g.,
+python benchmark.py --exp benchmark --env-name OverCooked --reward-level 1 --num-hierarchy 2 --num-subpolicy 5 --num-processes 16 --reward-bounty 1 --distance mass_center --benchmark bounty
+Pass --device cpu to run on a cpu-only node.
+'''
+import copy
+import time
+
+import gym
+import numpy as np
+import torch
+
+from envs import make_env
+import bounty
+import utils
+from tests.test_bounty import reference_get_mass_center, reference_reward_bounty_raw
+from tests.test_model import reference_predict_each_action, reference_multi_linear, reference_inverse_mask
+from tests.test_storage import reference_compute_returns, reference_stack
+
+from arguments import get_args
+args = get_args()
+
+device = args.device
+torch.set_num_threads(args.num_threads)
+
+def timeit(fn):
+    '''return the result of fn and the mean seconds it takes'''
+    result = fn()
+    if device.type in ['cuda']:
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(args.benchmark_repeat):
+        result = fn()
+    if device.type in ['cuda']:
+        torch.cuda.synchronize()
+    return result, (time.time()-start)/args.benchmark_repeat
+
+def print_speedup(name, reference_time, new_time):
+    print('[{}] reference {:10.3f} ms, new {:10.3f} ms, speedup {:8.2f}x'.format(
+        name,
+        reference_time*1000.0,
+        new_time*1000.0,
+        reference_time/new_time,
+    ))
+
+def get_spaces():
+    env = make_env(0, args=args)()
+    observation_space, action_space = env.observation_space, env.action_space
+    env.close()
+    return observation_space, action_space
+
+def generate_bounty_inputs():
+    '''generate random inputs of generate_reward_bounty for args.env_name'''
+    observation_space, _ = get_spaces()
+    num_actions = args.num_subpolicy[0]
+    obs_shape = observation_space.shape
+    if len(obs_shape)==3 and (obs_shape[1]==84) and (obs_shape[2]==84):
+        obs = np.random.randint(0, 256, size=(args.num_processes, *obs_shape)).astype(observation_space.dtype)
+        observation_predicted_from = torch.randint(0, 256, (args.num_processes, 1, *obs_shape[1:])).float()
+        predicted_next_observations = (torch.rand(num_actions, args.num_processes, *obs_shape)*2.0-1.0)*255.0
+    else:
+        obs = np.random.randint(-10, 11, size=(args.num_processes, *obs_shape)).astype(observation_space.dtype)
+        if len(obs_shape) in [3]:
+            observation_predicted_from = torch.randint(-10, 11, (args.num_processes, 1, *obs_shape[1:])).float()
+        else:
+            observation_predicted_from = torch.randint(-10, 11, (args.num_processes, *obs_shape)).float()
+        predicted_next_observations = torch.randn(num_actions, args.num_processes, *obs_shape)*10.0
+    action = torch.randint(0, num_actions, (args.num_processes,)).long()
+    return obs, observation_predicted_from.to(device), predicted_next_observations.to(device), action.to(device)
+
+def benchmark_bounty():
+    '''time the batched reward bounty engine against the per-process loop'''
+    obs, observation_predicted_from, predicted_next_observations, action = generate_bounty_inputs()
+
+    _, reference_time = timeit(
+        lambda: reference_reward_bounty_raw(
+            obs, observation_predicted_from, predicted_next_observations, action,
+            distance = args.distance,
+            env_name = args.env_name,
+            reward_bounty = args.reward_bounty,
+            diversity_driven_active_function = args.diversity_driven_active_function,
+        )
+    )
+    _, new_time = timeit(
+        lambda: bounty.compute_reward_bounty_raw(
+            obs = torch.from_numpy(obs).float().to(device),
+            observation_predicted_from = observation_predicted_from,
+            predicted_next_observations = predicted_next_observations,
+            action = action,
+            distance = args.distance,
+            env_name = args.env_name,
+            reward_bounty = args.reward_bounty,
+            diversity_driven_active_function = args.diversity_driven_active_function,
+        )
+    )
+    print_speedup('bounty', reference_time, new_time)
+
+def benchmark_mass_center():
+    '''time the batched mass center kernel against the scipy path'''
+    obs, observation_predicted_from, predicted_next_observations, action = generate_bounty_inputs()
+    obs_rb = torch.from_numpy(obs).float().to(device)-observation_predicted_from
+
+    def reference_mass_center():
+        obs_rb_np = obs_rb.cpu().numpy()
+        prediction_np = predicted_next_observations.cpu().numpy()
+        obs_mass_center = np.stack([reference_get_mass_center(x[0]) for x in obs_rb_np])
+        prediction_mass_center = np.stack([
+            np.stack([reference_get_mass_center(x[0]) for x in prediction_np[action_i]]) for action_i in range(prediction_np.shape[0])
+        ])
+        return np.concatenate([obs_mass_center[np.newaxis],prediction_mass_center],0)
+
+    _, reference_time = timeit(reference_mass_center)
+    _, new_time = timeit(
+        lambda: bounty.get_mass_center(
+            torch.cat([obs_rb.unsqueeze(0),predicted_next_observations],0)[:,:,0]
+        )
+    )
+    print_speedup('mass_center', reference_time, new_time)
+
+def get_state_type(obs_shape):
+    if len(obs_shape)==3 and (obs_shape[1]==84) and (obs_shape[2]==84):
+        return 'standard_image'
+    else:
+        return 'vector'
+
+def benchmark_transition_model():
+    '''time TransitionModel.predict_each_action against forwarding repeated observations'''
+    from model import TransitionModel
+    observation_space, _ = get_spaces()
+    obs_shape = (observation_space.shape[0] * args.num_stack, *observation_space.shape[1:])
+    input_action_space = gym.spaces.Discrete(args.num_subpolicy[0])
+    transition_model = TransitionModel(
+        input_observation_shape = obs_shape,
+        state_type = get_state_type(obs_shape),
+        input_action_space = input_action_space,
+        output_observation_shape = observation_space.shape,
+        num_subpolicy = args.num_subpolicy[0],
+        mutual_information = False,
+    ).to(device)
+    transition_model.eval()
+
+    now_states = (torch.rand(args.num_processes, *obs_shape)*255.0).floor().to(device)
+    action_onehot_each_action = torch.eye(input_action_space.n).to(device)
+
+    with torch.no_grad():
+        _, reference_time = timeit(
+            lambda: reference_predict_each_action(transition_model, now_states, action_onehot_each_action)
+        )
+        _, new_time = timeit(
+            lambda: transition_model.predict_each_action(
+                inputs = now_states,
+                input_action = action_onehot_each_action,
+            )
+        )
+    print_speedup('transition_model', reference_time, new_time)
+
+def benchmark_returns():
+    '''time the blocked reverse scan in RolloutStorage.compute_returns against the per-step loop,
+    over a grid of num_steps x num_processes'''
+    from storage import RolloutStorage
+    observation_space = gym.spaces.Box(low=-1.0, high=1.0, shape=(2,), dtype=np.float32)
+    for use_gae in [True, False]:
+        for num_steps in [32, 128, 512, 2048]:
+            for num_processes in [1, 16, 64]:
+                rollouts = RolloutStorage(
+                    num_steps = num_steps,
+                    num_processes = num_processes,
+                    obs_shape = observation_space.shape,
+                    input_actions = gym.spaces.Discrete(2),
+                    action_space = gym.spaces.Discrete(2),
+                    state_size = 1,
+                    observation_space = observation_space,
+                )
+                rollouts.rewards.normal_()
+                rollouts.value_preds.normal_()
+                rollouts.masks.bernoulli_(0.95)
+                rollouts.to(device)
+                next_value = torch.randn(num_processes, 1).to(device)
+
+                _, reference_time = timeit(
+                    lambda: reference_compute_returns(rollouts, next_value, use_gae, args.gamma, args.tau)
+                )
+                _, new_time = timeit(
+                    lambda: rollouts.compute_returns(next_value, use_gae, args.gamma, args.tau)
+                )
+                print_speedup(
+                    'returns, use_gae {}, num_steps {}, num_processes {}'.format(use_gae, num_steps, num_processes),
+                    reference_time,
+                    new_time,
+                )
+
+def benchmark_multi_linear():
+    '''time utils.MultiLinear against the per-subpolicy index_select and index_add_ loop
+    previously used by the heads of Categorical, DiagGaussian and Policy'''
+    from utils import MultiLinear
+    num_subpolicy = args.num_subpolicy[0]
+    batch_size = args.num_processes*args.num_steps[0] if len(args.num_steps)>0 else args.num_processes*128
+    linears = torch.nn.ModuleList([torch.nn.Linear(256, 18) for _ in range(num_subpolicy)]).to(device)
+    multi_linear = MultiLinear(linears).to(device)
+    x = torch.randn(batch_size, 256).to(device)
+    action_index = torch.randint(0, num_subpolicy, (batch_size,)).to(device)
+
+    with torch.no_grad():
+        _, reference_time = timeit(lambda: reference_multi_linear(linears, x, action_index))
+        _, new_time = timeit(lambda: multi_linear(x, action_index))
+    print_speedup('multi_linear', reference_time, new_time)
+
+def benchmark_inverse_mask():
+    '''time the unfold-batched InverseMaskModel against the per-grid loop previously used
+    in get_alpha, get_e and alpha_to_mask, with the same weights'''
+    from model import InverseMaskModel
+    observation_space, action_space = get_spaces()
+    m = InverseMaskModel(
+        predicted_action_space = action_space.n,
+        num_grid = args.num_grid,
+    ).to(device)
+    last_states = torch.randint(0, 256, (args.num_processes, 1, 84, 84)).float().to(device)
+    now_states = torch.randint(0, 256, (args.num_processes, 1, 84, 84)).float().to(device)
+
+    def new_forward():
+        return m(last_states, now_states)[0], m.alpha_to_mask(m.get_alpha(now_states/255.0))
+
+    with torch.no_grad():
+        _, reference_time = timeit(lambda: reference_inverse_mask(m, last_states, now_states))
+        _, new_time = timeit(new_forward)
+    print_speedup('inverse_mask', reference_time, new_time)
+
+def benchmark_acting():
+    '''time the per-step acting latency of the traced ActingPolicy against Policy.act,
+    for the bottom layer and for the layer above it'''
+    from model import Policy, trace_acting_policy
+    observation_space, action_space = get_spaces()
+    obs_shape = (observation_space.shape[0] * args.num_stack, *observation_space.shape[1:])
+    for name, input_action_space, output_action_space in [
+        ('acting_bottom', gym.spaces.Discrete(args.num_subpolicy[0]), action_space),
+        ('acting_upper', gym.spaces.Discrete(2), gym.spaces.Discrete(args.num_subpolicy[0])),
+    ]:
+        actor_critic = Policy(
+            obs_shape = obs_shape,
+            state_type = get_state_type(obs_shape),
+            input_action_space = input_action_space,
+            output_action_space = output_action_space,
+            recurrent_policy = args.recurrent_policy,
+            num_subpolicy = input_action_space.n,
+        ).to(device)
+        acting_policy, _ = trace_acting_policy(
+            actor_critic = actor_critic,
+            obs_shape = obs_shape,
+            num_processes = args.num_processes,
+            device = device,
+        )
+        inputs = (torch.rand(args.num_processes, *obs_shape)*255.0).floor().to(device)
+        states = torch.zeros(args.num_processes, actor_critic.state_size).to(device)
+        masks = torch.ones(args.num_processes, 1).to(device)
+        input_action_index = torch.randint(0, input_action_space.n, (args.num_processes,)).to(device)
+        input_action = torch.eye(input_action_space.n).to(device)[input_action_index]
+
+        with torch.no_grad():
+            _, reference_time = timeit(
+                lambda: actor_critic.act(inputs, states, masks, deterministic=False, input_action=input_action)
+            )
+            _, new_time = timeit(
+                lambda: acting_policy(inputs, states, masks, input_action_index, torch.ones(1).to(device))
+            )
+        print_speedup(name, reference_time, new_time)
+
+def benchmark_quantize():
+    '''compare the dynamic int8 quantized Policy and TransitionModel (utils.quantize_for_inference)
+    against the float ones, report the drift of action distributions and predictions, and the speedup'''
+    from model import Policy, TransitionModel
+    from utils import quantize_for_inference
+    observation_space, action_space = get_spaces()
+    obs_shape = (observation_space.shape[0] * args.num_stack, *observation_space.shape[1:])
+    input_action_space = gym.spaces.Discrete(args.num_subpolicy[0])
+    actor_critic = Policy(
+        obs_shape = obs_shape,
+        state_type = get_state_type(obs_shape),
+        input_action_space = input_action_space,
+        output_action_space = action_space,
+        recurrent_policy = args.recurrent_policy,
+        num_subpolicy = input_action_space.n,
+    ).to(device).eval()
+    quantized_actor_critic = quantize_for_inference(copy.deepcopy(actor_critic))
+
+    inputs = (torch.rand(args.num_processes, *obs_shape)*255.0).floor().to(device)
+    states = torch.zeros(args.num_processes, actor_critic.state_size).to(device)
+    masks = torch.ones(args.num_processes, 1).to(device)
+    input_action = torch.eye(input_action_space.n).to(device)[torch.randint(0, input_action_space.n, (args.num_processes,))]
+
+    def get_value_dist(model):
+        base_features, _ = model.get_final_features(inputs, states, masks, input_action)
+        value, dist, _ = model.get_value_dist(base_features, input_action)
+        return value, dist
+
+    with torch.no_grad():
+        value, dist = get_value_dist(actor_critic)
+        quantized_value, quantized_dist = get_value_dist(quantized_actor_critic)
+        kl = torch.distributions.kl_divergence(dist, quantized_dist).view(args.num_processes,-1).sum(dim=1)
+        if action_space.__class__.__name__ in ['Discrete']:
+            mode_drift = 'mode agreement {:.3f}'.format((dist.mode()==quantized_dist.mode()).float().mean().item())
+        else:
+            mode_drift = 'max mode error {:.6f}'.format((dist.mode()-quantized_dist.mode()).abs().max().item())
+        print('[quantize] actor_critic: mean kl {:.6f}, max kl {:.6f}, {}, max value error {:.6f}'.format(
+            kl.mean().item(),
+            kl.max().item(),
+            mode_drift,
+            (value-quantized_value).abs().max().item(),
+        ))
+        _, reference_time = timeit(
+            lambda: actor_critic.act(inputs, states, masks, input_action=input_action)
+        )
+        _, new_time = timeit(
+            lambda: quantized_actor_critic.act(inputs, states, masks, input_action=input_action)
+        )
+    print_speedup('quantize_actor_critic', reference_time, new_time)
+
+    transition_model = TransitionModel(
+        input_observation_shape = obs_shape,
+        state_type = get_state_type(obs_shape),
+        input_action_space = input_action_space,
+        output_observation_shape = observation_space.shape,
+        num_subpolicy = args.num_subpolicy[0],
+        mutual_information = False,
+    ).to(device).eval()
+    quantized_transition_model = quantize_for_inference(copy.deepcopy(transition_model))
+    action_onehot_each_action = torch.eye(input_action_space.n).to(device)
+
+    with torch.no_grad():
+        reference, reference_time = timeit(
+            lambda: transition_model.predict_each_action(inputs, action_onehot_each_action)
+        )
+        new, new_time = timeit(
+            lambda: quantized_transition_model.predict_each_action(inputs, action_onehot_each_action)
+        )
+    print('[quantize] transition_model: mean error of predicted_state {:.6f} (mean magnitude {:.6f}), mean error of predicted_reward_bounty {:.6f}'.format(
+        (reference[0]-new[0]).abs().mean().item(),
+        reference[0].abs().mean().item(),
+        (reference[1]-new[1]).abs().mean().item(),
+    ))
+    print_speedup('quantize_transition_model', reference_time, new_time)
+
+def benchmark_frame_stack():
+    '''time storage.FrameStack against shifting the stacked observation,
+    previously done in HierarchyLayer.update_current_obs, with random episode ends'''
+    from storage import FrameStack
+    observation_space, _ = get_spaces()
+    frame_shape = observation_space.shape
+    num_steps = 64
+    frames = (torch.rand(num_steps, args.num_processes, *frame_shape)*255.0).floor().to(device)
+    masks = (torch.rand(num_steps, args.num_processes, 1) > 0.1).float().to(device)
+    out = torch.zeros(args.num_processes, frame_shape[0]*args.num_stack, *frame_shape[1:]).to(device)
+
+    def new_stack():
+        frame_stack = FrameStack(args.num_processes, frame_shape, args.num_stack).to(device)
+        for step_i in range(num_steps):
+            frame_stack.clear(masks[step_i])
+            frame_stack.push(frames[step_i])
+            frame_stack.stacked(out=out)
+
+    _, reference_time = timeit(lambda: reference_stack(frames, masks, args.num_stack, out=out))
+    _, new_time = timeit(new_stack)
+    print_speedup('frame_stack', reference_time/num_steps, new_time/num_steps)
+
+def benchmark_observation_store():
+    '''simulate the stepping of args.num_hierarchy layers as in main.py, with random frames and episode ends,
+    with the observations of rollouts kept in a shared storage.ObservationStore and kept as copies,
+    report the memory taken by each'''
+    from storage import RolloutStorage, FrameStack, ObservationStore
+    observation_space, _ = get_spaces()
+    frame_shape = observation_space.shape
+    obs_shape = (frame_shape[0] * args.num_stack, *frame_shape[1:])
+    num_steps = args.num_steps[0] if len(args.num_steps)>0 else 128
+    hierarchy_interval = args.hierarchy_interval[0] if len(args.hierarchy_interval)>0 else 4
+    action_space = gym.spaces.Discrete(args.num_subpolicy[0])
+    store = ObservationStore(
+        capacity = num_steps+args.num_stack+1,
+        num_processes = args.num_processes,
+        frame_shape = frame_shape,
+    ).to(device)
+
+    layers = {}
+    for name, layer_store in [('copied', None), ('shared', store)]:
+        layers[name] = [{
+            'rollouts': RolloutStorage(
+                num_steps = num_steps,
+                num_processes = args.num_processes,
+                obs_shape = obs_shape,
+                input_actions = action_space,
+                action_space = action_space,
+                state_size = 1,
+                observation_space = observation_space,
+                store = layer_store,
+            ).to(device),
+            'frame_stack': FrameStack(
+                num_processes = args.num_processes,
+                frame_shape = frame_shape,
+                num_stack = args.num_stack,
+                store = layer_store,
+            ).to(device),
+        } for hierarchy_id in range(args.num_hierarchy)]
+
+    zeros = torch.zeros(args.num_processes, 1).to(device)
+    step_i = [0]*args.num_hierarchy
+    last = {}
+
+    def interact_one_step(hierarchy_id):
+        if hierarchy_id in [0]:
+            last['frame'] = (torch.rand(args.num_processes, *frame_shape)*255.0).floor().to(device)
+            last['masks'] = (torch.rand(args.num_processes, 1) > 0.05).float().to(device)
+            last['slot'] = store.add(last['frame'])
+        else:
+            for macro_step_i in range(hierarchy_interval):
+                one_step(hierarchy_id-1)
+        for name in ['copied', 'shared']:
+            layer = layers[name][hierarchy_id]
+            layer['frame_stack'].clear(last['masks'])
+            layer['frame_stack'].push(last['frame'], slot=last['slot'])
+            layer['rollouts'].insert(layer['frame_stack'], zeros, zeros, zeros, zeros, zeros, last['masks'])
+
+    def one_step(hierarchy_id):
+        interact_one_step(hierarchy_id)
+        step_i[hierarchy_id] += 1
+        if step_i[hierarchy_id] == num_steps:
+            for name in ['copied', 'shared']:
+                layers[name][hierarchy_id]['rollouts'].after_update()
+            step_i[hierarchy_id] = 0
+
+    '''reset'''
+    last['frame'] = (torch.rand(args.num_processes, *frame_shape)*255.0).floor().to(device)
+    last['slot'] = store.add(last['frame'])
+    for name in ['copied', 'shared']:
+        for layer in layers[name]:
+            layer['frame_stack'].push(last['frame'], slot=last['slot'])
+            layer['rollouts'].set_observations(0, layer['frame_stack'])
+
+    '''run two updates of the top layer'''
+    for top_step_i in range(2*num_steps):
+        one_step(args.num_hierarchy-1)
+
+    copied = sum([layer['rollouts'].memory_footprint() for layer in layers['copied']])
+    shared = sum([layer['rollouts'].memory_footprint() for layer in layers['shared']])+store.memory_footprint()
+    print('[observation_store] rollouts of {} layers take {:.1f} MB with copied observations, {:.1f} MB with the shared store ({:.1f} MB of it), {:.2f}x smaller, {} of {} slots referenced at the end'.format(
+        args.num_hierarchy,
+        copied/1024.0/1024.0,
+        shared/1024.0/1024.0,
+        store.memory_footprint()/1024.0/1024.0,
+        float(copied)/shared,
+        store.capacity-len(store.free_slots),
+        store.capacity,
+    ))
+
+def benchmark_intern():
+    '''step random frames drawn from a small pool of distinct frames, as in GridWorld and Explore2D,
+    report the memory taken by the observations of rollouts kept in a storage.ObservationTable and kept as copies,
+    and time the acting and predicting of memoized Policy and TransitionModel against the plain ones'''
+    from storage import RolloutStorage, FrameStack, ObservationTable
+    from model import Policy, TransitionModel
+    observation_space, action_space = get_spaces()
+    frame_shape = observation_space.shape
+    obs_shape = (frame_shape[0] * args.num_stack, *frame_shape[1:])
+    num_steps = args.num_steps[0] if len(args.num_steps)>0 else 128
+    input_action_space = gym.spaces.Discrete(args.num_subpolicy[0])
+    '''frames come from envs on host'''
+    pool = np.floor(np.random.rand(64, *frame_shape)*255.0).astype(observation_space.dtype)
+    sequence = [pool[np.random.randint(0, pool.shape[0], args.num_processes)] for _ in range(2*num_steps+1)]
+    table = ObservationTable(
+        capacity = args.num_processes,
+        num_processes = args.num_processes,
+        frame_shape = frame_shape,
+    ).to(device)
+
+    layers = {}
+    for name, layer_store in [('copied', None), ('interned', table)]:
+        layers[name] = {
+            'rollouts': RolloutStorage(
+                num_steps = num_steps,
+                num_processes = args.num_processes,
+                obs_shape = obs_shape,
+                input_actions = input_action_space,
+                action_space = input_action_space,
+                state_size = 1,
+                observation_space = observation_space,
+                store = layer_store,
+            ).to(device),
+            'frame_stack': FrameStack(
+                num_processes = args.num_processes,
+                frame_shape = frame_shape,
+                num_stack = args.num_stack,
+                store = layer_store,
+            ).to(device),
+        }
+    zeros = torch.zeros(args.num_processes, 1).to(device)
+    for step_i, frames in enumerate(sequence):
+        masks = (torch.rand(args.num_processes, 1) > 0.05).float().to(device)
+        slot = table.intern(frames)
+        for name in ['copied', 'interned']:
+            layer = layers[name]
+            frame = torch.from_numpy(frames).float().to(device) if layer['rollouts'].store is None else table.frames_of(slot)
+            if step_i in [0]:
+                layer['frame_stack'].push(frame, slot=slot)
+                layer['rollouts'].set_observations(0, layer['frame_stack'])
+                continue
+            layer['frame_stack'].clear(masks)
+            layer['frame_stack'].push(frame, slot=slot)
+            layer['rollouts'].insert(layer['frame_stack'], zeros, zeros, zeros, zeros, zeros, masks)
+        if (step_i>0) and (step_i%num_steps==0):
+            for name in ['copied', 'interned']:
+                layers[name]['rollouts'].after_update()
+    copied = layers['copied']['rollouts'].memory_footprint()
+    interned = layers['interned']['rollouts'].memory_footprint()+table.memory_footprint()
+    print('[intern] rollouts take {:.1f} MB with copied observations, {:.1f} MB with the table ({} distinct frames), {:.2f}x smaller'.format(
+        copied/1024.0/1024.0,
+        interned/1024.0/1024.0,
+        table.num_frames-1,
+        float(copied)/interned,
+    ))
+
+    if (args.num_stack != 1) or args.recurrent_policy:
+        print('[intern] memo is skipped, it requires --num-stack 1 and a feed-forward policy')
+        return
+
+    actor_critic = Policy(
+        obs_shape = obs_shape,
+        state_type = get_state_type(obs_shape),
+        input_action_space = input_action_space,
+        output_action_space = action_space,
+        recurrent_policy = args.recurrent_policy,
+        num_subpolicy = input_action_space.n,
+    ).to(device)
+    transition_model = TransitionModel(
+        input_observation_shape = obs_shape,
+        state_type = get_state_type(obs_shape),
+        input_action_space = input_action_space,
+        output_observation_shape = frame_shape,
+        num_subpolicy = input_action_space.n,
+        mutual_information = False,
+    ).to(device)
+    transition_model.eval()
+    states = torch.zeros(args.num_processes, actor_critic.state_size).to(device)
+    masks = torch.ones(args.num_processes, 1).to(device)
+    input_action = torch.eye(input_action_space.n).to(device)[torch.randint(0, input_action_space.n, (args.num_processes,)).to(device)]
+    action_onehot_each_action = torch.eye(input_action_space.n).to(device)
+    slots = [table.intern(frames) for frames in sequence]
+    inputs = [table.frames_of(slot) for slot in slots]
+
+    def run(observation_ids):
+        outputs = []
+        for step_i in range(len(slots)):
+            outputs += [(
+                actor_critic.act(inputs[step_i], states, masks, deterministic=True, input_action=input_action,
+                    observation_ids = slots[step_i] if observation_ids else None),
+                transition_model.predict_each_action(inputs[step_i], action_onehot_each_action,
+                    observation_ids = slots[step_i] if observation_ids else None),
+            )]
+        return outputs
+
+    with torch.no_grad():
+        start = time.time()
+        run(observation_ids=False)
+        reference_time = time.time()-start
+        actor_critic.feature_memo = utils.LRUMemo(max(args.memo_size, pool.shape[0]), device)
+        transition_model.prediction_memo = utils.LRUMemo(max(args.memo_size, pool.shape[0]), device)
+        start = time.time()
+        run(observation_ids=True)
+        new_time = time.time()-start
+    print_speedup('intern_memo', reference_time, new_time)
+    print('[intern_memo] feature_memo hit rate {:.3f}, prediction_memo hit rate {:.3f}'.format(
+        actor_critic.feature_memo.hit_rate(),
+        transition_model.prediction_memo.hit_rate(),
+    ))
+
+def benchmark_auto_reset():
+    '''step Explore2D with random actions, letting done envs sleep untill all envs are done (SleepAfterDone)
+    or resetting each env as soon as it is done (AutoResetAfterDone, --auto-reset),
+    report the fraction of sleeping steps and the effective FPS, i.e., env steps that are not sleeping per second.
+    Envs of the same episode length never sleep, so envs are also given differing episode length limits,
+    spread from a quarter of args.episode_length_limit (32 if not given) to all of it, as envs ending at goals.
+    Only env stepping is timed, in main.py each sleeping step also costs a forward pass at every layer'''
+    from baselines.common.vec_env.subproc_vec_env import SubprocVecEnv
+    num_steps = (args.num_steps[0] if len(args.num_steps)>0 else 128)*args.benchmark_repeat
+    episode_length_limit = args.episode_length_limit if args.episode_length_limit is not None else 32
+    for episode_lengths in ['equal', 'differing']:
+        effective_fps = {}
+        for auto_reset in [False, True]:
+            env_fns = []
+            for i in range(args.num_processes):
+                env_args = copy.copy(args)
+                env_args.env_name = 'Explore2D'
+                env_args.auto_reset = auto_reset
+                env_args.episode_length_limit = episode_length_limit
+                if episode_lengths in ['differing']:
+                    env_args.episode_length_limit = max(episode_length_limit*(i%4+1)//4, 1)
+                env_fns += [make_env(i, args=env_args)]
+            envs = SubprocVecEnv(env_fns)
+            envs.reset()
+            done_at_last_step = np.zeros(args.num_processes, dtype=bool)
+            num_sleeping_steps = 0
+            num_episodes = 0
+            start = time.time()
+            for step_i in range(num_steps):
+                _, _, done, _ = envs.step([envs.action_space.sample() for _ in range(args.num_processes)])
+                num_sleeping_steps += int((done & done_at_last_step).sum())
+                num_episodes += int((done & (~done_at_last_step)).sum())
+                done_at_last_step = done
+                if (not auto_reset) and done.all():
+                    envs.reset()
+                    done_at_last_step = np.zeros(args.num_processes, dtype=bool)
+            seconds = time.time()-start
+            envs.close()
+            name = 'auto_reset' if auto_reset else 'sleep_after_done'
+            effective_fps[name] = (num_steps*args.num_processes-num_sleeping_steps)/seconds
+            print('[{}] {:9} episode lengths, {:4} episodes, sleeping_steps_fraction {:.3f}, FPS {:.0f}, effective FPS {:.0f}'.format(
+                name,
+                episode_lengths,
+                num_episodes,
+                float(num_sleeping_steps)/(num_steps*args.num_processes),
+                num_steps*args.num_processes/seconds,
+                effective_fps[name],
+            ))
+        print('[auto_reset] {:9} episode lengths, effective FPS gain {:.2f}x'.format(
+            episode_lengths,
+            effective_fps['auto_reset']/effective_fps['sleep_after_done'],
+        ))
+
+def benchmark_async_learner():
+    '''act on the bottom envs with a Policy and update it with PPO every num_steps steps,
+    inline (as main.py does by default) or by learner.AsyncLearner on swapped-out rollouts (--async-learner),
+    report the FPS and the time the actor is idle per update'''
+    import algo
+    from baselines.common.vec_env.subproc_vec_env import SubprocVecEnv
+    from model import Policy
+    from storage import RolloutStorage
+    from learner import LayerView, AsyncLearner
+    num_steps = args.num_steps[0] if len(args.num_steps)>0 else 128
+    num_updates = 4
+    envs = SubprocVecEnv([make_env(i, args=args) for i in range(args.num_processes)])
+    obs_shape = (envs.observation_space.shape[0] * args.num_stack, *envs.observation_space.shape[1:])
+    input_action_space = gym.spaces.Discrete(args.num_subpolicy[0])
+    input_action = torch.eye(input_action_space.n).to(device)[torch.randint(0, input_action_space.n, (args.num_processes,)).to(device)]
+    base_actor_critic = Policy(
+        obs_shape = obs_shape,
+        state_type = get_state_type(obs_shape),
+        input_action_space = input_action_space,
+        output_action_space = envs.action_space,
+        recurrent_policy = args.recurrent_policy,
+        num_subpolicy = input_action_space.n,
+    ).to(device)
+    base_rollouts = RolloutStorage(
+        num_steps = num_steps,
+        num_processes = args.num_processes,
+        obs_shape = obs_shape,
+        input_actions = input_action_space,
+        action_space = envs.action_space,
+        state_size = base_actor_critic.state_size,
+        observation_space = envs.observation_space,
+    ).to(device)
+    base_rollouts.input_actions.copy_(input_action.unsqueeze(0).expand_as(base_rollouts.input_actions))
+
+    for name in ['inline', 'async_learner']:
+        actor_critic = copy.deepcopy(base_actor_critic)
+        layer = LayerView(
+            layer = None,
+            args = args,
+            hierarchy_id = 0,
+            hierarchy_interval = 1,
+            inference_only = False,
+            actor_critic = actor_critic,
+            rollouts = copy.deepcopy(base_rollouts),
+            update_i = 2,
+        )
+        agent = algo.PPO()
+
+        def learn(job):
+            layer.rollouts = job['rollouts']
+            with torch.no_grad():
+                next_value = layer.actor_critic.get_value(
+                    inputs=layer.rollouts.get_observations(-1),
+                    states=layer.rollouts.states[-1],
+                    masks=layer.rollouts.get_masks(-1),
+                    input_action=layer.rollouts.get_input_actions(-1),
+                ).detach()
+            layer.rollouts.compute_returns(next_value, args.use_gae, args.gamma, args.tau)
+            return agent.update('actor_critic')
+
+        if name in ['async_learner']:
+            layer.actor_critic = copy.deepcopy(actor_critic)
+            learner = AsyncLearner(learn=learn, max_staleness=args.max_staleness)
+            learner.add_model(layer.actor_critic, actor_critic)
+            rollouts = layer.rollouts
+            free_rollouts = [copy.deepcopy(base_rollouts) for _ in range(args.max_staleness)]
+        else:
+            rollouts = layer.rollouts
+        agent.set_this_layer(layer)
+
+        rollouts.observations[0].copy_(utils.to_device(envs.reset(), device))
+        idle_time = 0.0
+        start = time.time()
+        for update_i in range(num_updates):
+            for step_i in range(num_steps):
+                if name in ['async_learner']:
+                    learner.sync()
+                with torch.no_grad():
+                    value, action, action_log_prob, states = actor_critic.act(
+                        inputs = rollouts.get_observations(step_i),
+                        states = rollouts.states[step_i],
+                        masks = rollouts.get_masks(step_i),
+                        input_action = input_action,
+                    )
+                obs, reward, done, _ = envs.step(utils.to_host(action.squeeze(1)))
+                masks = utils.to_device(1.0-done.astype(np.float32), device).unsqueeze(1)
+                rollouts.insert(utils.to_device(obs, device), states, action, action_log_prob, value, utils.to_device(reward, device).unsqueeze(1), masks)
+            update_start = time.time()
+            if name in ['async_learner']:
+                for finished_job, _ in learner.submit({'rollouts': rollouts}):
+                    free_rollouts += [finished_job['rollouts']]
+                next_rollouts = free_rollouts.pop(0)
+                next_rollouts.start_from(rollouts)
+                rollouts = next_rollouts
+            else:
+                learn({'rollouts': rollouts})
+                rollouts.after_update()
+            idle_time += time.time()-update_start
+        if name in ['async_learner']:
+            '''the last update is not counted in FPS'''
+            learner.collect(block=True)
+        seconds = time.time()-start
+        print('[{}] FPS {:.0f}, actor idle {:.3f} s per update, {:.1f}% of the time'.format(
+            name,
+            num_updates*num_steps*args.num_processes/seconds,
+            idle_time/num_updates,
+            idle_time/seconds*100.0,
+        ))
+    envs.close()
+
+def benchmark_shared_memory_envs():
+    '''compare the stepping throughput of SubprocVecEnv with observations sent through pipes
+    against observations written into shared memory (--shared-memory-envs), with the same actions,
+    for OverCooked, GridWorld and MineCraft at 8, 16 and 32 processes. Envs that cannot be made on this node are skipped'''
+    from baselines.common.vec_env.subproc_vec_env import SubprocVecEnv
+    num_steps = 8*args.benchmark_repeat
+    for env_name in ['OverCooked', 'GridWorld', 'MineCraft']:
+        env_args = copy.copy(args)
+        env_args.env_name = env_name
+        try:
+            make_env(0, args=env_args)().close()
+        except Exception as e:
+            print('[shared_memory_envs] skip {}, since {}'.format(env_name, e))
+            continue
+        for num_processes in [8, 16, 32]:
+            seconds = {}
+            last_obs = {}
+            for shared_memory in [False, True]:
+                envs = SubprocVecEnv([make_env(i, args=env_args) for i in range(num_processes)], shared_memory=shared_memory)
+                random_state = np.random.RandomState(args.seed)
+                envs.reset()
+                start = time.time()
+                for step_i in range(num_steps):
+                    obs, _, _, _ = envs.step([random_state.randint(envs.action_space.n) for _ in range(num_processes)])
+                seconds[shared_memory] = time.time()-start
+                last_obs[shared_memory] = np.array(obs)
+                envs.close()
+            if not np.array_equal(last_obs[True], last_obs[False]):
+                print('[shared_memory_envs] # WARNING: observations of {} differ, it may not be deterministic'.format(env_name))
+            print('[shared_memory_envs] {:10} {:2} processes, obs {} {}, pipe {:7.0f} FPS, shared memory {:7.0f} FPS, speedup {:.2f}x'.format(
+                env_name,
+                num_processes,
+                obs.shape[1:],
+                obs.dtype,
+                num_steps*num_processes/seconds[False],
+                num_steps*num_processes/seconds[True],
+                seconds[False]/seconds[True],
+            ))
+
+def benchmark_envs_per_worker():
+    '''compare the stepping throughput of SubprocVecEnv with one env per worker against envs batched in workers,
+    with the same actions, for Explore2D, GridWorld and OverCooked at args.num_processes'''
+    from baselines.common.vec_env.subproc_vec_env import SubprocVecEnv, num_physical_cores
+    num_steps = 8*args.benchmark_repeat
+    for env_name in ['Explore2D', 'GridWorld', 'OverCooked']:
+        env_args = copy.copy(args)
+        env_args.env_name = env_name
+        if env_args.episode_length_limit is None:
+            env_args.episode_length_limit = 32
+        seconds = {}
+        for envs_per_worker in [1, None, args.num_processes]:
+            envs = SubprocVecEnv([make_env(i, args=env_args) for i in range(args.num_processes)], envs_per_worker=envs_per_worker)
+            random_state = np.random.RandomState(args.seed)
+            envs.reset()
+            start = time.time()
+            for step_i in range(num_steps):
+                obs, _, _, _ = envs.step([random_state.randint(envs.action_space.n) for _ in range(args.num_processes)])
+            seconds[envs.envs_per_worker] = time.time()-start
+            envs.close()
+        for envs_per_worker in seconds.keys():
+            print('[envs_per_worker] {:10} {:2} processes, {:2} envs per worker ({:2} workers), FPS {:7.0f}, speedup {:.2f}x'.format(
+                env_name,
+                args.num_processes,
+                envs_per_worker,
+                int(np.ceil(args.num_processes/float(envs_per_worker))),
+                num_steps*args.num_processes/seconds[envs_per_worker],
+                seconds[1]/seconds[envs_per_worker],
+            ))
+    print('[envs_per_worker] {} physical cores'.format(num_physical_cores()))
+
+def benchmark_sleeping_flags():
+    '''time get_sleeping of SubprocVecEnv from the flags sent with step results
+    against querying the worker with a round trip, as it was done by every layer at every step'''
+    from baselines.common.vec_env.subproc_vec_env import SubprocVecEnv
+    num_steps = 8*args.benchmark_repeat
+    hierarchy_interval = args.hierarchy_interval[0] if len(args.hierarchy_interval)>0 else 4
+    '''get_sleeping calls per step of the bottom envs, each layer calls it once per step of its own'''
+    calls_per_step = sum([1.0/hierarchy_interval**hierarchy_id for hierarchy_id in range(args.num_hierarchy)])
+    for envs_per_worker in [1, None]:
+        envs = SubprocVecEnv([make_env(i, args=args) for i in range(args.num_processes)], envs_per_worker=envs_per_worker)
+        envs.reset()
+        round_trip_time, cached_time = 0.0, 0.0
+        for step_i in range(num_steps):
+            envs.step([envs.action_space.sample() for _ in range(args.num_processes)])
+            start = time.time()
+            envs.remotes[0].send(('get_sleeping', 0))
+            envs.remotes[0].recv()
+            round_trip_time += time.time()-start
+            start = time.time()
+            envs.get_sleeping(env_index=0)
+            cached_time += time.time()-start
+        print('[sleeping_flags] {:2} envs per worker, get_sleeping {:8.1f} us by round trip, {:8.3f} us cached, saves {:8.1f} us per bottom step with {} layers'.format(
+            envs.envs_per_worker,
+            round_trip_time/num_steps*1e6,
+            cached_time/num_steps*1e6,
+            (round_trip_time-cached_time)/num_steps*1e6*calls_per_step,
+            args.num_hierarchy,
+        ))
+        envs.close()
+
+def benchmark_env_groups():
+    '''compare the throughput of the bottom layer acting and stepping all envs synchronously
+    against acting on groups of envs in turn, each group simulating while the next one is acted on,
+    see act_and_step_in_groups() in main.py, across numbers of processes, with one env per worker.
+    Actions are taken deterministically'''
+    from baselines.common.vec_env.subproc_vec_env import SubprocVecEnv
+    from model import Policy
+    num_steps = 8*args.benchmark_repeat
+    observation_space, action_space = get_spaces()
+    obs_shape = (observation_space.shape[0] * args.num_stack, *observation_space.shape[1:])
+    input_action_space = gym.spaces.Discrete(args.num_subpolicy[0])
+    actor_critic = Policy(
+        obs_shape = obs_shape,
+        state_type = get_state_type(obs_shape),
+        input_action_space = input_action_space,
+        output_action_space = action_space,
+        recurrent_policy = args.recurrent_policy,
+        num_subpolicy = input_action_space.n,
+    ).to(device)
+    for num_processes in sorted(set([4, 8, args.num_processes])):
+        input_action = torch.eye(input_action_space.n).to(device)[torch.arange(num_processes).to(device)%input_action_space.n]
+        states = torch.zeros(num_processes, actor_critic.state_size).to(device)
+        masks = torch.ones(num_processes, 1).to(device)
+        seconds = {}
+        for env_groups in [1, 2, 4]:
+            envs = SubprocVecEnv([make_env(i, args=args) for i in range(num_processes)], envs_per_worker=1)
+            groups = envs.split_groups(env_groups)
+            obs = utils.to_device(envs.reset(), device)
+            start = time.time()
+            for step_i in range(num_steps):
+                with torch.no_grad():
+                    if env_groups in [1]:
+                        _, action, _, _ = actor_critic.act(obs, states, masks, deterministic=True, input_action=input_action)
+                        envs.step_async(utils.to_host(action.squeeze(1)))
+                    else:
+                        for group, index in enumerate(groups):
+                            _, action, _, _ = actor_critic.act(obs[index], states[index], masks[index], deterministic=True, input_action=input_action[index])
+                            envs.step_async_group(group, utils.to_host(action.squeeze(1)))
+                obs, _, _, _ = envs.step_wait()
+                obs = utils.to_device(obs, device)
+            seconds[env_groups] = time.time()-start
+            envs.close()
+        for env_groups in seconds.keys():
+            print('[env_groups] {:2} processes, {} groups, FPS {:7.0f}, speedup {:.2f}x'.format(
+                num_processes,
+                env_groups,
+                num_steps*num_processes/seconds[env_groups],
+                seconds[1]/seconds[env_groups],
+            ))
+
+def benchmark_native_envs():
+    '''compare the stepping throughput of the batched NumPy Explore2D and Explore2DContinuous against
+    SubprocVecEnv of make_env(), with and without args.auto_reset, envs are reset when all of them are done
+    as by the top layer. The batched envs are also timed alone with more envs'''
+    from baselines.common.vec_env.subproc_vec_env import SubprocVecEnv
+    from envs import make_native_vec_env
+    num_steps = 8*args.benchmark_repeat
+
+    def get_actions(envs, num_processes, random_state):
+        if isinstance(envs.action_space, gym.spaces.Discrete):
+            return random_state.randint(envs.action_space.n, size=num_processes)
+        return random_state.randn(num_processes, 2)
+
+    for env_name in ['Explore2D', 'Explore2DContinuous']:
+        env_args = copy.copy(args)
+        env_args.env_name = env_name
+        if env_args.episode_length_limit is None:
+            env_args.episode_length_limit = 32
+        for auto_reset in [False, True]:
+            env_args.auto_reset = auto_reset
+            seconds = {}
+            for name, envs in [
+                ('subproc', SubprocVecEnv([make_env(i, args=env_args) for i in range(args.num_processes)])),
+                ('native', make_native_vec_env(env_args)),
+            ]:
+                random_state = np.random.RandomState(args.seed)
+                envs.reset()
+                start = time.time()
+                for step_i in range(num_steps):
+                    _, _, dones, _ = envs.step(get_actions(envs, args.num_processes, random_state))
+                    if (not auto_reset) and dones.all():
+                        '''as the top layer does'''
+                        envs.reset()
+                seconds[name] = time.time()-start
+                envs.close()
+            print('[native_envs] {:19} auto_reset {:1}, {:2} processes, FPS subproc {:8.0f}, native {:9.0f}, speedup {:7.2f}x'.format(
+                env_name,
+                auto_reset,
+                args.num_processes,
+                num_steps*args.num_processes/seconds['subproc'],
+                num_steps*args.num_processes/seconds['native'],
+                seconds['subproc']/seconds['native'],
+            ))
+        env_args.auto_reset = False
+        for num_processes in [args.num_processes, 256, 4096]:
+            env_args.num_processes = num_processes
+            envs = make_native_vec_env(env_args)
+            actions = get_actions(envs, num_processes, np.random.RandomState(args.seed))
+            envs.reset()
+            start = time.time()
+            for step_i in range(num_steps):
+                _, _, dones, _ = envs.step(actions)
+                if dones.all():
+                    envs.reset()
+            print('[native_envs] {:19} {:4} processes, FPS native {:10.0f}'.format(
+                env_name,
+                num_processes,
+                num_steps*num_processes/(time.time()-start),
+            ))
+
+benchmarks = {
+    'bounty': benchmark_bounty,
+    'mass_center': benchmark_mass_center,
+    'transition_model': benchmark_transition_model,
+    'returns': benchmark_returns,
+    'multi_linear': benchmark_multi_linear,
+    'inverse_mask': benchmark_inverse_mask,
+    'acting': benchmark_acting,
+    'quantize': benchmark_quantize,
+    'frame_stack': benchmark_frame_stack,
+    'observation_store': benchmark_observation_store,
+    'intern': benchmark_intern,
+    'auto_reset': benchmark_auto_reset,
+    'async_learner': benchmark_async_learner,
+    'shared_memory_envs': benchmark_shared_memory_envs,
+    'envs_per_worker': benchmark_envs_per_worker,
+    'sleeping_flags': benchmark_sleeping_flags,
+    'env_groups': benchmark_env_groups,
+    'native_envs': benchmark_native_envs,
+}
+
+if __name__ == "__main__":
+    for benchmark_name in args.benchmark:
+        benchmarks[benchmark_name]()
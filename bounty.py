@@ -0,0 +1,100 @@
+import torch
+import torch.nn.functional as F
+
+def get_mass_center(observations):
+    '''compute the centers of mass of a batch of images [..., H, W] valued in [-255, 255],
+    images are normalized by (obs+255)/2 and floored (same as the cast to uint8 previously
+    used with scipy.ndimage.measurements.center_of_mass), return [..., 2] in (row, col)'''
+    weights = ((observations+255.0)/2.0).floor()
+    row_mass = weights.sum(dim=-1)
+    col_mass = weights.sum(dim=-2)
+    rows = torch.arange(row_mass.size()[-1], dtype=weights.dtype, device=weights.device)
+    cols = torch.arange(col_mass.size()[-1], dtype=weights.dtype, device=weights.device)
+    total = row_mass.sum(dim=-1)
+    return torch.stack(
+        [
+            (row_mass*rows).sum(dim=-1)/total,
+            (col_mass*cols).sum(dim=-1)/total,
+        ],
+        dim = -1,
+    )
+
+def get_position(observations, env_name):
+    '''slice the part of a batch of observations that represents the position,
+    return it along with the scale that normalizes the l2 distance'''
+    if env_name in ['Explore2D']:
+        return observations[...,0,0,:], 1.0
+    elif ('MinitaurBulletEnv' in env_name) or ('AntBulletEnv' in env_name):
+        '''28:30 represents the position'''
+        return observations[...,28:30], 2.0**0.5
+    elif env_name in ['ReacherBulletEnv-v1','Explore2DContinuous']:
+        '''0:2 represents the position'''
+        return observations[...,0:2], 2.0**0.5
+    else:
+        raise NotImplemented
+
+def get_difference(obs_rb, prediction_rb, distance, env_name):
+    '''compute the difference between obs_rb [num_processes, ...] and
+    every prediction in prediction_rb [num_actions, num_processes, ...],
+    return a [num_actions, num_processes] tensor'''
+    if distance in ['l2']:
+        obs_position, scale = get_position(obs_rb, env_name)
+        prediction_position, _ = get_position(prediction_rb, env_name)
+        difference = (obs_position.unsqueeze(0)-prediction_position).norm(p=2, dim=-1)/scale
+    elif distance in ['mass_center']:
+        '''mass centers of the first channel of obs_rb and all predictions in one pass'''
+        mass_center = get_mass_center(
+            torch.cat([obs_rb.unsqueeze(0),prediction_rb],0)[:,:,0]
+        )
+        difference = (mass_center[0:1]-mass_center[1:]).norm(p=2, dim=-1)
+    else:
+        raise NotImplemented
+    return difference
+
+def reduce_difference(difference, action, diversity_driven_active_function):
+    '''reduce difference [num_actions, num_processes] over the actions that are not taken,
+    action [num_processes] is the index of the taken action'''
+    taken = torch.arange(difference.size()[0], device=difference.device).unsqueeze(1) == action.unsqueeze(0)
+    if diversity_driven_active_function in ['min']:
+        return difference.masked_fill(taken, float('inf')).min(dim=0)[0]
+    elif diversity_driven_active_function in ['sum']:
+        return difference.masked_fill(taken, 0.0).sum(dim=0)
+    else:
+        raise NotImplemented
+
+def compute_reward_bounty_raw(obs, observation_predicted_from, predicted_next_observations, action, distance, env_name, reward_bounty, diversity_driven_active_function):
+    '''compute none normalized reward bounty for all processes in one batch.
+    obs: [num_processes, ...], real observations reached
+    observation_predicted_from: observations the predictions are made from
+    predicted_next_observations: [num_actions, num_processes, ...]
+    action: [num_processes], index of the action taken by upper layer'''
+    obs_rb = obs - observation_predicted_from
+    difference = get_difference(
+        obs_rb = obs_rb,
+        prediction_rb = predicted_next_observations,
+        distance = distance,
+        env_name = env_name,
+    )*reward_bounty
+    return reduce_difference(
+        difference = difference,
+        action = action,
+        diversity_driven_active_function = diversity_driven_active_function,
+    )
+
+def clip_reward_bounty(reward_bounty_raw, predicted_reward_bounty, action, clip_reward_bounty_active_function):
+    '''clip reward_bounty_raw [num_processes] with the reward bounty predicted
+    for the taken action, predicted_reward_bounty: [num_actions, num_processes]'''
+    bounty_clip = predicted_reward_bounty.gather(0, action.unsqueeze(0)).squeeze(0)
+    delta = (reward_bounty_raw-bounty_clip)
+    if clip_reward_bounty_active_function in ['linear']:
+        reward_bounty = delta
+    elif clip_reward_bounty_active_function in ['u']:
+        reward_bounty = delta.sign().clamp(min=0.0,max=1.0)
+    elif clip_reward_bounty_active_function in ['relu']:
+        reward_bounty = F.relu(delta)
+    elif clip_reward_bounty_active_function in ['shrink_relu']:
+        positive_active = delta.sign().clamp(min=0.0,max=1.0)
+        reward_bounty = delta * positive_active + positive_active - 1
+    else:
+        raise Exception('No Supported')
+    return reward_bounty, bounty_clip
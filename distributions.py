@@ -3,7 +3,7 @@ import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from utils import init, init_normc_, AddBias
+from utils import init, init_normc_, AddBias, MultiLinear, MultiAddBias
 import numpy as np
 
 """
@@ -42,29 +42,15 @@ class Categorical(nn.Module):
         if self.num_subpolicy <= 1:
             self.linear = init_(nn.Linear(num_inputs, num_outputs))
         else:
-            self.linear = []
-            for linear_i in range(self.num_subpolicy):
-                self.linear += [init_(nn.Linear(num_inputs, num_outputs))]
-            self.linear = nn.ModuleList(self.linear)
-            self.index_dic = {}
-            self.y_dic = {}
-            self.num_outputs = num_outputs
+            self.linear = MultiLinear(
+                [init_(nn.Linear(num_inputs, num_outputs)) for linear_i in range(self.num_subpolicy)]
+            )
 
     def forward(self, x, index = None):
         if self.num_subpolicy <= 1:
             y_ = self.linear(x)
         else:
-            self.y_dic = {}
-            for dic_i in range(self.num_subpolicy):
-                self.index_dic[str(dic_i)] = torch.from_numpy(np.where(index==dic_i)[0]).long().cuda()
-                if self.index_dic[str(dic_i)].size()[0] != 0:
-                    self.y_dic[str(dic_i)] = self.linear[dic_i](
-                        torch.index_select(x,0,self.index_dic[str(dic_i)])
-                    )
-            y_ = torch.zeros((x.size()[0],self.num_outputs)).cuda()
-            for y_i in range(self.num_subpolicy):
-                if str(y_i) in self.y_dic:
-                    y_.index_add_(0,self.index_dic[str(y_i)],self.y_dic[str(y_i)])
+            y_ = self.linear(x, index)
 
         return FixedCategorical(logits=y_), y_
 
@@ -81,39 +67,20 @@ class DiagGaussian(nn.Module):
             self.fc_mean = init_(nn.Linear(num_inputs, num_outputs))
             self.logstd = AddBias(torch.zeros(num_outputs))
         else:
-            self.fc_mean = []
-            self.logstd = []
-            for linear_i in range(self.num_subpolicy):
-                self.fc_mean += [init_(nn.Linear(num_inputs, num_outputs))]
-                self.logstd += [AddBias(torch.zeros(num_outputs))]
-            self.fc_mean = nn.ModuleList(self.fc_mean)
-            self.logstd = nn.ModuleList(self.logstd)
-            self.index_dic = {}
-            self.y_dic = {}
-            self.num_outputs = num_outputs
+            self.fc_mean = MultiLinear(
+                [init_(nn.Linear(num_inputs, num_outputs)) for linear_i in range(self.num_subpolicy)]
+            )
+            self.logstd = MultiAddBias(
+                [torch.zeros(num_outputs) for linear_i in range(self.num_subpolicy)]
+            )
 
     def forward(self, x, index = None):
 
         if self.num_subpolicy <= 1:
             action_mean = self.fc_mean(x)
-            action_logstd = self.logstd(torch.zeros(action_mean.size()).cuda())
+            action_logstd = self.logstd(torch.zeros_like(action_mean))
         else:
-            self.y_dic = {}
-            self.std_dic = {}
-            for dic_i in range(self.num_subpolicy):
-                self.index_dic[str(dic_i)] = torch.from_numpy(np.where(index==dic_i)[0]).long().cuda()
-                if self.index_dic[str(dic_i)].size()[0] != 0:
-                    self.y_dic[str(dic_i)] = self.fc_mean[dic_i](
-                        torch.index_select(x,0,self.index_dic[str(dic_i)])
-                    )
-                    self.std_dic[str(dic_i)] = self.logstd[dic_i](
-                        torch.zeros(self.y_dic[str(dic_i)].size()).cuda()
-                    )
-            action_mean   = torch.zeros((x.size()[0],self.num_outputs)).cuda()
-            action_logstd = torch.zeros((x.size()[0],self.num_outputs)).cuda()
-            for y_i in range(self.num_subpolicy):
-                if str(y_i) in self.y_dic:
-                    action_mean  .index_add_(0,self.index_dic[str(y_i)],self.y_dic  [str(y_i)])
-                    action_logstd.index_add_(0,self.index_dic[str(y_i)],self.std_dic[str(y_i)])
+            action_mean = self.fc_mean(x, index)
+            action_logstd = self.logstd(torch.zeros_like(action_mean), index)
 
         return FixedNormal(action_mean, action_logstd.exp()), action_mean
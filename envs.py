@@ -99,6 +99,28 @@ class SleepAfterDone(gym.Wrapper):
     def get_sleeping(self):
         return self.sleeping
 
+class AutoResetAfterDone(gym.Wrapper):
+    def __init__(self, env):
+        """reset the env as soon as it returns done, instead of sleeping untill reset() is called,
+        the returned obs is the first obs of the new episode, the last obs of the done episode
+        is in info['terminal_observation'], if info is a dict
+        """
+        gym.Wrapper.__init__(self, env)
+
+    def reset(self, **kwargs):
+        return self.env.reset(**kwargs)
+
+    def step(self, ac):
+        obs, reward, done, info = self.env.step(ac)
+        if done:
+            if isinstance(info, dict):
+                info = dict(info, terminal_observation=obs)
+            obs = self.env.reset()
+        return obs, reward, done, info
+
+    def get_sleeping(self):
+        return False
+
 class SingleThread(gym.Wrapper):
     def __init__(self, env):
         """make the env return things in a multi-thread fashion
@@ -255,7 +277,10 @@ def make_env(rank, args):
             env = WrapPyTorch(env)
 
         env = DelayDone(env)
-        env = SleepAfterDone(env)
+        if args.auto_reset:
+            env = AutoResetAfterDone(env)
+        else:
+            env = SleepAfterDone(env)
 
         if args.num_processes in [1]:
             env=SingleThread(env)
@@ -264,6 +289,25 @@ def make_env(rank, args):
 
     return _thunk
 
+def make_native_vec_env(args):
+    '''args.num_processes envs stepped together in this process by a batched implementation,
+    instead of one make_env() per process, see --native-envs'''
+
+    if args.env_name in ['Explore2D']:
+        import explore2d
+        return explore2d.VecExplore2D(
+            args = args,
+        )
+
+    elif args.env_name in ['Explore2DContinuous']:
+        import explore2d_continuous
+        return explore2d_continuous.VecExplore2DContinuous(
+            args = args,
+        )
+
+    else:
+        raise NotImplemented
+
 
 class AddTimestep(gym.ObservationWrapper):
     def __init__(self, env=None):
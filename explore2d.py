@@ -6,6 +6,7 @@ from gym.utils import seeding
 import numpy as np
 import cv2
 import random
+from baselines.common.vec_env import VecEnv
 
 logger = logging.getLogger(__name__)
 
@@ -65,3 +66,103 @@ class Explore2D(gym.Env):
         self.eposide_length = 0
         self.position = np.array([0.0,0.0])
         return self.obs()
+
+class VecExplore2D(VecEnv):
+    '''args.num_processes Explore2D envs stepped together in this process, positions are held in one [N, 2] array.
+    Steps as make_env(), i.e., observations are in the layout of WrapPyTorch, and the done is delayed by one step
+    as in DelayDone, after which envs are reset as in AutoResetAfterDone if args.auto_reset,
+    otherwise they sleep as in SleepAfterDone, see envs.py'''
+
+    def __init__(self, args=None):
+
+        self.args = args
+
+        '''config'''
+        self.episode_length_limit = self.args.episode_length_limit
+        VecEnv.__init__(self,
+            num_envs = self.args.num_processes,
+            observation_space = spaces.Box(
+                low   = -float(self.episode_length_limit),
+                high  = +float(self.episode_length_limit),
+                shape = (1, 2, 2),
+                dtype = np.float64,
+            ),
+            action_space = spaces.Discrete(5),
+        )
+        self.delta_positions = np.array([
+            [ 0.0, 0.0],
+            [ 1.0, 0.0],
+            [ 0.0, 1.0],
+            [-1.0, 0.0],
+            [ 0.0,-1.0],
+        ])
+
+        self.position = np.zeros((self.num_envs, 2))
+        self.eposide_length = np.zeros(self.num_envs, dtype=np.int64)
+        '''the done of the last step of an episode is delayed by one step, see DelayDone'''
+        self.going_to_done = np.zeros(self.num_envs, dtype=bool)
+        '''None before reset, see SleepAfterDone'''
+        self.going_to_sleep = np.zeros(self.num_envs, dtype=bool)
+        self.sleeping = None
+        self.actions = None
+
+    def delta_position(self, actions):
+        return self.delta_positions[np.asarray(actions, dtype=np.int64).reshape(self.num_envs)]
+
+    def obs(self):
+        obs = np.zeros((self.num_envs, 1, 2, 2))
+        obs[:,0,0,:] = self.position
+        return obs
+
+    def reset_envs(self, to_reset):
+        self.position[to_reset] = 0.0
+        self.eposide_length[to_reset] = 0
+        self.going_to_done[to_reset] = False
+
+    def reset(self):
+        self.reset_envs(slice(None))
+        self.going_to_sleep[:] = False
+        self.sleeping = np.zeros(self.num_envs, dtype=bool)
+        return self.obs()
+
+    def step_async(self, actions):
+        self.actions = actions
+
+    def step_wait(self):
+
+        if not self.args.auto_reset:
+            self.sleeping |= self.going_to_sleep
+        awake = ~self.sleeping
+
+        '''envs that returned their last step return done, without stepping'''
+        delaying = awake & self.going_to_done
+        stepping = awake & (~self.going_to_done)
+
+        self.position[stepping] += self.delta_position(self.actions)[stepping]
+        self.eposide_length[stepping] += 1
+        if self.episode_length_limit > 0:
+            self.going_to_done |= stepping & (self.eposide_length >= self.episode_length_limit)
+        self.going_to_done &= ~delaying
+
+        done = delaying | self.sleeping
+        reward = np.zeros(self.num_envs)
+        obs = self.obs()
+        infos = [{} for _ in range(self.num_envs)]
+
+        if self.args.auto_reset:
+            for env_index in np.flatnonzero(done):
+                infos[env_index]['terminal_observation'] = obs[env_index]
+            self.reset_envs(done)
+            obs = self.obs()
+        else:
+            self.going_to_sleep = delaying
+
+        return obs, reward, done, tuple(infos)
+
+    def get_sleeping(self, env_index):
+        if self.sleeping is None:
+            return None
+        return bool(self.sleeping[env_index])
+
+    def close(self):
+        pass
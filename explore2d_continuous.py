@@ -6,6 +6,7 @@ from gym.utils import seeding
 import numpy as np
 import cv2
 import random
+from explore2d import VecExplore2D
 
 logger = logging.getLogger(__name__)
 
@@ -52,3 +53,23 @@ class Explore2DContinuous(gym.Env):
         self.eposide_length = 0
         self.position = np.array([0.0,0.0])
         return self.obs()
+
+class VecExplore2DContinuous(VecExplore2D):
+    '''args.num_processes Explore2DContinuous envs stepped together in this process,
+    actions are scaled as in ScaleActions, see VecExplore2D'''
+
+    def __init__(self, args=None):
+        super(VecExplore2DContinuous, self).__init__(args)
+
+        '''config'''
+        high = np.ones([2])
+        self.action_space = gym.spaces.Box(-high, high, dtype=np.float64)
+        high = np.inf * np.ones([2])
+        self.observation_space = gym.spaces.Box(-high, high, dtype=np.float64)
+
+    def delta_position(self, actions):
+        actions = np.asarray(actions, dtype=np.float64).reshape(self.num_envs, 2)
+        return (np.tanh(actions) + 1) / 2 * (self.action_space.high - self.action_space.low) + self.action_space.low
+
+    def obs(self):
+        return self.position.copy()
@@ -0,0 +1,69 @@
+'''
+Export the acting path of each hierarchy layer of a run for fast acting.
+Run with the same arguments as main.py, it loads hierarchy_{i}_actor_critic.pth from the save_dir of the run,
+and saves the traced ActingPolicy (see model.py) as hierarchy_{i}_acting_policy.pt in the same dir, e.g.,
+python export.py --exp code --env-name OverCooked --reward-level 1 --num-hierarchy 2 --num-subpolicy 5 --num-processes 16 --reward-bounty 1 --distance mass_center
+Pass --export-onnx to also save hierarchy_{i}_acting_policy.onnx.
+Act with the exported modules by running main.py with --acting-policy exported, with all layers in --inference-only-hierarchy.
+'''
+import gym
+import torch
+
+from envs import make_env
+from model import Policy, ActingPolicy, trace_acting_policy
+
+from arguments import get_args
+args = get_args()
+
+torch.set_num_threads(args.num_threads)
+
+env = make_env(0, args=args)()
+observation_space, bottom_action_space = env.observation_space, env.action_space
+env.close()
+
+obs_shape = observation_space.shape
+obs_shape = (obs_shape[0] * args.num_stack, *obs_shape[1:])
+
+if len(obs_shape)==3 and (obs_shape[1]==84) and (obs_shape[2]==84):
+    state_type = 'standard_image'
+else:
+    state_type = 'vector'
+
+'''same as main.py'''
+if len(args.num_subpolicy) != (args.num_hierarchy-1):
+    args.num_subpolicy = [args.num_subpolicy[0]]*(args.num_hierarchy-1)
+args.num_subpolicy += [2]
+
+for hierarchy_id in range(args.num_hierarchy):
+
+    actor_critic = Policy(
+        obs_shape = obs_shape,
+        state_type = state_type,
+        input_action_space = gym.spaces.Discrete(args.num_subpolicy[hierarchy_id]),
+        output_action_space = bottom_action_space if hierarchy_id in [0] else gym.spaces.Discrete(args.num_subpolicy[hierarchy_id-1]),
+        recurrent_policy = args.recurrent_policy,
+        num_subpolicy = args.num_subpolicy[hierarchy_id],
+    ).to(args.device)
+    actor_critic.load_state_dict(torch.load(args.save_dir+'/hierarchy_{}_actor_critic.pth'.format(hierarchy_id), map_location=args.device))
+
+    acting_policy, example_inputs = trace_acting_policy(
+        actor_critic = actor_critic,
+        obs_shape = obs_shape,
+        num_processes = args.num_processes,
+        device = args.device,
+    )
+    acting_policy.save(args.save_dir+'/hierarchy_{}_acting_policy.pt'.format(hierarchy_id))
+    print('[H-{:1}] Exported to {}'.format(hierarchy_id, args.save_dir+'/hierarchy_{}_acting_policy.pt'.format(hierarchy_id)))
+
+    if args.export_onnx:
+        torch.onnx.export(
+            ActingPolicy(actor_critic),
+            example_inputs,
+            args.save_dir+'/hierarchy_{}_acting_policy.onnx'.format(hierarchy_id),
+            input_names = ['inputs', 'states', 'masks', 'input_action_index', 'stochastic'],
+            output_names = ['value', 'action', 'action_log_probs', 'next_states'],
+            dynamic_axes = {
+                name: {0: 'num_processes'} for name in ['inputs', 'states', 'masks', 'input_action_index', 'value', 'action', 'action_log_probs', 'next_states']
+            },
+        )
+        print('[H-{:1}] Exported to {}'.format(hierarchy_id, args.save_dir+'/hierarchy_{}_acting_policy.onnx'.format(hierarchy_id)))
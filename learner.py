@@ -0,0 +1,118 @@
+'''
+Learners running in background threads, see --async-learner in arguments.py.
+The acting thread keeps interacting with envs on a slightly stale policy,
+while the learner trains copies of the models on the rollouts swapped out of the acting thread.
+'''
+import queue
+import threading
+import time
+
+class LayerView(object):
+    '''view of a HierarchyLayer for an agent (see algo/ppo.py), attributes given as kwargs override those of layer,
+    the others are read from layer. So that the agent can be bound to the copies of models trained by a learner,
+    instead of the models used for acting'''
+    def __init__(self, layer, **kwargs):
+        self.layer = layer
+        self.__dict__.update(kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__['layer'], name)
+
+class AsyncLearner(object):
+    '''call learn(job) in a background thread for each job submitted by the acting thread, in order.
+    After each job, the models trained by learn are published as a complete snapshot of their parameters,
+    the acting thread loads the last published snapshot into the models it acts with by sync(), between steps,
+    so that the acting models are never partially updated.
+    At most max_staleness jobs are pending, i.e., the acting models are at most max_staleness updates behind,
+    submit() blocks the acting thread till then, the time blocked is counted in idle_time'''
+    def __init__(self, learn, max_staleness):
+        self.learn = learn
+        self.max_staleness = max_staleness
+        '''pairs of (model trained by learn, model used for acting)'''
+        self.models = []
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()
+        self.num_pending = 0
+        self.lock = threading.Lock()
+        self.published = None
+        self.num_published = 0
+        self.num_loaded = 0
+        self.idle_time = 0.0
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True # if the acting thread crashes, we should not cause things to hang
+        self.thread.start()
+
+    def add_model(self, trained, acting):
+        '''acting is loaded with the parameters of trained, when trained is published'''
+        self.models += [(trained, acting)]
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                '''put by close()'''
+                break
+            try:
+                result = self.learn(job)
+                self.publish()
+            except Exception as e:
+                '''raised in the acting thread when it is collected'''
+                result = e
+            self.results.put((job, result))
+
+    def publish(self):
+        snapshot = [
+            ({name: x.detach().clone() for name, x in trained.state_dict().items()}, trained.version) for trained, _ in self.models
+        ]
+        with self.lock:
+            self.published = snapshot
+            self.num_published += 1
+
+    def sync(self):
+        '''load the last published snapshot into the acting models, if there is a new one'''
+        if self.num_published == self.num_loaded:
+            return
+        with self.lock:
+            snapshot, self.num_loaded = self.published, self.num_published
+        for (state_dict, version), (_, acting) in zip(snapshot, self.models):
+            acting.load_state_dict(state_dict)
+            '''memoized outputs of the acting model are invalidated, see utils.LRUMemo'''
+            acting.version = version
+
+    def collect(self, block):
+        '''return the list of (job, result) finished'''
+        finished = []
+        while self.num_pending > 0:
+            try:
+                job, result = self.results.get(block=block)
+            except queue.Empty:
+                break
+            self.num_pending -= 1
+            if isinstance(result, Exception):
+                raise result
+            finished += [(job, result)]
+            block = False
+        return finished
+
+    def submit(self, job):
+        '''submit job and return the list of (job, result) finished,
+        block untill at most max_staleness jobs are pending'''
+        self.jobs.put(job)
+        self.num_pending += 1
+        finished = self.collect(block=False)
+        start = time.time()
+        while self.num_pending > self.max_staleness:
+            finished += self.collect(block=True)
+        self.idle_time += time.time()-start
+        return finished
+
+    def close(self):
+        '''finish the pending jobs, stop the thread and load the last published snapshot into the acting models,
+        so that the acting models are saved with all submitted updates, return the list of (job, result) finished'''
+        if not self.thread.is_alive():
+            return []
+        self.jobs.put(None)
+        self.thread.join()
+        finished = self.collect(block=True)
+        self.sync()
+        return finished
@@ -13,14 +13,15 @@ import torch.optim as optim
 from baselines.common.vec_env.dummy_vec_env import DummyVecEnv
 from baselines.common.vec_env.subproc_vec_env import SubprocVecEnv
 from baselines.common.vec_env.vec_normalize import VecNormalize
-from envs import make_env
-from model import Policy
-from storage import RolloutStorage
+from envs import make_env, make_native_vec_env
+from model import Policy, trace_acting_policy
+from storage import RolloutStorage, FrameStack, ObservationStore, ObservationTable
+from learner import LayerView, AsyncLearner
 import tensorflow as tf
 import cv2
-from scipy import ndimage
 
 import utils
+import bounty
 
 import algo
 
@@ -32,8 +33,13 @@ if args.recurrent_policy:
     assert args.algo in ['a2c', 'ppo'], \
         'Recurrent policy is not implemented for ACKTR'
 
+if args.quantize_inference_only:
+    assert args.device.type in ['cpu'], \
+        'Dynamic quantization is only supported on cpu'
+
 torch.manual_seed(args.seed)
-torch.cuda.manual_seed(args.seed)
+if args.device.type in ['cuda']:
+    torch.cuda.manual_seed(args.seed)
 
 print('######## SUMMARY OF LOGGING ########')
 try:
@@ -54,15 +60,17 @@ print('####################################')
 log_fourcc = cv2.VideoWriter_fourcc(*'MJPG')
 log_fps = 10
 
-torch.set_num_threads(1)
+torch.set_num_threads(args.num_threads)
 
 summary_writer = tf.summary.FileWriter(args.save_dir)
 
 bottom_envs = [make_env(i, args=args)
             for i in range(args.num_processes)]
 
-if args.num_processes > 1:
-    bottom_envs = SubprocVecEnv(bottom_envs)
+if args.native_envs:
+    bottom_envs = make_native_vec_env(args)
+elif args.num_processes > 1:
+    bottom_envs = SubprocVecEnv(bottom_envs, shared_memory=args.shared_memory_envs, envs_per_worker=args.envs_per_worker)
 else:
     bottom_envs = bottom_envs[0]()
 
@@ -120,7 +128,7 @@ if len(args.num_steps) != (args.num_hierarchy):
 
 input_actions_onehot_global = []
 for hierarchy_i in range(args.num_hierarchy):
-    input_actions_onehot_global += [torch.zeros(args.num_processes, args.num_subpolicy[hierarchy_i]).cuda()]
+    input_actions_onehot_global += [torch.zeros(args.num_processes, args.num_subpolicy[hierarchy_i]).to(args.device)]
 '''init top layer input_actions'''
 input_actions_onehot_global[-1][:,0]=1.0
 
@@ -143,15 +151,6 @@ def puton_input_action_text(img):
     )
     return img
 
-def get_mass_center(obs):
-    return np.asarray(
-        ndimage.measurements.center_of_mass(
-            (
-                (obs+255.0)/2.0
-            ).astype(np.uint8)
-        )
-    )
-
 sess = tf.Session()
 
 if args.env_name in ['Explore2D']:
@@ -247,9 +246,9 @@ if args.inverse_mask:
     inverse_mask_model = InverseMaskModel(
         predicted_action_space = bottom_envs.action_space.n,
         num_grid = args.num_grid,
-    ).cuda()
+    ).to(args.device)
     try:
-        inverse_mask_model.load_state_dict(torch.load(args.save_dir+'/inverse_mask_model.pth'))
+        inverse_mask_model.load_state_dict(torch.load(args.save_dir+'/inverse_mask_model.pth', map_location=args.device))
         print('Load inverse_mask_model previous point: Successed')
     except Exception as e:
         print('Load inverse_mask_model previous point: Failed, due to {}')
@@ -272,14 +271,22 @@ if args.inverse_mask:
         epoch_loss = {}
         inverse_mask_model.train()
 
+        '''collect the dataset once for all epochs'''
+        dataset = bottom_layer.rollouts.transition_model_dataset()
+
         for e in range(4):
 
             data_generator = bottom_layer.rollouts.transition_model_feed_forward_generator(
+                dataset = dataset,
                 mini_batch_size = bottom_layer.args.actor_critic_mini_batch_size,
             )
 
             for sample in data_generator:
 
+                if sample is None:
+                    print('# WARNING: No sample this update!')
+                    return epoch_loss
+
                 observations_batch, next_observations_batch, action_onehot_batch, reward_bounty_raw_batch = sample
 
                 optimizer_inverse_mask_model.zero_grad()
@@ -354,7 +361,7 @@ class HierarchyLayer(object):
             output_action_space = self.envs.action_space,
             recurrent_policy = args.recurrent_policy,
             num_subpolicy = args.num_subpolicy[self.hierarchy_id],
-        ).cuda()
+        ).to(args.device)
 
         if args.reward_bounty > 0.0 and self.hierarchy_id not in [0]:
             from model import TransitionModel
@@ -365,13 +372,9 @@ class HierarchyLayer(object):
                 output_observation_shape = self.envs.observation_space.shape,
                 num_subpolicy = args.num_subpolicy[self.hierarchy_id-1],
                 mutual_information = args.mutual_information,
-            ).cuda()
-            self.action_onehot_batch = torch.zeros(args.num_processes*self.envs.action_space.n,self.envs.action_space.n).cuda()
-            batch_i = 0
-            for action_i in range(self.envs.action_space.n):
-                for process_i in range(args.num_processes):
-                    self.action_onehot_batch[batch_i][action_i] = 1.0
-                    batch_i += 1
+            ).to(args.device)
+            '''onehot of each action of self.envs, to predict for all of them at once'''
+            self.action_onehot_each_action = torch.eye(self.envs.action_space.n).to(args.device)
         else:
             self.transition_model = None
 
@@ -391,6 +394,38 @@ class HierarchyLayer(object):
                 acktr=True,
             )
 
+        '''frames shared by all layers, owned by the bottom layer'''
+        if not (args.share_observations or args.intern_observations):
+            self.observation_store = None
+        elif self.hierarchy_id in [0]:
+            if args.intern_observations:
+                '''frames are never freed from the table, so it is only for envs of a small, bounded set of distinct frames'''
+                assert args.env_name in ['GridWorld', 'Explore2D'], '--intern-observations only supports GridWorld and Explore2D, the table grows with every distinct frame'
+                '''each distinct frame is kept once, start with slots for the frames of one step, it grows by doubling'''
+                self.observation_store = ObservationTable(
+                    capacity = args.num_processes,
+                    num_processes = args.num_processes,
+                    frame_shape = self.envs.observation_space.shape,
+                    dtype = torch.uint8 if (args.compact_rollouts and (self.envs.observation_space.dtype == np.uint8)) else torch.float32,
+                ).to(args.device)
+            else:
+                '''with a single frame, rollouts of layers refer to frames at different steps, mostly,
+                only the stacked frames referred several times are saved by the store'''
+                assert args.num_stack > 1, '--share-observations requires --num-stack > 1, use --intern-observations for small discrete-state envs'
+                '''start with slots for the frames referenced by this layer, it grows when upper layers reference more'''
+                self.observation_store = ObservationStore(
+                    capacity = args.num_steps[self.hierarchy_id]+args.num_stack+1,
+                    num_processes = args.num_processes,
+                    frame_shape = self.envs.observation_space.shape,
+                    dtype = torch.uint8 if (args.compact_rollouts and (self.envs.observation_space.dtype == np.uint8)) else torch.float32,
+                ).to(args.device)
+            print('[H-{:1}] Observation store takes {:.1f} MB at start.'.format(
+                self.hierarchy_id,
+                self.observation_store.memory_footprint()/1024.0/1024.0,
+            ))
+        else:
+            self.observation_store = self.envs.observation_store
+
         self.rollouts = RolloutStorage(
             num_steps = args.num_steps[self.hierarchy_id],
             num_processes = args.num_processes,
@@ -399,8 +434,24 @@ class HierarchyLayer(object):
             action_space = self.envs.action_space,
             state_size = self.actor_critic.state_size,
             observation_space = self.envs.observation_space,
-        ).cuda()
-        self.current_obs = torch.zeros(args.num_processes, *obs_shape).cuda()
+            compact = args.compact_rollouts,
+            store = self.observation_store,
+        ).to(args.device)
+        print('[H-{:1}] Rollout storage takes {:.1f} MB.'.format(
+            self.hierarchy_id,
+            self.rollouts.memory_footprint()/1024.0/1024.0,
+        ))
+        '''last args.num_stack frames of each process, gathered into self.rollouts at insert'''
+        self.frame_stack = FrameStack(
+            num_processes = args.num_processes,
+            frame_shape = self.envs.observation_space.shape,
+            num_stack = args.num_stack,
+            dtype = self.rollouts.observation_dtype,
+            store = self.observation_store,
+        ).to(args.device)
+        if self.hierarchy_id in [0]:
+            '''preallocated, obs from bottom envs is copied into it at every step'''
+            self.obs_on_device = torch.zeros(args.num_processes, *self.envs.observation_space.shape).to(args.device)
 
         '''for summarizing reward'''
         self.episode_reward = {}
@@ -426,13 +477,13 @@ class HierarchyLayer(object):
         try:
             self.num_trained_frames = np.load(args.save_dir+'/hierarchy_{}_num_trained_frames.npy'.format(self.hierarchy_id))[0]
             try:
-                self.actor_critic.load_state_dict(torch.load(args.save_dir+'/hierarchy_{}_actor_critic.pth'.format(self.hierarchy_id)))
+                self.actor_critic.load_state_dict(torch.load(args.save_dir+'/hierarchy_{}_actor_critic.pth'.format(self.hierarchy_id), map_location=args.device))
                 print('[H-{:1}] Load actor_critic previous point: Successed'.format(self.hierarchy_id))
             except Exception as e:
                 print('[H-{:1}] Load actor_critic previous point: Failed, due to {}'.format(self.hierarchy_id,e))
             if self.transition_model is not None:
                 try:
-                    self.transition_model.load_state_dict(torch.load(args.save_dir+'/hierarchy_{}_transition_model.pth'.format(self.hierarchy_id)))
+                    self.transition_model.load_state_dict(torch.load(args.save_dir+'/hierarchy_{}_transition_model.pth'.format(self.hierarchy_id), map_location=args.device))
                     print('[H-{:1}] Load transition_model previous point: Successed'.format(self.hierarchy_id))
                 except Exception as e:
                     print('[H-{:1}] Load transition_model previous point: Failed, due to {}'.format(self.hierarchy_id,e))
@@ -444,10 +495,85 @@ class HierarchyLayer(object):
         print('[H-{:1}] Learner has been trained to step: {}'.format(self.hierarchy_id, self.num_trained_frames))
         self.num_trained_frames_at_start = self.num_trained_frames
 
+        '''layers in args.inference_only_hierarchy only act and predict, they are not updated or saved.
+        transition_model of this layer is trained by the downer layer, so it is inference only if the downer layer is'''
+        self.inference_only = self.hierarchy_id in args.inference_only_hierarchy
+        self.transition_model_inference_only = (self.transition_model is not None) and ((self.hierarchy_id-1) in args.inference_only_hierarchy)
+        if args.quantize_inference_only:
+            if self.inference_only:
+                self.actor_critic = utils.quantize_for_inference(self.actor_critic)
+                print('[H-{:1}] Quantized actor_critic for inference'.format(self.hierarchy_id))
+            if self.transition_model_inference_only:
+                self.transition_model = utils.quantize_for_inference(self.transition_model)
+                print('[H-{:1}] Quantized transition_model for inference'.format(self.hierarchy_id))
+
+        '''memoize features and predictions per observation id, they are the same for the same interned observation
+        until the model is updated'''
+        if args.memo_size > 0:
+            assert args.intern_observations and (args.num_stack==1) and (not args.recurrent_policy), \
+                '--memo-size requires --intern-observations, --num-stack 1 and a feed-forward policy'
+            self.actor_critic.feature_memo = utils.LRUMemo(args.memo_size, args.device)
+            if self.transition_model is not None:
+                self.transition_model.prediction_memo = utils.LRUMemo(args.memo_size, args.device)
+
+        '''compiled module to act with, see ActingPolicy in model.py'''
+        if args.acting_policy in ['eager']:
+            self.acting_policy = None
+        elif args.acting_policy in ['traced']:
+            '''shares parameters with self.actor_critic, so it keeps acting with the latest policy'''
+            self.acting_policy, _ = trace_acting_policy(
+                actor_critic = self.actor_critic,
+                obs_shape = obs_shape,
+                num_processes = args.num_processes,
+                device = args.device,
+            )
+        elif args.acting_policy in ['exported']:
+            '''frozen at export, for evaluating a trained run, so actor_critic should not be updated,
+            otherwise PPO would train on actions that the updated actor_critic did not take'''
+            assert self.inference_only, '--acting-policy exported requires every layer in --inference-only-hierarchy, the exported policy is not updated'
+            self.acting_policy = torch.jit.load(
+                args.save_dir+'/hierarchy_{}_acting_policy.pt'.format(self.hierarchy_id),
+                map_location = args.device,
+            )
+        else:
+            raise NotImplemented
+        print('[H-{:1}] Act with {} policy'.format(self.hierarchy_id, args.acting_policy))
+        self.stochastic = torch.ones(1).to(args.device)
+        self.not_stochastic = torch.zeros(1).to(args.device)
+
+        '''with args.env_groups > 1, the bottom layer acts on the groups of envs in turn,
+        each group simulates while the next one is acted on, see act_and_step_in_groups()'''
+        if (self.hierarchy_id in [0]) and (args.env_groups > 1):
+            assert isinstance(self.envs, SubprocVecEnv), '--env-groups requires env workers, i.e., --num-processes > 1 without --native-envs'
+            assert not args.test_action, '--env-groups does not support --test-action'
+            assert len(self.envs.remotes) >= args.env_groups, \
+                '--env-groups {} needs at least as many env workers, there are {}, since envs are spread over as many workers as physical cores by default, pass --envs-per-worker, e.g., 1'.format(
+                    args.env_groups, len(self.envs.remotes),
+                )
+            self.env_groups = self.envs.split_groups(args.env_groups)
+        else:
+            self.env_groups = None
+
         self.start = time.time()
         self.step_i = 0
         self.update_i = 0
 
+        '''for the host<->device transfers metric, see utils.to_device and utils.to_host'''
+        self.num_host_device_transfers_at_last_update = 0
+        self.host_device_transfers_per_step = 0.0
+
+        '''an env is sleeping at a step if it has been done at the last step, see SleepAfterDone in envs.py'''
+        self.done_at_last_step = np.zeros(args.num_processes, dtype=bool)
+        self.sleeping = [None]*args.num_processes
+        self.num_sleeping_steps = 0
+        self.sleeping_steps_fraction = 0.0
+
+        '''done and masks accumulated over the macro step of the upper layer.
+        An env done in the middle of the macro step is done for the upper layer,
+        so that it is masked the same way, whether it sleeps or is reset at once (see --auto-reset)'''
+        self.done_in_macro = np.zeros(args.num_processes, dtype=bool)
+        self.masks_in_macro = torch.ones(args.num_processes, 1).to(args.device)
+
         self.refresh_update_type()
 
         self.last_time_summarize_behavior = 0.0 # make sure the first episode is recorded
@@ -457,40 +583,124 @@ class HierarchyLayer(object):
 
         self.predicted_next_observations_to_downer_layer = None
         self.mask_of_predicted_observation_to_downer_layer = None
+        self.is_predicted_to_downer_layer = False
+
+        '''with args.async_learner, the agent trains copies of the models in a background thread, on rollouts
+        swapped out of this layer, while this layer keeps acting with the models published by the learner, see learner.py'''
+        self.actor_idle_time = 0.0
+        if args.async_learner and (not self.inference_only):
+            assert args.algo in ['ppo'], '--async-learner is only supported with ppo'
+            assert not (args.share_observations or args.intern_observations), \
+                '--async-learner keeps rollouts of its own, it does not support shared observations'
+            self.learner = AsyncLearner(
+                learn = self.learn,
+                max_staleness = args.max_staleness,
+            )
+            self.learner_view = LayerView(
+                layer = self,
+                actor_critic = self.copy_for_learner(self.actor_critic),
+                rollouts = self.rollouts,
+                update_i = self.update_i,
+            )
+            self.learner.add_model(self.learner_view.actor_critic, self.actor_critic)
+            '''rollouts being filled by this layer are self.rollouts, the others are free or being learnt'''
+            self.free_rollouts = [copy.deepcopy(self.rollouts) for _ in range(args.max_staleness)]
+            self.learner_epoch_loss = {}
+            self.agent.set_this_layer(self.learner_view)
+        else:
+            self.learner = None
+            self.agent.set_this_layer(self)
 
-        self.agent.set_this_layer(self)
-
-        self.bounty_clip = torch.zeros(args.num_processes).cuda()
-        self.reward_bounty_raw_to_return = torch.zeros(args.num_processes).cuda()
-        self.reward_final = torch.zeros(args.num_processes).cuda()
-        self.reward_bounty = torch.zeros(args.num_processes).cuda()
+        self.bounty_clip = torch.zeros(args.num_processes).to(args.device)
+        self.reward_bounty_raw_to_return = torch.zeros(args.num_processes).to(args.device)
+        self.reward_final = torch.zeros(args.num_processes).to(args.device)
+        self.reward_bounty = torch.zeros(args.num_processes).to(args.device)
 
         if (self.args.env_name in ['Explore2D']) and (self.hierarchy_id in [0]):
             self.terminal_states = []
 
     def set_upper_layer(self, upper_layer):
         self.upper_layer = upper_layer
-        self.agent.set_upper_layer(self.upper_layer)
+        if self.learner is None:
+            self.agent.set_upper_layer(self.upper_layer)
+        else:
+            '''transition_model of upper layer is trained by the learner of this layer'''
+            upper_learner_view = LayerView(
+                layer = self.upper_layer,
+                transition_model = self.copy_for_learner(self.upper_layer.transition_model),
+            )
+            if upper_learner_view.transition_model is not None:
+                self.learner.add_model(upper_learner_view.transition_model, self.upper_layer.transition_model)
+            self.agent.set_upper_layer(upper_learner_view)
+
+    def copy_for_learner(self, model):
+        '''copy of model trained by the learner, without memos'''
+        if model is None:
+            return None
+        model = copy.deepcopy(model)
+        if isinstance(model, Policy):
+            model.feature_memo = None
+        else:
+            model.prediction_memo = None
+        return model
+
+    def learn(self, job):
+        '''called in the learner thread, update the copies of models with job['rollouts']'''
+        self.learner_view.rollouts = job['rollouts']
+        self.learner_view.update_i = job['update_i']
+        if job['update_type'] in ['actor_critic','both']:
+            with torch.no_grad():
+                next_value = self.learner_view.actor_critic.get_value(
+                    inputs=job['rollouts'].get_observations(-1),
+                    states=job['rollouts'].states[-1],
+                    masks=job['rollouts'].get_masks(-1),
+                    input_action=job['rollouts'].get_input_actions(-1),
+                ).detach()
+            job['rollouts'].compute_returns(next_value, args.use_gae, args.gamma, args.tau)
+        return self.agent.update(
+            job['update_type'],
+            transition_model_dataset = job['transition_model_dataset'],
+        )
+
+    def submit_to_learner(self):
+        '''submit self.rollouts to the learner, and continue acting on free rollouts,
+        the transition_model dataset is collected here, since the upper layer keeps acting'''
+        if self.update_type in ['transition_model','both']:
+            transition_model_dataset = self.agent.transition_model_dataset()
+        else:
+            transition_model_dataset = None
+        finished = self.learner.submit({
+            'rollouts': self.rollouts,
+            'update_i': self.update_i,
+            'update_type': self.update_type,
+            'transition_model_dataset': transition_model_dataset,
+        })
+        for finished_job, epoch_loss in finished:
+            self.free_rollouts += [finished_job['rollouts']]
+            self.learner_epoch_loss = epoch_loss
+        '''start the free rollouts from the last step of the submitted rollouts'''
+        rollouts = self.free_rollouts.pop(0)
+        rollouts.start_from(self.rollouts)
+        self.rollouts = rollouts
 
     def step(self, inputs):
         '''as a environment, it has step method'''
         if args.reward_bounty > 0.0 and (not args.mutual_information):
-            input_cpu_actions = inputs['actions_to_step']
-            self.predicted_next_observations_by_upper_layer = inputs['predicted_next_observations_to_downer_layer']
-            self.mask_of_predicted_observation_by_upper_layer = inputs['mask_of_predicted_observation_to_downer_layer']
-            self.observation_predicted_from_by_upper_layer = inputs['observation_predicted_from_to_downer_layer']
-            self.predicted_reward_bounty_by_upper_layer     = inputs['predicted_reward_bounty_to_downer_layer']
+            input_actions = inputs['actions_to_step']
+            '''predictions of upper layer are made lazily, when they are consumed'''
+            self.predict_by_upper_layer = inputs['predict_to_downer_layer']
         else:
-            input_cpu_actions = inputs['actions_to_step']
-            self.predicted_next_observations_by_upper_layer = None
-            self.observation_predicted_from_by_upper_layer = None
-            self.predicted_reward_bounty_by_upper_layer = None
+            input_actions = inputs['actions_to_step']
+            self.predict_by_upper_layer = None
 
-        '''convert: input_cpu_actions >> input_actions_onehot_global[self.hierarchy_id]'''
+        '''convert: input_actions >> input_actions_onehot_global[self.hierarchy_id],
+        input_actions is on device, so there is no host<->device transfer'''
         input_actions_onehot_global[self.hierarchy_id].fill_(0.0)
-        input_actions_onehot_global[self.hierarchy_id].scatter_(1,torch.from_numpy(input_cpu_actions).long().unsqueeze(1).cuda(),1.0)
+        input_actions_onehot_global[self.hierarchy_id].scatter_(1,input_actions.long().unsqueeze(1),1.0)
 
         '''macro step forward'''
+        self.done_in_macro[:] = False
+        self.masks_in_macro.fill_(1.0)
         reward_macro = None
         for macro_step_i in range(self.hierarchy_interval):
 
@@ -509,13 +719,17 @@ class HierarchyLayer(object):
             else:
                 reward_macro += self.reward
 
-        return self.obs, reward_macro, self.reward_bounty_raw_to_return, self.done, self.info
+        return self.obs, reward_macro, self.reward_bounty_raw_to_return, self.done_in_macro.copy(), self.info
 
     def one_step(self):
         '''as a environment, it has step method.
         But the step method step forward for args.hierarchy_interval times,
         as a macro action, this method is to step forward for a singel step'''
 
+        '''act with the models last published by the learner'''
+        if self.learner is not None:
+            self.learner.sync()
+
         '''for each one_step, interact with env for one step'''
         self.interact_one_step()
 
@@ -587,7 +801,11 @@ class HierarchyLayer(object):
     def generate_actions_to_step(self):
         '''this method generate actions_to_step controlled by many logic'''
 
-        self.actions_to_step = self.action.squeeze(1).cpu().numpy()
+        '''actions are passed between layers on device,
+        they are converted to numpy only at the bottom env boundary'''
+        self.actions_to_step = self.action.squeeze(1)
+        if self.hierarchy_id in [0]:
+            self.actions_to_step = utils.to_host(self.actions_to_step)
 
         if self.hierarchy_id not in [0]:
             self.actions_to_step = {
@@ -596,51 +814,57 @@ class HierarchyLayer(object):
 
         if (self.hierarchy_id not in [0]) and (args.reward_bounty > 0.0) and (not args.mutual_information):
 
+            '''states are predicted lazily by predict_to_downer_layer(),
+            only when the downer layer needs them to compute reward bounty,
+            or when they are summarized'''
+            self.is_predicted_to_downer_layer = False
+            self.actions_to_step.update(
+                {
+                    'predict_to_downer_layer': self.predict_to_downer_layer,
+                }
+            )
+
+    def predict_to_downer_layer(self):
+        '''predict next observations of downer layer resulted from each of its actions,
+        predictions are made at most once per macro step and cached'''
+
+        if not self.is_predicted_to_downer_layer:
+
             '''predict states'''
             self.transition_model.eval()
             with torch.no_grad():
-                if len(self.rollouts.observations[self.step_i].size())==4:
+                now_states = self.rollouts.get_observations(self.step_i)
+                if len(now_states.size())==4:
                     '''state are represented in a image format'''
-                    self.observation_predicted_from_to_downer_layer = self.rollouts.observations[self.step_i][:,-1:]
-                elif len(self.rollouts.observations[self.step_i].size())==2:
+                    self.observation_predicted_from_to_downer_layer = now_states[:,-1:]
+                elif len(now_states.size())==2:
                     '''state are represented in a one-dimentional vector format'''
-                    self.observation_predicted_from_to_downer_layer = self.rollouts.observations[self.step_i]
+                    self.observation_predicted_from_to_downer_layer = now_states
                 else:
                     raise NotImplemented
 
-                if len(self.rollouts.observations[self.step_i].size()) in [4]:
-                    now_states = self.rollouts.observations[self.step_i].repeat(self.envs.action_space.n,1,1,1)
-                elif len(self.rollouts.observations[self.step_i].size()) in [2]:
-                    now_states = self.rollouts.observations[self.step_i].repeat(self.envs.action_space.n,1)
-                else:
-                    raise NotImplemented
-
-                self.predicted_next_observations_to_downer_layer, self.predicted_reward_bounty_to_downer_layer = self.transition_model(
+                '''encode now_states once and predict for all actions'''
+                self.predicted_next_observations_to_downer_layer, self.predicted_reward_bounty_to_downer_layer = self.transition_model.predict_each_action(
                     inputs = now_states,
-                    input_action = self.action_onehot_batch,
+                    input_action = self.action_onehot_each_action,
+                    observation_ids = self.rollouts.get_observation_ids(self.step_i),
                 )
+                self.predicted_reward_bounty_to_downer_layer = self.predicted_reward_bounty_to_downer_layer.squeeze(2)
+
                 '''generate inverse mask'''
                 if self.args.inverse_mask:
                     inverse_mask_model.eval()
+                    '''the mask only depends on the real obs, which is the same for all actions'''
                     self.mask_of_predicted_observation_to_downer_layer = inverse_mask_model.get_mask(
                         # last_states = (now_states[:,-1:]+self.predicted_next_observations_to_downer_layer),
                         last_states = now_states[:,-1:], # only predict from real obs first
-                    )
+                    ).unsqueeze(0).expand(self.envs.action_space.n,-1,-1,-1,-1)
+                else:
+                    self.mask_of_predicted_observation_to_downer_layer = None
 
-            self.predicted_next_observations_to_downer_layer = self.predicted_next_observations_to_downer_layer.view(self.envs.action_space.n,args.num_processes,*self.predicted_next_observations_to_downer_layer.size()[1:])
-            if self.args.inverse_mask:
-                self.mask_of_predicted_observation_to_downer_layer = self.mask_of_predicted_observation_to_downer_layer.view(self.envs.action_space.n,args.num_processes,*self.mask_of_predicted_observation_to_downer_layer.size()[1:])
-            else:
-                self.mask_of_predicted_observation_to_downer_layer = None
-            self.predicted_reward_bounty_to_downer_layer = self.predicted_reward_bounty_to_downer_layer.view(self.envs.action_space.n,args.num_processes,*self.predicted_reward_bounty_to_downer_layer.size()[1:]).squeeze(2)
-            self.actions_to_step.update(
-                {
-                    'predicted_next_observations_to_downer_layer': self.predicted_next_observations_to_downer_layer,
-                    'mask_of_predicted_observation_to_downer_layer': self.mask_of_predicted_observation_to_downer_layer,
-                    'observation_predicted_from_to_downer_layer': self.observation_predicted_from_to_downer_layer,
-                    'predicted_reward_bounty_to_downer_layer': self.predicted_reward_bounty_to_downer_layer,
-                }
-            )
+            self.is_predicted_to_downer_layer = True
+
+        return self.predicted_next_observations_to_downer_layer, self.mask_of_predicted_observation_to_downer_layer, self.observation_predicted_from_to_downer_layer, self.predicted_reward_bounty_to_downer_layer
 
     def generate_reward_bounty(self):
         '''this method generate reward bounty'''
@@ -653,75 +877,39 @@ class HierarchyLayer(object):
         '''START: computer normalized reward_bounty, EVERY T interval'''
         if (args.reward_bounty>0) and (self.hierarchy_id not in [args.num_hierarchy-1]) and (self.is_final_step_by_upper_layer or self.is_extend_step):
 
-            '''START: compute none normalized reward_bounty_raw_to_return'''
-            action_rb = self.rollouts.input_actions[self.step_i].nonzero()[:,1]
-            obs_rb = self.obs.astype(float)-self.observation_predicted_from_by_upper_layer.cpu().numpy()
-            prediction_rb = self.predicted_next_observations_by_upper_layer.cpu().numpy()
-            if self.args.inverse_mask:
-                mask_rb = self.mask_of_predicted_observation_by_upper_layer.cpu().numpy()
-            for process_i in range(args.num_processes):
-                difference_list = []
-                for action_i in range(prediction_rb.shape[0]):
-                    if action_i!=action_rb[process_i]:
-                        '''compute difference'''
-                        if args.distance in ['l2']:
-                            if args.env_name in ['Explore2D']:
-                                difference = np.linalg.norm(
-                                    x = (obs_rb[process_i][0,0]-prediction_rb[action_i,process_i][0,0]),
-                                    ord = 2,
-                                )
-                            elif ('MinitaurBulletEnv' in args.env_name) or ('AntBulletEnv' in args.env_name):
-                                '''28:30 represents the position'''
-                                difference = np.linalg.norm(
-                                    x = (obs_rb[process_i][28:30]-prediction_rb[action_i,process_i][28:30]),
-                                    ord = 2,
-                                )/(obs_rb[process_i][28:30].shape[0]**0.5)
-                            elif args.env_name in ['ReacherBulletEnv-v1','Explore2DContinuous']:
-                                '''0:2 represents the position'''
-                                difference = np.linalg.norm(
-                                    x = (obs_rb[process_i][0:2]-prediction_rb[action_i,process_i][0:2]),
-                                    ord = 2,
-                                )/(obs_rb[process_i][0:2].shape[0]**0.5)
-                            else:
-                                raise NotImplemented
-                        elif args.distance in ['mass_center']:
-                            # mask here: *mask_rb[action_i,process_i][0]
-                            difference = np.linalg.norm(
-                                get_mass_center(obs_rb[process_i][0])-get_mass_center(prediction_rb[action_i,process_i][0])
-                            )
-                        else:
-                            raise NotImplemented
-
-                        difference_list += [difference*args.reward_bounty]
-                if args.diversity_driven_active_function in ['min']:
-                    self.reward_bounty_raw_to_return[process_i] += float(np.amin(difference_list))
-                elif args.diversity_driven_active_function in ['sum']:
-                    self.reward_bounty_raw_to_return[process_i] += float(np.sum(difference_list))
-                else:
-                    raise NotImplemented
+            '''get predictions from upper layer'''
+            self.predicted_next_observations_by_upper_layer, self.mask_of_predicted_observation_by_upper_layer, self.observation_predicted_from_by_upper_layer, self.predicted_reward_bounty_by_upper_layer = self.predict_by_upper_layer()
 
+            '''START: compute none normalized reward_bounty_raw_to_return'''
+            action_rb = self.rollouts.get_input_actions(self.step_i).argmax(dim=1)
+            self.reward_bounty_raw_to_return += bounty.compute_reward_bounty_raw(
+                obs = self.obs,
+                observation_predicted_from = self.observation_predicted_from_by_upper_layer,
+                predicted_next_observations = self.predicted_next_observations_by_upper_layer,
+                action = action_rb,
+                distance = args.distance,
+                env_name = args.env_name,
+                reward_bounty = args.reward_bounty,
+                diversity_driven_active_function = args.diversity_driven_active_function,
+            )
+            # mask here: self.mask_of_predicted_observation_by_upper_layer
             '''END: compute none normalized reward_bounty_raw_to_return'''
 
             '''mask reward bounty, since the final state is start state,
-            and the estimation from transition model is not accurate'''
-            self.reward_bounty_raw_to_return *= self.masks.squeeze()
+            and the estimation from transition model is not accurate.
+            Envs done in the middle of the macro step are masked as well, since they may have been reset'''
+            self.reward_bounty_raw_to_return *= self.masks_in_macro.squeeze(1)
 
             '''START: computer bounty after being clipped'''
             if args.clip_reward_bounty:
-                for process_i in range(args.num_processes):
-                    self.bounty_clip[process_i] = self.predicted_reward_bounty_by_upper_layer[action_rb[process_i]][process_i]
-                    delta = (self.reward_bounty_raw_to_return[process_i]-self.bounty_clip[process_i])
-                    if args.clip_reward_bounty_active_function in ['linear']:
-                        self.reward_bounty[process_i] = delta
-                    elif args.clip_reward_bounty_active_function in ['u']:
-                        self.reward_bounty[process_i] = delta.sign().clamp(min=0.0,max=1.0)
-                    elif args.clip_reward_bounty_active_function in ['relu']:
-                        self.reward_bounty[process_i] = F.relu(delta)
-                    elif args.clip_reward_bounty_active_function in ['shrink_relu']:
-                        positive_active = delta.sign().clamp(min=0.0,max=1.0)
-                        self.reward_bounty[process_i] = delta * positive_active + positive_active - 1
-                    else:
-                        raise Exception('No Supported')
+                reward_bounty, bounty_clip = bounty.clip_reward_bounty(
+                    reward_bounty_raw = self.reward_bounty_raw_to_return,
+                    predicted_reward_bounty = self.predicted_reward_bounty_by_upper_layer,
+                    action = action_rb,
+                    clip_reward_bounty_active_function = args.clip_reward_bounty_active_function,
+                )
+                self.bounty_clip.copy_(bounty_clip)
+                self.reward_bounty.copy_(reward_bounty)
             else:
                 self.reward_bounty = self.reward_bounty_raw_to_return
             '''END: end of computer bounty after being clipped'''
@@ -735,7 +923,7 @@ class HierarchyLayer(object):
                 '''top level only receive reward from env or nothing to observe unsupervised learning'''
                 if self.args.env_name in ['OverCooked','GridWorld'] or ('NoFrameskip-v4' in args.env_name):
                     '''top level only receive reward from env'''
-                    self.reward_final += self.reward.cuda()
+                    self.reward_final += self.reward
                 elif (self.args.env_name in ['MineCraft','Explore2D','Explore2DContinuous']) or ('Bullet' in args.env_name):
                     '''top level only receive nothing to observe unsupervised learning'''
                     pass
@@ -749,9 +937,9 @@ class HierarchyLayer(object):
                 elif self.args.env_name in ['GridWorld','AntBulletEnv-v1'] or ('NoFrameskip-v4' in args.env_name):
                     '''reward occurs more frequently and we want down layers to know it'''
                     if self.args.env_name in ['GridWorld'] or ('NoFrameskip-v4' in args.env_name):
-                        self.reward_final += self.reward.cuda()
+                        self.reward_final += self.reward
                     elif self.args.env_name in ['AntBulletEnv-v1']:
-                        self.reward_final += (self.reward.cuda()*0.001)
+                        self.reward_final += (self.reward*0.001)
                     else:
                         raise NotImplemented
                 else:
@@ -770,22 +958,24 @@ class HierarchyLayer(object):
 
         self.rollouts.input_actions[self.step_i].copy_(input_actions_onehot_global[self.hierarchy_id])
 
-        '''Sample actions'''
-        with torch.no_grad():
-            self.value, self.action, self.action_log_prob, self.states = self.actor_critic.act(
-                inputs = self.rollouts.observations[self.step_i],
+        if self.env_groups is None:
+            '''Sample actions'''
+            self.value, self.action, self.action_log_prob, self.states = self.act(
+                inputs = self.rollouts.get_observations(self.step_i),
                 states = self.rollouts.states[self.step_i],
-                masks = self.rollouts.masks[self.step_i],
-                deterministic = self.deterministic,
-                input_action = self.rollouts.input_actions[self.step_i],
+                masks = self.rollouts.get_masks(self.step_i),
+                input_actions = self.rollouts.get_input_actions(self.step_i),
+                observation_ids = self.rollouts.get_observation_ids(self.step_i),
             )
 
-        self.specify_action()
+            self.specify_action()
 
-        self.generate_actions_to_step()
+            self.generate_actions_to_step()
 
-        '''Obser reward and next obs'''
-        fetched = self.envs.step(self.actions_to_step)
+            '''Obser reward and next obs'''
+            fetched = self.envs.step(self.actions_to_step)
+        else:
+            fetched = self.act_and_step_in_groups()
         if self.hierarchy_id in [0]:
             # print('====')
             # print(self.obs[0])
@@ -793,31 +983,45 @@ class HierarchyLayer(object):
             # print(self.obs[0])
             # print(self.done[0])
             # input('continue')
+            self.obs_to_device()
         else:
             self.obs, self.reward_raw_OR_reward, self.reward_bounty_raw_returned, self.done, self.info = fetched
+        self.refresh_obs_slot()
+        self.refresh_sleeping()
 
         if self.hierarchy_id in [0]:
             if args.test_action:
                 win_dic['Obs'] = viz.images(
-                    self.obs[0],
+                    utils.to_host(self.obs[0]),
                     win=win_dic['Obs'],
                     opts=dict(title='obs')
                 )
 
-        self.masks = torch.FloatTensor([[0.0] if done_ else [1.0] for done_ in self.done]).cuda()
-
-        if self.hierarchy_id in [(args.num_hierarchy-1)]:
-            '''top hierarchy layer is responsible for reseting env if all env has done'''
+        '''self.done stays on host for the logic below,
+        it comes to device as masks only at the bottom env boundary, upper layers reuse these masks'''
+        if self.hierarchy_id in [0]:
+            self.masks_of_done = utils.to_device(1.0-self.done.astype(np.float32), args.device).unsqueeze(1)
+            self.num_sleeping_steps += int((self.done & self.done_at_last_step).sum())
+            self.done_at_last_step = self.done.copy()
+        else:
+            self.masks_of_done = self.envs.masks_in_macro
+        self.masks = self.masks_of_done
+        self.done_in_macro |= self.done
+        self.masks_in_macro.mul_(self.masks_of_done)
+
+        if (self.hierarchy_id in [(args.num_hierarchy-1)]) and (not args.auto_reset):
+            '''top hierarchy layer is responsible for reseting env if all env has done,
+            with args.auto_reset, each env is reset by AutoResetAfterDone in envs.py as soon as it is done'''
             if args.test_action:
-                if self.masks[0] == 0.0:
+                if self.done[0]:
                     self.obs = self.reset()
             else:
-                if self.masks.sum() == 0.0:
+                if self.done.all():
                     self.obs = self.reset()
 
         if self.hierarchy_id in [0]:
             '''only when hierarchy_id is 0, the envs is returning reward_raw from the basic game emulator'''
-            self.reward_raw = torch.from_numpy(self.reward_raw_OR_reward).float()
+            self.reward_raw = utils.to_device(self.reward_raw_OR_reward, args.device)
             if args.env_name in ['OverCooked','MineCraft','GridWorld','Explore2D'] or ('NoFrameskip-v4' in args.env_name):
                 self.reward = self.reward_raw.sign()
             elif ('Bullet' in args.env_name) or (args.env_name in ['Explore2DContinuous']):
@@ -832,7 +1036,7 @@ class HierarchyLayer(object):
 
         self.log_for_specify_action()
 
-        env_0_sleeping = self.envs.get_sleeping(env_index=0)
+        env_0_sleeping = self.get_sleeping(env_index=0)
         if env_0_sleeping in [False]:
             self.step_summarize_from_env_0()
         elif env_0_sleeping in [True]:
@@ -841,18 +1045,15 @@ class HierarchyLayer(object):
             raise NotImplementedError
 
         '''If done then clean the history of observations'''
-        if self.current_obs.dim() == 4:
-            self.current_obs *= self.masks.unsqueeze(2).unsqueeze(2)
-        else:
-            self.current_obs *= self.masks
+        self.frame_stack.clear(self.masks)
 
-        self.update_current_obs(self.obs)
+        self.frame_stack.push(self.obs, slot=self.obs_slot)
 
         if self.hierarchy_id not in [0]:
             self.rollouts.reward_bounty_raw[self.rollouts.step].copy_(self.reward_bounty_raw_returned.unsqueeze(1))
 
         self.rollouts.insert(
-            self.current_obs,
+            self.frame_stack,
             self.states,
             self.action,
             self.action_log_prob,
@@ -861,6 +1062,54 @@ class HierarchyLayer(object):
             self.masks,
         )
 
+    def act(self, inputs, states, masks, input_actions, observation_ids):
+        '''sample actions with actor_critic, or with acting_policy if there is one'''
+        with torch.no_grad():
+            if self.acting_policy is None:
+                return self.actor_critic.act(
+                    inputs = inputs,
+                    states = states,
+                    masks = masks,
+                    deterministic = self.deterministic,
+                    input_action = input_actions,
+                    observation_ids = observation_ids,
+                )
+            else:
+                return self.acting_policy(
+                    inputs,
+                    states,
+                    masks,
+                    input_actions.argmax(dim=1),
+                    self.not_stochastic if self.deterministic else self.stochastic,
+                )
+
+    def act_and_step_in_groups(self):
+        '''act on self.env_groups in turn, actions of a group are sent to its workers as soon as they are sampled,
+        so that the group simulates while the next group is acted on, instead of all workers waiting for Policy.act.
+        Results of all groups are returned together, so that rewards, bounty and rollouts are processed
+        for all envs at once, as in the synchronous loop'''
+        inputs = self.rollouts.get_observations(self.step_i)
+        states = self.rollouts.states[self.step_i]
+        masks = self.rollouts.get_masks(self.step_i)
+        input_actions = self.rollouts.get_input_actions(self.step_i)
+        observation_ids = self.rollouts.get_observation_ids(self.step_i)
+        acted = []
+        actions_to_step = []
+        for group, index in enumerate(self.env_groups):
+            acted += [self.act(
+                inputs = inputs[index],
+                states = states[index],
+                masks = masks[index],
+                input_actions = input_actions[index],
+                observation_ids = None if observation_ids is None else observation_ids[index],
+            )]
+            actions_to_step += [utils.to_host(acted[-1][1].squeeze(1))]
+            self.envs.step_async_group(group, actions_to_step[-1])
+        self.value, self.action, self.action_log_prob, self.states = [torch.cat(x, dim=0) for x in zip(*acted)]
+        '''actions of the groups are already on host, as generate_actions_to_step() would bring them for the bottom layer'''
+        self.actions_to_step = np.concatenate(actions_to_step, axis=0)
+        return self.envs.step_wait()
+
     def refresh_update_type(self):
         if args.reward_bounty > 0.0:
 
@@ -900,34 +1149,57 @@ class HierarchyLayer(object):
         '''update the self.actor_critic with self.agent,
         according to the experiences stored in self.rollouts'''
 
+        '''time this layer does not act, since it is updating or waiting for the learner'''
+        update_start = time.time()
+
         '''prepare rollouts for updating actor_critic'''
-        if self.update_type in ['actor_critic','both']:
+        if self.inference_only or (self.learner is not None):
+            pass
+        elif self.update_type in ['actor_critic','both']:
             with torch.no_grad():
                 self.next_value = self.actor_critic.get_value(
-                    inputs=self.rollouts.observations[-1],
+                    inputs=self.rollouts.get_observations(-1),
                     states=self.rollouts.states[-1],
-                    masks=self.rollouts.masks[-1],
-                    input_action=self.rollouts.input_actions[-1],
+                    masks=self.rollouts.get_masks(-1),
+                    input_action=self.rollouts.get_input_actions(-1),
                 ).detach()
             self.rollouts.compute_returns(self.next_value, args.use_gae, args.gamma, args.tau)
 
         '''update, either actor_critic or transition_model'''
         epoch_loss = {}
-        epoch_loss.update(
-            self.agent.update(self.update_type)
-        )
-        if self.args.inverse_mask and (self.hierarchy_id in [0]):
+        if self.inference_only:
+            pass
+        elif self.learner is None:
+            epoch_loss.update(
+                self.agent.update(self.update_type)
+            )
+        if self.args.inverse_mask and (self.hierarchy_id in [0]) and (not self.inference_only):
+            '''inverse_mask_model is used for acting by all layers, it is trained in place, before rollouts are swapped out'''
             epoch_loss.update(
                 update_inverse_mask_model(
                     bottom_layer=self,
                 )
             )
+        if self.learner is not None:
+            '''self.rollouts is swapped, losses are from the last update finished by the learner'''
+            self.submit_to_learner()
+            epoch_loss.update(self.learner_epoch_loss)
+        self.actor_idle_time = time.time()-update_start
 
         self.num_trained_frames += (args.num_steps[self.hierarchy_id]*args.num_processes)
         self.update_i += 1
 
-        '''prepare rollouts for new round of interaction'''
-        self.rollouts.after_update()
+        if self.hierarchy_id in [0]:
+            '''synchronous host<->device transfers made by all layers, per step of the bottom env'''
+            self.host_device_transfers_per_step = float(utils.num_host_device_transfers-self.num_host_device_transfers_at_last_update)/args.num_steps[self.hierarchy_id]
+            self.num_host_device_transfers_at_last_update = utils.num_host_device_transfers
+            '''fraction of env steps wasted on sleeping envs, effective FPS is FPS*(1-sleeping_steps_fraction)'''
+            self.sleeping_steps_fraction = float(self.num_sleeping_steps)/(args.num_steps[self.hierarchy_id]*args.num_processes)
+            self.num_sleeping_steps = 0
+
+        '''prepare rollouts for new round of interaction, with the learner, they are started in submit_to_learner'''
+        if self.learner is None:
+            self.rollouts.after_update()
 
         if (self.args.env_name in ['Explore2D']) and (self.hierarchy_id in [0]):
 
@@ -950,19 +1222,7 @@ class HierarchyLayer(object):
 
         '''save checkpoint'''
         if (self.update_i % args.save_interval == 0 and args.save_dir != "") or (self.update_i in [1,2]):
-            try:
-                np.save(
-                    args.save_dir+'/hierarchy_{}_num_trained_frames.npy'.format(self.hierarchy_id),
-                    np.array([self.num_trained_frames]),
-                )
-                self.actor_critic.save_model(args.save_dir+'/hierarchy_{}_actor_critic.pth'.format(self.hierarchy_id))
-                if self.transition_model is not None:
-                    self.transition_model.save_model(args.save_dir+'/hierarchy_{}_transition_model.pth'.format(self.hierarchy_id))
-                if self.args.inverse_mask and (self.hierarchy_id in [0]):
-                    inverse_mask_model   .save_model(args.save_dir+'/inverse_mask_model.pth')
-                print("[H-{:1}] Save checkpoint successed.".format(self.hierarchy_id))
-            except Exception as e:
-                print("[H-{:1}] Save checkpoint failed, due to {}.".format(self.hierarchy_id,e))
+            self.save_checkpoint()
 
         '''print info'''
         if self.update_i % args.log_interval == 0:
@@ -985,6 +1245,20 @@ class HierarchyLayer(object):
                 print_string += ', remaining {:4.1f} hours'.format(
                     (self.end - self.start)/(self.num_trained_frames-self.num_trained_frames_at_start)*(args.num_frames-self.num_trained_frames)/60.0/60.0,
                 )
+                print_string += ', host_device_transfers_per_step {:4.1f}'.format(
+                    self.host_device_transfers_per_step,
+                )
+                print_string += ', sleeping_steps_fraction {:.3f}'.format(
+                    self.sleeping_steps_fraction,
+                )
+            print_string += ', actor_idle_time {:.3f}s'.format(
+                self.actor_idle_time,
+            )
+            for metric_name, metric in self.observation_metrics().items():
+                print_string += ', {} {:.3f}'.format(
+                    metric_name,
+                    metric,
+                )
             if self.args.summarize_behavior:
                 print_string += ', summarize_behavior {}'.format(
                     self.summarize_behavior,
@@ -1024,6 +1298,36 @@ class HierarchyLayer(object):
                                 simple_value = leg_count[index_leg],
                             )
 
+            if self.hierarchy_id in [0]:
+                self.summary.value.add(
+                    tag = 'hierarchy_{}/host_device_transfers_per_step'.format(
+                        self.hierarchy_id,
+                    ),
+                    simple_value = self.host_device_transfers_per_step,
+                )
+                self.summary.value.add(
+                    tag = 'hierarchy_{}/sleeping_steps_fraction'.format(
+                        self.hierarchy_id,
+                    ),
+                    simple_value = self.sleeping_steps_fraction,
+                )
+
+            self.summary.value.add(
+                tag = 'hierarchy_{}/actor_idle_time'.format(
+                    self.hierarchy_id,
+                ),
+                simple_value = self.actor_idle_time,
+            )
+
+            for metric_name, metric in self.observation_metrics().items():
+                self.summary.value.add(
+                    tag = 'hierarchy_{}/{}'.format(
+                        self.hierarchy_id,
+                        metric_name,
+                    ),
+                    simple_value = metric,
+                )
+
             for episode_reward_type in self.episode_reward.keys():
                 self.summary.value.add(
                     tag = 'hierarchy_{}/final_reward_{}'.format(
@@ -1055,27 +1359,77 @@ class HierarchyLayer(object):
             if self.num_trained_frames > args.num_frames:
                 raise Exception('Done')
 
+    def save_checkpoint(self):
+        try:
+            np.save(
+                args.save_dir+'/hierarchy_{}_num_trained_frames.npy'.format(self.hierarchy_id),
+                np.array([self.num_trained_frames]),
+            )
+            if not self.inference_only:
+                self.actor_critic.save_model(args.save_dir+'/hierarchy_{}_actor_critic.pth'.format(self.hierarchy_id))
+            if (self.transition_model is not None) and (not self.transition_model_inference_only):
+                self.transition_model.save_model(args.save_dir+'/hierarchy_{}_transition_model.pth'.format(self.hierarchy_id))
+            if self.args.inverse_mask and (self.hierarchy_id in [0]):
+                inverse_mask_model   .save_model(args.save_dir+'/inverse_mask_model.pth')
+            print("[H-{:1}] Save checkpoint successed.".format(self.hierarchy_id))
+        except Exception as e:
+            print("[H-{:1}] Save checkpoint failed, due to {}.".format(self.hierarchy_id,e))
+
+    def close(self):
+        '''with args.async_learner, finish the updates in flight and save the models acting with all of them,
+        the learner thread is joined, so that the process exits normally'''
+        if self.learner is not None:
+            self.learner.close()
+            self.save_checkpoint()
+
     def reset(self):
         '''as a environment, it has reset method'''
         self.obs = self.envs.reset()
+        self.done_at_last_step[:] = False
+        self.refresh_sleeping()
         if self.hierarchy_id in [0]:
+            self.obs_to_device()
             if args.test_action:
                 win_dic['Obs'] = viz.images(
-                    self.obs[0],
+                    utils.to_host(self.obs[0]),
                     win=win_dic['Obs'],
                     opts=dict(title='obs')
                 )
-        self.update_current_obs(self.obs)
-        self.rollouts.observations[0].copy_(self.current_obs)
+        self.refresh_obs_slot()
+        self.frame_stack.push(self.obs, slot=self.obs_slot)
+        self.rollouts.set_observations(0, self.frame_stack)
         return self.obs
 
-    def update_current_obs(self, obs):
-        '''update self.current_obs, which contains args.num_stack frames, with obs, which is current frame'''
-        shape_dim0 = self.envs.observation_space.shape[0]
-        obs = torch.from_numpy(obs).float()
-        if args.num_stack > 1:
-            self.current_obs[:, :-shape_dim0] = self.current_obs[:, shape_dim0:]
-        self.current_obs[:, -shape_dim0:] = obs
+    def obs_to_device(self):
+        '''bottom env boundary, obs comes to device here and is passed between layers on device'''
+        if isinstance(self.observation_store, ObservationTable):
+            '''obs is interned on host, only frames not seen before come to device'''
+            self.obs_slot = self.observation_store.intern(self.obs)
+            self.obs = self.observation_store.frames_of(self.obs_slot, out=self.obs_on_device)
+        else:
+            self.obs = utils.to_device(self.obs, args.device, out=self.obs_on_device)
+
+    def observation_metrics(self):
+        '''size of the observation table and hit rates of memos, if they are used'''
+        metrics = {}
+        if (self.hierarchy_id in [0]) and isinstance(self.observation_store, ObservationTable):
+            metrics['interned_observations'] = self.observation_store.num_frames-1
+        if self.actor_critic.feature_memo is not None:
+            metrics['feature_memo_hit_rate'] = self.actor_critic.feature_memo.hit_rate()
+        if (self.transition_model is not None) and (self.transition_model.prediction_memo is not None):
+            metrics['prediction_memo_hit_rate'] = self.transition_model.prediction_memo.hit_rate()
+        return metrics
+
+    def refresh_obs_slot(self):
+        '''slot of self.obs in the shared observation store,
+        the bottom layer adds obs to the store, upper layers reuse the slot, since they get the same obs'''
+        if self.observation_store is None:
+            self.obs_slot = None
+        elif self.hierarchy_id in [0]:
+            if not isinstance(self.observation_store, ObservationTable):
+                self.obs_slot = self.observation_store.add(self.obs)
+        else:
+            self.obs_slot = self.envs.obs_slot
 
     def step_summarize_from_env_0(self):
 
@@ -1087,14 +1441,18 @@ class HierarchyLayer(object):
         if self.summarize_behavior:
             self.summarize_behavior_at_step()
 
-        '''summarize reward'''
-        self.episode_reward['norm'] += self.reward[0].item()
-        self.episode_reward['bounty'] += self.reward_bounty[0].item()
-        self.episode_reward['bounty_clip'] += self.bounty_clip[0].item()
-        self.episode_reward['final'] += self.reward_final[0].item()
+        '''summarize reward, fetch all of them from device in one transfer'''
+        reward_at_step = [self.reward[0], self.reward_bounty[0], self.bounty_clip[0], self.reward_final[0]]
+        if self.hierarchy_id in [0]:
+            reward_at_step += [self.reward_raw[0]]
+        reward_at_step = utils.to_host(torch.stack(reward_at_step).float())
+        self.episode_reward['norm'] += float(reward_at_step[0])
+        self.episode_reward['bounty'] += float(reward_at_step[1])
+        self.episode_reward['bounty_clip'] += float(reward_at_step[2])
+        self.episode_reward['final'] += float(reward_at_step[3])
         if self.hierarchy_id in [0]:
             '''for hierarchy_id=0, summarize reward_raw'''
-            self.episode_reward['raw'] += self.reward_raw[0].item()
+            self.episode_reward['raw'] += float(reward_at_step[4])
 
         self.episode_reward['len'] += 1
 
@@ -1115,13 +1473,17 @@ class HierarchyLayer(object):
                 self.summarize_behavior = False
 
             if (self.args.env_name in ['Explore2D']) and (self.hierarchy_id in [0]):
-                self.terminal_states += [self.obs[0,0,0:1]]
+                if args.auto_reset:
+                    '''self.obs is from the new episode'''
+                    self.terminal_states += [self.info[0]['terminal_observation'][0,0:1].astype(np.float64)]
+                else:
+                    self.terminal_states += [utils.to_host(self.obs[0,0,0:1]).astype(np.float64)]
 
     def summarize_behavior_at_step(self):
 
         '''summarize observation'''
         if args.summarize_observation:
-            state_img = obs_to_state_img(self.obs[0])
+            state_img = obs_to_state_img(utils.to_host(self.obs[0]).astype(self.observation_space.dtype))
             try:
                 self.episode_visilize_stack['observation'] += [state_img]
                 '''
@@ -1142,15 +1504,16 @@ class HierarchyLayer(object):
 
         '''Summery state_prediction'''
         if args.summarize_state_prediction:
-            if self.predicted_next_observations_to_downer_layer is not None:
-                img = obs_to_state_img(self.observation_predicted_from_to_downer_layer[0].cpu().numpy())
+            if (self.hierarchy_id not in [0]) and (args.reward_bounty > 0.0) and (not args.mutual_information):
+                self.predict_to_downer_layer()
+                img = obs_to_state_img(utils.to_host(self.observation_predicted_from_to_downer_layer[0]))
                 for action_i in range(self.envs.action_space.n):
                     if state_type in ['standard_image']:
                         temp = ((self.predicted_next_observations_to_downer_layer[action_i,0]+255.0)/2.0)
                     elif state_type in ['vector']:
                         temp = self.observation_predicted_from_to_downer_layer[0] + self.predicted_next_observations_to_downer_layer[action_i,0]
                     temp = obs_to_state_img(
-                        temp.cpu().numpy(),
+                        utils.to_host(temp),
                         marker = "+",
                         c = 'green',
                     )
@@ -1168,7 +1531,7 @@ class HierarchyLayer(object):
                             (
                                 img,
                                 obs_to_state_img(
-                                    (binarize_mask_torch(inverse_model_mask)*255.0).cpu().numpy()
+                                    utils.to_host(binarize_mask_torch(inverse_model_mask)*255.0)
                                 )
                             ),
                             1,
@@ -1275,7 +1638,11 @@ class HierarchyLayer(object):
             raise SystemExit
 
     def get_sleeping(self, env_index):
-        return self.envs.get_sleeping(env_index)
+        '''sleeping flags are cached at each step and reset, so that they are not queried down the hierarchy'''
+        return self.sleeping[env_index]
+
+    def refresh_sleeping(self):
+        self.sleeping = [self.envs.get_sleeping(env_index) for env_index in range(args.num_processes)]
 
 def main():
 
@@ -1295,19 +1662,22 @@ def main():
 
     hierarchy_layer[-1].reset()
 
-    while True:
-
-        '''as long as the top hierarchy layer is stepping forward,
-        the downer layers is controlled and kept running.
-        Note that the top hierarchy does no have to call step,
-        calling one_step is enough'''
-        hierarchy_layer[-1].predicted_next_observations_by_upper_layer = None
-        hierarchy_layer[-1].mask_of_predicted_observation_by_upper_layer = None
-        hierarchy_layer[-1].observation_predicted_from_by_upper_layer = None
-        hierarchy_layer[-1].predicted_reward_bounty_by_upper_layer = None
-        hierarchy_layer[-1].is_final_step_by_upper_layer = False
-        hierarchy_layer[-1].is_extend_step = False
-        hierarchy_layer[-1].one_step()
+    try:
+        while True:
+
+            '''as long as the top hierarchy layer is stepping forward,
+            the downer layers is controlled and kept running.
+            Note that the top hierarchy does no have to call step,
+            calling one_step is enough'''
+            hierarchy_layer[-1].predict_by_upper_layer = None
+            hierarchy_layer[-1].is_final_step_by_upper_layer = False
+            hierarchy_layer[-1].is_extend_step = False
+            hierarchy_layer[-1].one_step()
+
+    finally:
+        '''training ends by raising Exception('Done') when num_frames is reached'''
+        for layer in hierarchy_layer:
+            layer.close()
 
 if __name__ == "__main__":
     main()
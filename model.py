@@ -1,8 +1,10 @@
+import math
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from distributions import Categorical, DiagGaussian
-from utils import init, init_normc_
+from utils import init, init_normc_, MultiLinear
 import numpy as np
 from arguments import get_args
 args = get_args()
@@ -65,41 +67,44 @@ class Policy(nn.Module):
 
         '''build critic model'''
         if self.num_subpolicy > 1:
-            self.critic_linear = []
-            for linear_i in range(self.num_subpolicy):
-                self.critic_linear += [self.base.linear_init_(nn.Linear(self.base.linear_size, 1))]
-            self.critic_linear = nn.ModuleList(self.critic_linear)
+            self.critic_linear = MultiLinear(
+                [self.base.linear_init_(nn.Linear(self.base.linear_size, 1)) for linear_i in range(self.num_subpolicy)]
+            )
         else:
             self.critic_linear = self.base.linear_init_(nn.Linear(self.base.linear_size, 1))
 
         self.input_action_space = input_action_space
 
+        '''LRUMemo of base features per observation id and version, set by HierarchyLayer,
+        version is increased by the agent on every update'''
+        self.feature_memo = None
+        self.version = 0
+
     def forward(self, inputs, states, input_action, masks):
         raise NotImplementedError
 
-    def get_final_features(self, inputs, states, masks, input_action=None):
-        base_features, states = self.base(inputs, states, masks)
-        return base_features, states
+    def get_final_features(self, inputs, states, masks, input_action=None, observation_ids=None):
+        if (self.feature_memo is None) or (observation_ids is None):
+            base_features, states = self.base(inputs, states, masks)
+            return base_features, states
+
+        '''only the observations missed by feature_memo are encoded, this is for feed-forward StateEncoder'''
+        def compute(index):
+            base_features, _ = self.base(inputs.index_select(0,index), states.index_select(0,index), masks.index_select(0,index))
+            return base_features['actor'], base_features['critic']
+        actor, critic = self.feature_memo.memoize_batch(
+            keys = [(self.version, observation_id) for observation_id in observation_ids],
+            compute = compute,
+        )
+        return {'actor': actor, 'critic': critic}, states
 
     def get_value_dist(self, base_features, input_action):
 
         if self.num_subpolicy > 1:
 
             '''value forward'''
-            index_dic = {}
-            tensor_dic = {}
-            y_dic = {}
-            action_index = np.where(input_action.cpu()==1)[1]
-            for dic_i in range(self.num_subpolicy):
-                index_dic[str(dic_i)] = torch.from_numpy(np.where(action_index==dic_i)[0]).long().cuda()
-                if index_dic[str(dic_i)].size()[0] != 0:
-                    tensor_dic[str(dic_i)] = torch.index_select(base_features['critic'],0,index_dic[str(dic_i)])
-                    y_dic[str(dic_i)] = self.critic_linear[dic_i](tensor_dic[str(dic_i)])
-
-            value = torch.zeros((input_action.size()[0],1)).cuda()
-            for y_i in range(self.num_subpolicy):
-                if str(y_i) in y_dic:
-                    value.index_add_(0,index_dic[str(y_i)],y_dic[str(y_i)])
+            action_index = input_action.argmax(dim=1)
+            value = self.critic_linear(base_features['critic'], action_index)
 
             '''dist forward'''
             dist, dist_features = self.dist(base_features['actor'],action_index)
@@ -112,8 +117,8 @@ class Policy(nn.Module):
 
         return value, dist, dist_features
 
-    def act(self, inputs, states, masks, deterministic=False, input_action=None):
-        base_features, states = self.get_final_features(inputs, states, masks, input_action)
+    def act(self, inputs, states, masks, deterministic=False, input_action=None, observation_ids=None):
+        base_features, states = self.get_final_features(inputs, states, masks, input_action, observation_ids)
 
         value, dist, dist_features = self.get_value_dist(base_features, input_action)
 
@@ -143,6 +148,61 @@ class Policy(nn.Module):
     def save_model(self, save_path):
         torch.save(self.state_dict(), save_path)
 
+class ActingPolicy(nn.Module):
+    '''the acting path of Policy.act written with plain tensor ops, so that it can be traced by
+    torch.jit.trace or exported to ONNX. The index of subpolicy is an input, instead of the onehot,
+    stochastic is a [1] tensor, 1.0 to sample actions and 0.0 to take the mode.
+    Parameters are shared with the wrapped Policy.'''
+    def __init__(self, actor_critic):
+        super(ActingPolicy, self).__init__()
+        self.actor_critic = actor_critic
+
+    def head(self, linear, x, input_action_index):
+        if self.actor_critic.num_subpolicy > 1:
+            return linear(x, input_action_index)
+        else:
+            return linear(x)
+
+    def forward(self, inputs, states, masks, input_action_index, stochastic):
+        base_features, states = self.actor_critic.base(inputs, states, masks)
+
+        value = self.head(self.actor_critic.critic_linear, base_features['critic'], input_action_index)
+
+        dist = self.actor_critic.dist
+        if dist.__class__.__name__ in ['Categorical']:
+            '''sample with gumbel-max, which is the mode when stochastic is 0.0'''
+            log_probs = F.log_softmax(self.head(dist.linear, base_features['actor'], input_action_index), dim=1)
+            gumbel = -(-torch.rand_like(log_probs).clamp(min=1e-20).log()).log()
+            action = (log_probs+gumbel*stochastic).argmax(dim=1, keepdim=True)
+            action_log_probs = log_probs.gather(1, action)
+        elif dist.__class__.__name__ in ['DiagGaussian']:
+            action_mean = self.head(dist.fc_mean, base_features['actor'], input_action_index)
+            action_logstd = self.head(dist.logstd, torch.zeros_like(action_mean), input_action_index)
+            action = action_mean + torch.randn_like(action_mean)*action_logstd.exp()*stochastic
+            action_log_probs = (
+                -((action-action_mean)**2)/(2.0*(2.0*action_logstd).exp()) - action_logstd - math.log(math.sqrt(2.0*math.pi))
+            ).sum(-1, keepdim=True)
+        else:
+            raise NotImplemented
+
+        return value, action, action_log_probs, states
+
+def trace_acting_policy(actor_critic, obs_shape, num_processes, device):
+    '''trace the ActingPolicy of actor_critic with example inputs of num_processes,
+    the traced module shares parameters with actor_critic, so it follows the updates of actor_critic'''
+    example_inputs = (
+        torch.zeros(num_processes, *obs_shape, device=device),
+        torch.zeros(num_processes, actor_critic.state_size, device=device),
+        torch.ones(num_processes, 1, device=device),
+        torch.zeros(num_processes, dtype=torch.long, device=device),
+        torch.ones(1, device=device),
+    )
+    return torch.jit.trace(
+        ActingPolicy(actor_critic),
+        example_inputs,
+        check_trace = False,
+    ), example_inputs
+
 class StateEncoder(nn.Module):
 
     def __init__(self, use_gru, obs_shape, state_type, linear_size=256):
@@ -289,59 +349,39 @@ class InverseMaskModel(nn.Module):
         )
 
     def get_alpha(self, states):
-        alpha_bar = []
-        for i in range(self.num_grid):
-            for j in range(self.num_grid):
-                alpha_bar += [self.mlp_alpha(
-                    flatten(
-                        self.slice_grid(
-                            states=states,
-                            i=i,
-                            j=j,
-                        )
-                    )
-                )]
-        alpha = F.softmax(torch.cat(alpha_bar, 1), dim=1)
+        '''run mlp_alpha on all grids in one batch, return softmax over grids [batch, num_grid**2]'''
+        alpha_bar = self.mlp_alpha(
+            self.unfold_grid(states).reshape(-1,self.mlp_alpha[0].in_features)
+        ).view(states.size()[0],-1)
+        alpha = F.softmax(alpha_bar, dim=1)
         return alpha
 
+    def unfold_grid(self, states):
+        '''extract all grids of states [batch, C, H, W] as [batch, num_grid**2, C*size_grid**2],
+        grids are ordered row by row and each grid is flattened as slice_grid(...).view(batch,-1),
+        so that weights trained with the per-grid loop stay valid'''
+        size = self.num_grid*self.size_grid
+        return F.unfold(
+            states[:,:,:size,:size],
+            kernel_size = self.size_grid,
+            stride = self.size_grid,
+        ).transpose(1,2)
+
     def slice_grid(self, states, i, j):
         return states [:,:,i*self.size_grid:(i+1)*self.size_grid,j*self.size_grid:(j+1)*self.size_grid]
 
     def get_e(self, conved_last_states, conved_now_states):
-        e = []
-        for i in range(self.num_grid):
-            for j in range(self.num_grid):
-                e += [
-                    torch.unsqueeze(
-                        self.mlp_e(
-                            torch.cat(
-                                [
-                                    flatten(
-                                        self.slice_grid(
-                                            states=conved_now_states,
-                                            i=i,
-                                            j=j,
-                                        ) - self.slice_grid(
-                                            states=conved_last_states,
-                                            i=i,
-                                            j=j,
-                                        )
-                                    ),
-                                    flatten(
-                                        self.slice_grid(
-                                            states=conved_now_states,
-                                            i=i,
-                                            j=j,
-                                        )
-                                    )
-                                ],
-                                dim = 1,
-                            )
-                        ),
-                        dim = 1,
-                    )
-                ]
-        e = torch.cat(e, dim=1)
+        '''run mlp_e on all grids in one batch, return [batch, num_grid**2, predicted_action_space]'''
+        grid_now_states = self.unfold_grid(conved_now_states)
+        e = self.mlp_e(
+            torch.cat(
+                [
+                    grid_now_states - self.unfold_grid(conved_last_states),
+                    grid_now_states,
+                ],
+                dim = 2,
+            ).view(-1,self.mlp_e[0].in_features)
+        ).view(conved_now_states.size()[0],-1,self.predicted_action_space)
         return e
 
     def get_predicted_action_log_probs(self, e, alpha):
@@ -380,9 +420,8 @@ class InverseMaskModel(nn.Module):
         return predicted_action_log_probs, loss_ent, predicted_action_log_probs_each
 
     def alpha_to_mask(self, alpha):
-        alpha = alpha.unsqueeze(2).expand(-1,-1,self.size_grid)
-        alpha = alpha.contiguous().view(alpha.size()[0], self.num_grid, -1)
-        alpha = torch.cat([alpha]*self.size_grid,dim=2).view(alpha.size()[0],self.size_grid*self.num_grid,self.size_grid*self.num_grid)
+        alpha = alpha.view(alpha.size()[0], self.num_grid, self.num_grid)
+        alpha = alpha.repeat_interleave(self.size_grid, dim=1).repeat_interleave(self.size_grid, dim=2)
         '''alpha is kept to be softmax'''
         return alpha
 
@@ -522,7 +561,12 @@ class TransitionModel(nn.Module):
                 self.linear_init_(nn.Linear(self.linear_size, num_subpolicy)),
             )
 
-    def forward(self, inputs, input_action=None):
+        '''LRUMemo of predict_each_action per observation id and version, set by HierarchyLayer,
+        version is increased by the agent on every update'''
+        self.prediction_memo = None
+        self.version = 0
+
+    def encode(self, inputs):
         if self.state_type in ['standard_image']:
             conved = self.conv(
                 inputs/255.0,
@@ -531,6 +575,22 @@ class TransitionModel(nn.Module):
             conved = self.conv(
                 inputs.view(inputs.size()[0],-1),
             )
+        return conved
+
+    def decode(self, before_deconv):
+        if self.state_type in ['standard_image']:
+
+            predicted_state = self.deconv(before_deconv)*255.0
+
+        elif self.state_type in ['vector']:
+
+            predicted_state = self.deconv(before_deconv)
+            predicted_state = predicted_state.view(predicted_state.size()[0],*self.output_observation_shape)
+
+        return predicted_state
+
+    def forward(self, inputs, input_action=None):
+        conved = self.encode(inputs)
 
         before_deconv = conved*self.input_action_linear(input_action)
 
@@ -543,14 +603,7 @@ class TransitionModel(nn.Module):
 
         if not self.mutual_information:
 
-            if self.state_type in ['standard_image']:
-
-                predicted_state = self.deconv(before_deconv)*255.0
-
-            elif self.state_type in ['vector']:
-
-                predicted_state = self.deconv(before_deconv)
-                predicted_state = predicted_state.view(predicted_state.size()[0],*self.output_observation_shape)
+            predicted_state = self.decode(before_deconv)
 
             return predicted_state, predicted_reward_bounty
 
@@ -560,5 +613,40 @@ class TransitionModel(nn.Module):
 
             return predicted_action_resulted_from, predicted_reward_bounty
 
+    def predict_each_action(self, inputs, input_action, observation_ids=None):
+        '''for inference, encode inputs [num_processes, ...] only once, then broadcast
+        the embedding of each action in input_action [num_actions, input_action_space.n] against it,
+        return predicted_state [num_actions, num_processes, ...] and predicted_reward_bounty [num_actions, num_processes, 1].
+        If observation_ids is given, predictions are memoized by prediction_memo, input_action should be the same for all calls'''
+        if (self.prediction_memo is not None) and (observation_ids is not None):
+            predicted_state, predicted_reward_bounty = self.prediction_memo.memoize_batch(
+                keys = [(self.version, observation_id) for observation_id in observation_ids],
+                compute = lambda index: [
+                    x.transpose(0,1) for x in self.predict_each_action(inputs.index_select(0,index), input_action)
+                ],
+            )
+            return predicted_state.transpose(0,1).contiguous(), predicted_reward_bounty.transpose(0,1).contiguous()
+
+        conved = self.encode(inputs)
+        num_actions, num_processes = input_action.size()[0], conved.size()[0]
+
+        before_deconv = (
+            self.input_action_linear(input_action).unsqueeze(1)*conved.unsqueeze(0)
+        ).view(num_actions*num_processes,-1)
+
+        if args.clip_reward_bounty_over_subpolicy in ['each']:
+            predicted_reward_bounty = self.reward_bounty_linear(before_deconv)
+        elif args.clip_reward_bounty_over_subpolicy in ['all']:
+            predicted_reward_bounty = self.reward_bounty_linear(conved).repeat(num_actions,1)
+        else:
+            raise NotImplemented
+
+        predicted_state = self.decode(before_deconv)
+
+        return (
+            predicted_state.view(num_actions,num_processes,*predicted_state.size()[1:]),
+            predicted_reward_bounty.view(num_actions,num_processes,1),
+        )
+
     def save_model(self, save_path):
         torch.save(self.state_dict(), save_path)
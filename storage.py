@@ -1,13 +1,365 @@
+import numpy as np
 import torch
+import utils
 from torch.utils.data.sampler import BatchSampler, SubsetRandomSampler
 
 
+def discounted_reverse_scan(values, discounts, last, block_size=16):
+    '''compute x[t] = values[t] + discounts[t] * x[t+1] for all t, with x[T] = last,
+    values and discounts are [T, ...], last is [...].
+    Steps are split into blocks of block_size. Within a block,
+    x[t] = sum_k prod(discounts[t:k]) * values[k] + prod(discounts[t:]) * x[end of block],
+    the products are taken by cumprod over an upper triangular matrix, for all blocks at once,
+    so that zero discounts at episode boundaries need no special treatment.
+    Only x[end of block] is then carried from block to block in a loop over blocks'''
+    num_steps = values.size()[0]
+    block_size = min(block_size, num_steps)
+    num_blocks = (num_steps+block_size-1)//block_size
+    num_pad = num_blocks*block_size-num_steps
+
+    '''pad at the front, so that the padded steps do not affect the real ones'''
+    values = torch.cat([torch.zeros_like(values[:1]).expand(num_pad,*values.size()[1:]), values], 0)
+    discounts = torch.cat([torch.ones_like(discounts[:1]).expand(num_pad,*discounts.size()[1:]), discounts], 0)
+
+    '''[num_blocks, ..., block_size]'''
+    to_blocks = lambda x: x.view(num_blocks, block_size, *x.size()[1:]).permute(0, *range(2,x.dim()+1), 1)
+    values = to_blocks(values)
+    discounts = to_blocks(discounts)
+
+    '''upper[t,k] = (k>=t)'''
+    upper = torch.ones(block_size, block_size, device=values.device).triu()
+    '''inclusive[..., t, k] = prod(discounts[t:k+1]) for k>=t'''
+    inclusive = (
+        discounts.unsqueeze(-2)*upper + (1.0-upper)
+    ).cumprod(dim=-1)
+    '''exclusive[..., t, k] = prod(discounts[t:k]) for k>=t, 0 otherwise'''
+    exclusive = torch.cat(
+        [torch.ones_like(inclusive[...,:1]), inclusive[...,:-1]],
+        dim = -1,
+    )*upper
+    x = (exclusive*values.unsqueeze(-2)).sum(dim=-1)
+    decay = inclusive[...,-1]
+
+    '''carry x[end of block] from the last block to the first one'''
+    carries = []
+    x_next = last
+    for block_i in reversed(range(num_blocks)):
+        carries.insert(0, x_next)
+        x_next = x[block_i,...,0] + decay[block_i,...,0]*x_next
+    x = x + decay*torch.stack(carries, 0).unsqueeze(-1)
+
+    '''back to [T, ...]'''
+    x = x.permute(0, x.dim()-1, *range(1,x.dim()-1)).contiguous().view(num_blocks*block_size, *x.size()[1:-1])
+    return x[num_pad:]
+
+def gather_frames(frames, index, out=None):
+    '''gather frames [num_slots, num_processes, C, ...] by index [..., num_stack] of slot*num_processes+process,
+    into stacked observations [..., num_stack*C, ...], into out if it is given'''
+    frame_shape = frames.size()[2:]
+    if out is None:
+        out = torch.empty(
+            *index.size()[:-1], index.size()[-1]*frame_shape[0], *frame_shape[1:],
+            dtype = frames.dtype,
+            device = frames.device,
+        )
+    '''index_select rows of whole frames'''
+    torch.index_select(
+        frames.view(frames.size()[0]*frames.size()[1], -1),
+        0,
+        index.contiguous().view(-1),
+        out = out.view(index.numel(), -1),
+    )
+    return out
+
+class ObservationStore(object):
+    '''frames [1+capacity, num_processes, ...] shared by the FrameStack and RolloutStorage of all hierarchy layers,
+    it is owned by the bottom layer. The bottom layer adds each frame once, upper layers and rollouts keep the slot of it,
+    and gather stacked observations only when they are consumed.
+    Slots are reference counted on host, a slot is freed when it is not referenced.
+    When all slots are referenced, the store grows, slots are appended so that kept slots stay valid.
+    Slot 0 is kept as zeros, it is referenced by cleared frames'''
+    def __init__(self, capacity, num_processes, frame_shape, dtype=torch.float32):
+        self.capacity = capacity
+        self.num_processes = num_processes
+        self.frames = torch.zeros(1+capacity, num_processes, *frame_shape, dtype=dtype)
+        self.zero_slot = 0
+        self.refcounts = [0]*(1+capacity)
+        self.free_slots = list(reversed(range(1, 1+capacity)))
+        self.process_index = torch.arange(num_processes)
+        '''rows of slot 0, see rows'''
+        self.zero_rows = self.process_index
+        '''slots added and not retained yet, see add'''
+        self.unretained = []
+
+    def to(self, device):
+        self.frames = self.frames.to(device)
+        self.process_index = self.process_index.to(device)
+        self.zero_rows = self.zero_rows.to(device)
+        return self
+
+    def cuda(self):
+        return self.to(torch.device('cuda'))
+
+    def memory_footprint(self):
+        return self.frames.element_size()*self.frames.numel()
+
+    def grow(self, num_slots):
+        self.frames = torch.cat([self.frames, torch.zeros_like(self.frames[:1]).repeat(num_slots,*([1]*(self.frames.dim()-1)))], 0)
+        self.refcounts += [0]*num_slots
+        self.free_slots = list(reversed(range(1+self.capacity, 1+self.capacity+num_slots))) + self.free_slots
+        self.capacity += num_slots
+
+    def add(self, frame):
+        '''copy frame [num_processes, ...] into a free slot and return the slot,
+        it should be retained by the caller before the next add, otherwise it is freed by the next add,
+        e.g., the frame of the last step of an episode is dropped when the top layer resets all envs'''
+        self.free_slots += self.unretained
+        if len(self.free_slots) == 0:
+            self.grow(max(self.capacity//4, 1))
+        slot = self.free_slots.pop()
+        self.unretained = [slot]
+        self.frames[slot].copy_(frame)
+        return slot
+
+    def retain(self, slots):
+        for slot in slots:
+            if slot != self.zero_slot:
+                self.refcounts[slot] += 1
+        if (len(self.unretained) > 0) and (self.refcounts[self.unretained[0]] > 0):
+            self.unretained = []
+
+    def release(self, slots):
+        for slot in slots:
+            if slot != self.zero_slot:
+                self.refcounts[slot] -= 1
+                if self.refcounts[slot] == 0:
+                    self.free_slots.append(slot)
+
+    def rows(self, slot):
+        '''index of the frames of all processes in slot, see gather_frames'''
+        return slot*self.num_processes+self.process_index
+
+    def gather(self, index, out=None):
+        return gather_frames(self.frames, index, out)
+
+class ObservationTable(object):
+    '''table of the distinct frames seen in a run, used in place of ObservationStore for envs
+    with few distinct observations, e.g., GridWorld and Explore2D.
+    Frames from envs are interned: a frame is looked up by its bytes, only frames not seen before are copied to the table.
+    A slot of the table is the tuple of the ids of the frames of all processes, frames are never freed.
+    Row 0 is kept as zeros, it is referenced by cleared frames'''
+    def __init__(self, capacity, num_processes, frame_shape, dtype=torch.float32):
+        self.capacity = capacity
+        self.num_processes = num_processes
+        self.frames = torch.zeros(1+capacity, *frame_shape, dtype=dtype)
+        self.num_frames = 1
+        self.ids = {}
+        self.zero_slot = (0,)*num_processes
+        self.zero_rows = torch.zeros(num_processes, dtype=torch.long)
+        '''preallocated, ids of a slot are copied into it'''
+        self.slot_rows = torch.zeros(num_processes, dtype=torch.long)
+
+    def to(self, device):
+        self.frames = self.frames.to(device)
+        self.zero_rows = self.zero_rows.to(device)
+        self.slot_rows = self.slot_rows.to(device)
+        return self
+
+    def cuda(self):
+        return self.to(torch.device('cuda'))
+
+    def memory_footprint(self):
+        return self.frames.element_size()*self.frames.numel()
+
+    def intern(self, frames):
+        '''look up frames [num_processes, ...] on host, add the ones not seen before, return the slot of them'''
+        ids = []
+        new_frames = []
+        for frame in frames:
+            key = frame.tobytes()
+            frame_id = self.ids.get(key)
+            if frame_id is None:
+                frame_id = self.num_frames+len(new_frames)
+                self.ids[key] = frame_id
+                new_frames += [frame]
+            ids += [frame_id]
+        if len(new_frames) > 0:
+            num_frames = self.num_frames+len(new_frames)
+            if num_frames > 1+self.capacity:
+                '''grow by doubling'''
+                num_slots = max(self.capacity, num_frames-1-self.capacity)
+                self.frames = torch.cat([self.frames, torch.zeros_like(self.frames[:1]).repeat(num_slots,*([1]*(self.frames.dim()-1)))], 0)
+                self.capacity += num_slots
+            '''only frames not seen before come to device'''
+            self.frames[self.num_frames:num_frames].copy_(utils.to_device(np.stack(new_frames), self.frames.device))
+            self.num_frames = num_frames
+        return tuple(ids)
+
+    def retain(self, slots):
+        pass
+
+    def release(self, slots):
+        pass
+
+    def rows(self, slot):
+        '''ids in slot, on device, it is overwritten by the next call'''
+        return utils.to_device(np.asarray(slot, dtype=np.int64), self.slot_rows.device, out=self.slot_rows)
+
+    def gather(self, index, out=None):
+        return gather_frames(self.frames.unsqueeze(1), index, out)
+
+    def frames_of(self, slot, out=None):
+        '''frames [num_processes, ...] in slot'''
+        frames = self.frames.index_select(0, self.rows(slot))
+        if out is None:
+            return frames
+        return out.copy_(frames)
+
+'''stacked observations of fewer elements [num_processes, num_stack*C, ...] than this are shifted as a whole each step,
+the ring of FrameStack only wins above it, measured by benchmark.py --benchmark frame_stack on cpu'''
+RING_MIN_STACKED_NUMEL = 2**18
+
+class FrameStack(object):
+    '''ring buffer of the last num_stack frames of each process. Each step writes one frame,
+    instead of shifting the whole stacked observation. The stacked observation [num_processes, num_stack*C, ...]
+    is gathered by FrameStack.stacked, oldest frame first, same as the shifted stack.
+    Frames cleared by masks are gathered from a slot of zeros.
+    If store is given, frames are kept in the shared ObservationStore, and the ring keeps the slots of them.
+    Without store, small stacked observations, see RING_MIN_STACKED_NUMEL, and those of a single frame
+    are shifted and masked as a whole, where the indexing of the ring costs more than it saves'''
+    def __init__(self, num_processes, frame_shape, num_stack, dtype=torch.float32, store=None):
+        self.num_processes = num_processes
+        self.frame_shape = frame_shape
+        self.num_stack = num_stack
+        self.store = store
+        self.shift = (self.store is None) and (
+            (num_stack == 1) or (num_processes*num_stack*int(np.prod(frame_shape)) <= RING_MIN_STACKED_NUMEL)
+        )
+        if self.shift:
+            '''the stacked observation, oldest frame first'''
+            self.current = torch.zeros(num_processes, frame_shape[0]*num_stack, *frame_shape[1:], dtype=dtype)
+            return
+        if self.store is None:
+            '''slot num_stack is kept as zeros'''
+            self.frames = torch.zeros(num_stack+1, num_processes, *frame_shape, dtype=dtype)
+            self.zero_slot = num_stack
+        else:
+            self.zero_slot = self.store.zero_slot
+        '''slot of each frame in the ring on host for reference counting, and rows of it on device for gathering.
+        Without store, the frame at i of the ring is in slot i'''
+        self.slots = [self.zero_slot]*num_stack
+        if self.store is not None:
+            self.row_index = self.store.zero_rows.view(1,-1).repeat(num_stack,1)
+        '''so that the first frame is written to the ring at 0'''
+        self.head = num_stack-1
+        '''number of frames of each process written since it was cleared'''
+        self.num_valid = torch.zeros(num_processes, dtype=torch.long)
+        '''how many steps each frame in the stack is behind the head, oldest frame first'''
+        self.steps_back = torch.arange(num_stack-1, -1, -1)
+        self.process_index = torch.arange(num_processes)
+
+    def to(self, device):
+        if self.shift:
+            self.current = self.current.to(device)
+            return self
+        if self.store is None:
+            self.frames = self.frames.to(device)
+        else:
+            self.row_index = self.row_index.to(device)
+        self.num_valid = self.num_valid.to(device)
+        self.steps_back = self.steps_back.to(device)
+        self.process_index = self.process_index.to(device)
+        return self
+
+    def cuda(self):
+        return self.to(torch.device('cuda'))
+
+    def clear(self, masks):
+        '''clear the frames of processes with masks [num_processes, 1] of 0'''
+        if self.shift:
+            self.current.mul_(masks.view(-1,*([1]*(self.current.dim()-1))).to(self.current.dtype))
+            return
+        self.num_valid.mul_(masks.view(-1).long())
+
+    def push(self, frame, slot=None):
+        '''write frame [num_processes, *frame_shape] as the newest frame,
+        if frames are kept in store, slot is where frame has been added to the store'''
+        if self.shift:
+            if self.num_stack > 1:
+                self.current[:, :-self.frame_shape[0]] = self.current[:, self.frame_shape[0]:]
+            self.current[:, -self.frame_shape[0]:] = frame
+            return
+        self.head = (self.head+1)%self.num_stack
+        if self.store is None:
+            slot = self.head
+            self.frames[slot].copy_(frame)
+        else:
+            self.store.retain([slot])
+            self.store.release([self.slots[self.head]])
+            self.row_index[self.head].copy_(self.store.rows(slot))
+        self.slots[self.head] = slot
+        self.num_valid.add_(1).clamp_(max=self.num_stack)
+
+    def ordered_slots(self):
+        '''slots of the frames in the stack, oldest frame first'''
+        return [self.slots[(self.head-steps_back)%self.num_stack] for steps_back in range(self.num_stack-1, -1, -1)]
+
+    def stacked_index(self):
+        '''index [num_processes, num_stack] of the stacked frames, see gather_frames'''
+        ring = (self.head-self.steps_back)%self.num_stack
+        valid = self.steps_back.unsqueeze(0) < self.num_valid.unsqueeze(1)
+        if self.store is None:
+            slots = torch.where(
+                valid,
+                ring.unsqueeze(0),
+                torch.full_like(self.steps_back, self.zero_slot).unsqueeze(0),
+            )
+            return slots*self.num_processes+self.process_index.unsqueeze(1)
+        else:
+            return torch.where(
+                valid,
+                self.row_index[ring].t(),
+                self.store.zero_rows.unsqueeze(1),
+            )
+
+    def stacked(self, out=None):
+        '''gather the stacked observation, into out if it is given'''
+        if self.shift:
+            if out is None:
+                return self.current.clone()
+            return out.copy_(self.current)
+        if self.store is None:
+            return gather_frames(self.frames, self.stacked_index(), out)
+        else:
+            return self.store.gather(self.stacked_index(), out)
+
 class RolloutStorage(object):
-    def __init__(self, num_steps, num_processes, obs_shape, input_actions, action_space, state_size, observation_space):
+    def __init__(self, num_steps, num_processes, obs_shape, input_actions, action_space, state_size, observation_space, compact=False, store=None):
         self.num_steps = num_steps
         self.observation_space = observation_space
-        self.observations = torch.zeros(num_steps + 1, num_processes, *obs_shape)
+        self.obs_shape = obs_shape
+        '''in compact mode, observations, input_actions, actions and masks are stored in the narrowest safe dtype,
+        they are converted back to float lazily by get_* and the minibatch generators'''
+        self.compact = compact
+        if self.compact and (observation_space.dtype == np.uint8):
+            '''image observations emitted as uint8 by the env are kept as uint8'''
+            self.observation_dtype = torch.uint8
+        else:
+            self.observation_dtype = torch.float32
+        '''if store is given, observations are the index [num_steps+1, num_processes, num_stack] of frames in the shared ObservationStore,
+        they are gathered lazily by get_observations and the minibatch generators, see materialize'''
+        self.store = store
+        if self.store is None:
+            self.observations = torch.zeros(num_steps + 1, num_processes, *obs_shape, dtype=self.observation_dtype)
+        else:
+            num_stack = obs_shape[0]//observation_space.shape[0]
+            self.observations = self.store.zero_rows.cpu().view(1,num_processes,1).repeat(num_steps + 1, 1, num_stack)
+            '''slots referenced by each step, on host for reference counting'''
+            self.observation_slots = [[self.store.zero_slot]*num_stack for _ in range(num_steps + 1)]
         self.input_actions = torch.zeros(num_steps + 1, num_processes, input_actions.n)
+        if self.compact:
+            '''input_actions is onehot'''
+            self.input_actions = self.input_actions.byte()
         self.states = torch.zeros(num_steps + 1, num_processes, state_size)
         self.rewards = torch.zeros(num_steps, num_processes, 1)
         self.reward_bounty_raw = torch.zeros(num_steps, num_processes, 1)
@@ -23,27 +375,112 @@ class RolloutStorage(object):
             raise NotImplemented
         self.actions = torch.zeros(num_steps, num_processes, action_shape)
         if action_space.__class__.__name__ == 'Discrete':
-            self.actions = self.actions.long()
+            if self.compact and (action_space.n <= np.iinfo(np.int16).max):
+                self.actions = self.actions.short()
+            else:
+                self.actions = self.actions.long()
         self.masks = torch.ones(num_steps + 1, num_processes, 1)
+        if self.compact:
+            self.masks = self.masks.bool()
+        if action_space.__class__.__name__ == 'Discrete':
+            '''onehot of each action, looked up by transition_model_dataset'''
+            self.action_onehot = torch.eye(action_space.n)
 
         self.num_steps = num_steps
         self.step = 0
 
-    def cuda(self):
-        self.observations = self.observations.cuda()
-        self.input_actions = self.input_actions.cuda()
-        self.states = self.states.cuda()
-        self.rewards = self.rewards.cuda()
-        self.reward_bounty_raw = self.reward_bounty_raw.cuda()
-        self.value_preds = self.value_preds.cuda()
-        self.returns = self.returns.cuda()
-        self.action_log_probs = self.action_log_probs.cuda()
-        self.actions = self.actions.cuda()
-        self.masks = self.masks.cuda()
+    def to(self, device):
+        self.observations = self.observations.to(device)
+        self.input_actions = self.input_actions.to(device)
+        self.states = self.states.to(device)
+        self.rewards = self.rewards.to(device)
+        self.reward_bounty_raw = self.reward_bounty_raw.to(device)
+        self.value_preds = self.value_preds.to(device)
+        self.returns = self.returns.to(device)
+        self.action_log_probs = self.action_log_probs.to(device)
+        self.actions = self.actions.to(device)
+        self.masks = self.masks.to(device)
+        if self.action_space.__class__.__name__ == 'Discrete':
+            self.action_onehot = self.action_onehot.to(device)
         return self
 
+    def cuda(self):
+        return self.to(torch.device('cuda'))
+
+    def memory_footprint(self):
+        '''bytes taken by all tensors in this storage'''
+        return sum([
+            x.element_size()*x.numel() for x in [
+                self.observations,
+                self.input_actions,
+                self.states,
+                self.rewards,
+                self.reward_bounty_raw,
+                self.value_preds,
+                self.returns,
+                self.action_log_probs,
+                self.actions,
+                self.masks,
+            ]
+        ])
+
+    def to_float(self, x):
+        '''convert x stored in compact dtype back to float, it is no-op if x is float already'''
+        return x.float()
+
+    def to_action(self, x):
+        '''convert actions stored in compact dtype back to the dtype used by the policy'''
+        if self.action_space.__class__.__name__ == 'Discrete':
+            return x.long()
+        else:
+            return x
+
+    def materialize(self, observations):
+        '''gather observations from store, it is no-op if observations are not kept in store'''
+        if self.store is None:
+            return observations
+        else:
+            return self.store.gather(observations)
+
+    def materialize_transition_dataset(self, dataset):
+        '''gather the observations in dataset from transition_model_dataset, to keep it beyond this update'''
+        if dataset is None:
+            return None
+        observations_batch, next_observations_batch, action_onehot_batch, reward_bounty_raw_batch = dataset
+        return self.materialize(observations_batch), self.materialize(next_observations_batch), action_onehot_batch, reward_bounty_raw_batch
+
+    def get_observations(self, step):
+        return self.to_float(self.materialize(self.observations[step]))
+
+    def get_observation_ids(self, step):
+        '''ids of the newest frames of the observations at step, to memoize outputs computed from these observations,
+        see utils.LRUMemo. None if frames are not interned, since slots of ObservationStore are reused'''
+        if not isinstance(self.store, ObservationTable):
+            return None
+        return self.observation_slots[step][-1]
+
+    def get_input_actions(self, step):
+        return self.to_float(self.input_actions[step])
+
+    def get_masks(self, step):
+        return self.to_float(self.masks[step])
+
+    def set_observations(self, step, current_obs):
+        if self.store is not None:
+            '''current_obs is a FrameStack on store, keep the slots of its frames'''
+            slots = current_obs.ordered_slots()
+            self.store.retain(slots)
+            self.store.release(self.observation_slots[step])
+            self.observation_slots[step] = slots
+            self.observations[step].copy_(current_obs.stacked_index())
+        elif isinstance(current_obs, FrameStack):
+            '''gathered straight into the storage'''
+            current_obs.stacked(out=self.observations[step])
+        else:
+            self.observations[step].copy_(current_obs)
+
     def insert(self, current_obs, state, action, action_log_prob, value_pred, reward, mask):
-        self.observations[self.step + 1].copy_(current_obs)
+        self.set_observations(self.step + 1, current_obs)
         self.states[self.step + 1].copy_(state)
         self.actions[self.step].copy_(action)
         self.action_log_probs[self.step].copy_(action_log_prob)
@@ -54,43 +491,82 @@ class RolloutStorage(object):
         self.step = (self.step + 1) % self.num_steps
 
     def after_update(self):
-        self.observations[0].copy_(self.observations[-1])
-        self.states[0].copy_(self.states[-1])
-        self.masks[0].copy_(self.masks[-1])
+        self.start_from(self)
 
-    def compute_returns(self, next_value, use_gae, gamma, tau):
+    def start_from(self, rollouts):
+        '''start a new round of interaction from the last step of rollouts,
+        rollouts is self after update, or the other rollouts of a double buffer'''
+        if self.store is not None:
+            self.store.retain(rollouts.observation_slots[-1])
+            self.store.release(self.observation_slots[0])
+            self.observation_slots[0] = list(rollouts.observation_slots[-1])
+        self.observations[0].copy_(rollouts.observations[-1])
+        self.states[0].copy_(rollouts.states[-1])
+        self.masks[0].copy_(rollouts.masks[-1])
+
+    def compute_returns(self, next_value, use_gae, gamma, tau, block_size=16):
+        '''compute returns with a blocked reverse scan, see discounted_reverse_scan'''
+        masks = self.to_float(self.masks)
         if use_gae:
             self.value_preds[-1] = next_value
-            gae = 0
-            for step in reversed(range(self.rewards.size(0))):
-                delta = self.rewards[step] + gamma * self.value_preds[step + 1] * self.masks[step + 1] - self.value_preds[step]
-                gae = delta + gamma * tau * self.masks[step + 1] * gae
-                self.returns[step] = gae + self.value_preds[step]
+            delta = self.rewards + gamma * self.value_preds[1:] * masks[1:] - self.value_preds[:-1]
+            gae = discounted_reverse_scan(
+                values = delta,
+                discounts = gamma * tau * masks[1:],
+                last = torch.zeros_like(next_value),
+                block_size = block_size,
+            )
+            self.returns[:-1] = gae + self.value_preds[:-1]
         else:
             self.returns[-1] = next_value
-            for step in reversed(range(self.rewards.size(0))):
-                self.returns[step] = self.returns[step + 1] * \
-                    gamma * self.masks[step + 1] + self.rewards[step]
-
-
-    def feed_forward_generator(self, advantages, mini_batch_size):
-        num_steps, num_processes = self.rewards.size()[0:2]
-        batch_size = num_processes * num_steps
-        sampler = BatchSampler(SubsetRandomSampler(range(batch_size)), mini_batch_size, drop_last=False)
-        for indices in sampler:
-            observations_batch         = self.observations [:-1].view(-1,*self.observations .size()[2:])[indices]
-            input_actions_batch        = self.input_actions[:-1].view(-1,*self.input_actions.size()[2:])[indices]
-            states_batch               = self.states       [:-1].view(-1, self.states.size(-1)         )[indices]
-            actions_batch              = self.actions           .view(-1, self.actions.size(-1)        )[indices]
-            return_batch               = self.returns      [:-1].view(-1, 1                            )[indices]
-            masks_batch                = self.masks        [:-1].view(-1, 1                            )[indices]
-            old_action_log_probs_batch = self.action_log_probs  .view(-1, 1                            )[indices]
-            adv_targ                   = advantages             .view(-1, 1                            )[indices]
+            self.returns[:-1] = discounted_reverse_scan(
+                values = self.rewards,
+                discounts = gamma * masks[1:],
+                last = next_value,
+                block_size = block_size,
+            )
+
+    def flatten_for_feed_forward(self, advantages):
+        '''flatten storage for feed_forward_generator, this is done once per update'''
+        return (
+            self.observations [:-1].contiguous().view(-1,*self.observations .size()[2:]),
+            self.input_actions[:-1].contiguous().view(-1,*self.input_actions.size()[2:]),
+            self.states       [:-1].contiguous().view(-1, self.states.size(-1)         ),
+            self.actions           .contiguous().view(-1, self.actions.size(-1)        ),
+            self.returns      [:-1].contiguous().view(-1, 1                            ),
+            self.masks        [:-1].contiguous().view(-1, 1                            ),
+            self.action_log_probs  .contiguous().view(-1, 1                            ),
+            advantages             .contiguous().view(-1, 1                            ),
+        )
+
+    def feed_forward_generator(self, flattened, mini_batch_size):
+        '''yield minibatches for one epoch from flattened, which is from flatten_for_feed_forward,
+        one permutation is drawn and split into minibatches of mini_batch_size (the last one may be smaller)'''
+        observations, input_actions, states, actions, returns, masks, old_action_log_probs, advantages = flattened
+        permutation = torch.randperm(returns.size()[0], device=returns.device)
+        for indices in permutation.split(mini_batch_size):
+            observations_batch         = observations        .index_select(0, indices)
+            input_actions_batch        = input_actions       .index_select(0, indices)
+            states_batch               = states              .index_select(0, indices)
+            actions_batch              = actions             .index_select(0, indices)
+            return_batch               = returns             .index_select(0, indices)
+            masks_batch                = masks               .index_select(0, indices)
+            old_action_log_probs_batch = old_action_log_probs.index_select(0, indices)
+            adv_targ                   = advantages          .index_select(0, indices)
+
+            '''gather from store and convert compact dtypes back, only for this minibatch'''
+            observations_batch         = self.to_float (self.materialize(observations_batch))
+            input_actions_batch        = self.to_float (input_actions_batch)
+            actions_batch              = self.to_action(actions_batch      )
+            masks_batch                = self.to_float (masks_batch        )
 
             yield observations_batch, input_actions_batch, states_batch, actions_batch, \
                 return_batch, masks_batch, old_action_log_probs_batch, adv_targ
 
-    def transition_model_feed_forward_generator(self, mini_batch_size, recent_steps=None, recent_at=None):
+    def transition_model_dataset(self, recent_steps=None, recent_at=None):
+        '''collect the transitions whose next observations are not reset by done,
+        for transition_model_feed_forward_generator, this is done once per update,
+        return None if there is no such transition'''
 
         observations_batch           = self.observations
         reward_bounty_raw_batch      = self.reward_bounty_raw
@@ -106,37 +582,40 @@ class RolloutStorage(object):
             actions_batch                = actions_batch               [recent_at-recent_steps:recent_at  ]
             next_masks_batch             = next_masks_batch            [recent_at-recent_steps:recent_at+1]
 
-        observations_batch           = observations_batch               [ :-1].view(-1,*self.observations.size()[2:])
-        reward_bounty_raw_batch      = reward_bounty_raw_batch                .view(-1, 1                           )
-        next_observations_batch      = next_observations_batch          [1:  ].view(-1,*self.observations.size()[2:])
-        actions_batch                = actions_batch                          .view(-1, self.actions.size(-1)       )
-        next_masks_batch             = next_masks_batch                 [1:  ].view(-1, 1                           )
+        observations_batch           = observations_batch               [ :-1].contiguous().view(-1,*self.observations.size()[2:])
+        reward_bounty_raw_batch      = reward_bounty_raw_batch                .contiguous().view(-1, 1                           )
+        next_observations_batch      = next_observations_batch          [1:  ].contiguous().view(-1,*self.observations.size()[2:])
+        actions_batch                = actions_batch                          .contiguous().view(-1                              )
+        next_masks_batch             = next_masks_batch                 [1:  ].contiguous().view(-1                              )
 
         '''generate indexs'''
-        try:
-            next_masks_batch_index = next_masks_batch.squeeze(1).nonzero().squeeze(1)
-        except Exception as e:
-            yield None 
-
-        if len(observations_batch.size()) == 4:
-            unsqueezed_next_masks_batch_index_for_obs = next_masks_batch_index.unsqueeze(1).unsqueeze(2).unsqueeze(3)
-        elif len(observations_batch.size()) == 2:
-            unsqueezed_next_masks_batch_index_for_obs = next_masks_batch_index.unsqueeze(1)
-        unsqueezed_next_masks_batch_index_for_vec =  next_masks_batch_index.unsqueeze(1)
-
-        next_masks_batch_index_observations_batch      = unsqueezed_next_masks_batch_index_for_obs.expand(next_masks_batch_index.size()[0],*observations_batch     .size()[1:])
-        next_masks_batch_index_reward_bounty_raw_batch = unsqueezed_next_masks_batch_index_for_vec                          .expand(next_masks_batch_index.size()[0],*reward_bounty_raw_batch.size()[1:])
-        next_masks_batch_index_next_observations_batch = unsqueezed_next_masks_batch_index_for_obs.expand(next_masks_batch_index.size()[0],*next_observations_batch.size()[1:])
-        next_masks_batch_index_actions_batch           = unsqueezed_next_masks_batch_index_for_vec                          .expand(next_masks_batch_index.size()[0],*actions_batch          .size()[1:])
+        next_masks_batch_index = next_masks_batch.nonzero().view(-1)
+        if next_masks_batch_index.size()[0] == 0:
+            return None
 
         '''index'''
-        observations_batch      = observations_batch     .gather(0,next_masks_batch_index_observations_batch)
-        reward_bounty_raw_batch = reward_bounty_raw_batch.gather(0,next_masks_batch_index_reward_bounty_raw_batch)
-        next_observations_batch = next_observations_batch.gather(0,next_masks_batch_index_next_observations_batch)
-        actions_batch           = actions_batch          .gather(0,next_masks_batch_index_actions_batch)
+        observations_batch      = observations_batch     .index_select(0,next_masks_batch_index)
+        reward_bounty_raw_batch = reward_bounty_raw_batch.index_select(0,next_masks_batch_index)
+        if self.store is None:
+            next_observations_batch = next_observations_batch.index_select(0,next_masks_batch_index)[:,-self.observation_space.shape[0]:]
+        else:
+            '''index of the last frame'''
+            next_observations_batch = next_observations_batch.index_select(0,next_masks_batch_index)[:,-1:]
+        actions_batch           = actions_batch          .index_select(0,next_masks_batch_index)
+
+        '''convert actions_batch to action_onehot_batch, by looking up the cached onehot of each action'''
+        action_onehot_batch = self.action_onehot.index_select(0,actions_batch.long())
+
+        return observations_batch, next_observations_batch, action_onehot_batch, reward_bounty_raw_batch
+
+    def transition_model_feed_forward_generator(self, dataset, mini_batch_size):
+        '''yield minibatches for one epoch from dataset, which is from transition_model_dataset'''
+
+        if dataset is None:
+            yield None
+            return
 
-        '''convert actions_batch to action_onehot_batch'''
-        action_onehot_batch = torch.zeros(observations_batch.size()[0],self.action_space.n).cuda().fill_(0.0).scatter_(1,actions_batch.long(),1.0)
+        observations_batch, next_observations_batch, action_onehot_batch, reward_bounty_raw_batch = dataset
 
         batch_size = observations_batch.size()[0]
 
@@ -144,9 +623,13 @@ class RolloutStorage(object):
             '''if only one batch can be sampled'''
             mini_batch_size = batch_size
 
-        sampler = BatchSampler(SubsetRandomSampler(range(batch_size)), mini_batch_size, drop_last=True)
-        for indices in sampler:
-            yield observations_batch[indices], next_observations_batch[indices][:,-self.observation_space.shape[0]:], action_onehot_batch[indices], reward_bounty_raw_batch[indices]
+        permutation = torch.randperm(batch_size, device=observations_batch.device)
+        for indices in permutation.split(mini_batch_size):
+            if indices.size()[0] < mini_batch_size:
+                '''drop last'''
+                break
+            '''gather from store and convert compact dtypes back, only for this minibatch'''
+            yield self.to_float(self.materialize(observations_batch.index_select(0,indices))), self.to_float(self.materialize(next_observations_batch.index_select(0,indices))), action_onehot_batch.index_select(0,indices), reward_bounty_raw_batch.index_select(0,indices)
 
     def recurrent_generator(self, advantages, num_mini_batch):
         raise Exception('Not supported')
@@ -0,0 +1,28 @@
+'''
+model.py and arguments.get_args parse sys.argv when they are imported,
+tests run with the smallest argument set of main.py, on cpu.
+Run from the root of the repository with python -m pytest tests
+'''
+import copy
+import sys
+
+import pytest
+
+sys.argv = sys.argv[:1]+[
+    '--exp', 'test',
+    '--env-name', 'Explore2D',
+    '--episode-length-limit', '8',
+    '--num-hierarchy', '2',
+    '--num-subpolicy', '5',
+    '--num-processes', '4',
+    '--reward-bounty', '1',
+    '--distance', 'l2',
+    '--device', 'cpu',
+]
+
+from arguments import get_args
+
+@pytest.fixture
+def args():
+    '''a copy of the arguments, tests may override them'''
+    return copy.copy(get_args())
@@ -0,0 +1,113 @@
+import numpy as np
+import pytest
+import torch
+from scipy import ndimage
+
+import bounty
+
+def reference_get_mass_center(obs):
+    '''the scipy path previously used to compute mass center'''
+    return np.asarray(
+        ndimage.measurements.center_of_mass(
+            (
+                (obs+255.0)/2.0
+            ).astype(np.uint8)
+        )
+    )
+
+def reference_reward_bounty_raw(obs, observation_predicted_from, predicted_next_observations, action, distance, env_name, reward_bounty, diversity_driven_active_function):
+    '''the per-process loop previously used in HierarchyLayer.generate_reward_bounty'''
+    num_processes = obs.shape[0]
+    reward_bounty_raw_to_return = torch.zeros(num_processes)
+    action_rb = action.cpu().numpy()
+    obs_rb = obs.astype(float)-observation_predicted_from.cpu().numpy()
+    prediction_rb = predicted_next_observations.cpu().numpy()
+    for process_i in range(num_processes):
+        difference_list = []
+        for action_i in range(prediction_rb.shape[0]):
+            if action_i!=action_rb[process_i]:
+                '''compute difference'''
+                if distance in ['l2']:
+                    if env_name in ['Explore2D']:
+                        difference = np.linalg.norm(
+                            x = (obs_rb[process_i][0,0]-prediction_rb[action_i,process_i][0,0]),
+                            ord = 2,
+                        )
+                    elif ('MinitaurBulletEnv' in env_name) or ('AntBulletEnv' in env_name):
+                        difference = np.linalg.norm(
+                            x = (obs_rb[process_i][28:30]-prediction_rb[action_i,process_i][28:30]),
+                            ord = 2,
+                        )/(obs_rb[process_i][28:30].shape[0]**0.5)
+                    elif env_name in ['ReacherBulletEnv-v1','Explore2DContinuous']:
+                        difference = np.linalg.norm(
+                            x = (obs_rb[process_i][0:2]-prediction_rb[action_i,process_i][0:2]),
+                            ord = 2,
+                        )/(obs_rb[process_i][0:2].shape[0]**0.5)
+                    else:
+                        raise NotImplemented
+                elif distance in ['mass_center']:
+                    difference = np.linalg.norm(
+                        reference_get_mass_center(obs_rb[process_i][0])-reference_get_mass_center(prediction_rb[action_i,process_i][0])
+                    )
+                else:
+                    raise NotImplemented
+
+                difference_list += [difference*reward_bounty]
+        if diversity_driven_active_function in ['min']:
+            reward_bounty_raw_to_return[process_i] += float(np.amin(difference_list))
+        elif diversity_driven_active_function in ['sum']:
+            reward_bounty_raw_to_return[process_i] += float(np.sum(difference_list))
+        else:
+            raise NotImplemented
+    return reward_bounty_raw_to_return
+
+def generate_bounty_inputs(obs_shape, num_processes, num_actions, dtype=np.float64):
+    '''random inputs of generate_reward_bounty, 84x84 frames are images as in OverCooked'''
+    if len(obs_shape)==3 and (obs_shape[1]==84) and (obs_shape[2]==84):
+        obs = np.random.randint(0, 256, size=(num_processes, *obs_shape)).astype(dtype)
+        observation_predicted_from = torch.randint(0, 256, (num_processes, 1, *obs_shape[1:])).float()
+        predicted_next_observations = (torch.rand(num_actions, num_processes, *obs_shape)*2.0-1.0)*255.0
+    else:
+        obs = np.random.randint(-10, 11, size=(num_processes, *obs_shape)).astype(dtype)
+        if len(obs_shape) in [3]:
+            observation_predicted_from = torch.randint(-10, 11, (num_processes, 1, *obs_shape[1:])).float()
+        else:
+            observation_predicted_from = torch.randint(-10, 11, (num_processes, *obs_shape)).float()
+        predicted_next_observations = torch.randn(num_actions, num_processes, *obs_shape)*10.0
+    action = torch.randint(0, num_actions, (num_processes,)).long()
+    return obs, observation_predicted_from, predicted_next_observations, action
+
+@pytest.mark.parametrize('env_name, distance, obs_shape', [
+    ('Explore2D', 'l2', (1,2,2)),
+    ('Explore2DContinuous', 'l2', (2,)),
+    ('OverCooked', 'mass_center', (1,84,84)),
+])
+@pytest.mark.parametrize('diversity_driven_active_function', ['min', 'sum'])
+def test_compute_reward_bounty_raw(env_name, distance, obs_shape, diversity_driven_active_function):
+    torch.manual_seed(0)
+    np.random.seed(0)
+    obs, observation_predicted_from, predicted_next_observations, action = generate_bounty_inputs(obs_shape, 4, 5)
+    kwargs = dict(
+        distance = distance,
+        env_name = env_name,
+        reward_bounty = 0.5,
+        diversity_driven_active_function = diversity_driven_active_function,
+    )
+    reference = reference_reward_bounty_raw(obs, observation_predicted_from, predicted_next_observations, action, **kwargs)
+    new = bounty.compute_reward_bounty_raw(
+        obs = torch.from_numpy(obs).float(),
+        observation_predicted_from = observation_predicted_from,
+        predicted_next_observations = predicted_next_observations,
+        action = action,
+        **kwargs
+    )
+    np.testing.assert_allclose(new.numpy(), reference.numpy(), rtol=1e-4, atol=1e-4)
+
+def test_get_mass_center():
+    torch.manual_seed(0)
+    '''observation differences are valued in [-255, 255]'''
+    observations = (torch.rand(3, 4, 84, 84)*2.0-1.0)*255.0
+    reference = np.stack([
+        np.stack([reference_get_mass_center(image) for image in images]) for images in observations.numpy()
+    ])
+    np.testing.assert_allclose(bounty.get_mass_center(observations).numpy(), reference, rtol=1e-4, atol=1e-3)
@@ -0,0 +1,102 @@
+import numpy as np
+import pytest
+
+from baselines.common.vec_env.subproc_vec_env import SubprocVecEnv
+from envs import make_env, make_native_vec_env
+
+def override_args(args, **kwargs):
+    for name, value in kwargs.items():
+        setattr(args, name, value)
+    return args
+
+def random_actions(action_space, num_envs, random_state):
+    if action_space.__class__.__name__ in ['Discrete']:
+        return random_state.randint(action_space.n, size=num_envs)
+    return random_state.randn(num_envs, *action_space.shape)
+
+def run(envs, num_envs, num_steps, auto_reset, seed=0):
+    '''step envs with random actions, reset all envs when all are done, as the top layer does,
+    return what is observed at each step'''
+    random_state = np.random.RandomState(seed)
+    sleepings = lambda: [envs.get_sleeping(env_index) for env_index in range(num_envs)]
+    results = [(np.array(envs.reset()), sleepings())]
+    for step_i in range(num_steps):
+        obs, rews, dones, infos = envs.step(random_actions(envs.action_space, num_envs, random_state))
+        terminal_observations = [info['terminal_observation'] for info in infos if isinstance(info, dict) and ('terminal_observation' in info)]
+        results += [(np.array(obs), np.array(rews), np.array(dones), sleepings(), terminal_observations)]
+        if (not auto_reset) and dones.all():
+            results += [(np.array(envs.reset()), sleepings())]
+    envs.close()
+    return results
+
+def assert_same_results(results, reference):
+    assert len(results) == len(reference)
+    for result, reference_result in zip(results, reference):
+        assert len(result) == len(reference_result)
+        for x, reference_x in zip(result, reference_result):
+            if isinstance(x, np.ndarray):
+                np.testing.assert_array_equal(x, reference_x)
+            elif (len(x) > 0) and isinstance(x[0], np.ndarray):
+                for x_i, reference_x_i in zip(x, reference_x):
+                    np.testing.assert_array_equal(x_i, reference_x_i)
+            else:
+                assert x == reference_x
+
+@pytest.mark.parametrize('env_name', ['Explore2D', 'Explore2DContinuous'])
+@pytest.mark.parametrize('auto_reset', [False, True])
+def test_native_envs(args, env_name, auto_reset):
+    '''the batched envs should step as SubprocVecEnv of make_env(), i.e., with the wrappers of make_env()'''
+    args = override_args(args, env_name=env_name, auto_reset=auto_reset, num_processes=3, episode_length_limit=4)
+    reference = run(SubprocVecEnv([make_env(i, args=args) for i in range(3)]), 3, 20, auto_reset)
+    assert_same_results(run(make_native_vec_env(args), 3, 20, auto_reset), reference)
+
+@pytest.mark.parametrize('env_name', ['Explore2D', 'OverCooked'])
+def test_envs_per_worker(args, env_name):
+    '''envs hosted in the same worker should step as envs in a worker of their own,
+    including the envs drawing from np.random, e.g., OverCooked'''
+    args = override_args(args, env_name=env_name, reward_level=1, num_processes=4)
+    results = {
+        envs_per_worker: run(SubprocVecEnv([make_env(i, args=args) for i in range(4)], envs_per_worker=envs_per_worker), 4, 12, False)
+        for envs_per_worker in [1, 3]
+    }
+    assert_same_results(results[3], results[1])
+
+def test_shared_memory(args):
+    args = override_args(args, num_processes=4)
+    reference = run(SubprocVecEnv([make_env(i, args=args) for i in range(4)], envs_per_worker=1), 4, 12, False)
+    assert_same_results(run(SubprocVecEnv([make_env(i, args=args) for i in range(4)], shared_memory=True, envs_per_worker=2), 4, 12, False), reference)
+
+def test_sleeping_flags(args):
+    '''sleeping flags sent with step results should be those queried from the workers'''
+    args = override_args(args, num_processes=3, episode_length_limit=2)
+    envs = SubprocVecEnv([make_env(i, args=args) for i in range(3)], envs_per_worker=2)
+    envs.reset()
+    for step_i in range(6):
+        envs.step(np.zeros(3, dtype=np.int64))
+        for env_index in range(3):
+            envs.remotes[env_index//envs.envs_per_worker].send(('get_sleeping', env_index%envs.envs_per_worker))
+            assert envs.get_sleeping(env_index) == envs.remotes[env_index//envs.envs_per_worker].recv()
+    envs.close()
+
+@pytest.mark.parametrize('num_groups', [1, 2, 3])
+def test_step_async_group(args, num_groups):
+    '''stepping groups of envs in turn should step as stepping all envs at once'''
+    args = override_args(args, num_processes=5)
+    random_state = np.random.RandomState(0)
+    actions = [random_actions(make_env(0, args=args)().action_space, 5, random_state) for _ in range(10)]
+    results = {}
+    for grouped in [False, True]:
+        envs = SubprocVecEnv([make_env(i, args=args) for i in range(5)], envs_per_worker=1)
+        groups = envs.split_groups(num_groups)
+        assert sum([group.stop-group.start for group in groups]) == 5
+        results[grouped] = [envs.reset()]
+        for step_actions in actions:
+            if grouped:
+                for group, index in enumerate(groups):
+                    envs.step_async_group(group, step_actions[index])
+                results[grouped] += [envs.step_wait()[0]]
+            else:
+                results[grouped] += [envs.step(step_actions)[0]]
+        envs.close()
+    for grouped_obs, obs in zip(results[True], results[False]):
+        np.testing.assert_array_equal(grouped_obs, obs)
@@ -0,0 +1,226 @@
+import gym
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+
+import utils
+from model import Policy, TransitionModel, InverseMaskModel, trace_acting_policy, flatten
+
+def get_state_type(obs_shape):
+    if len(obs_shape)==3 and (obs_shape[1]==84) and (obs_shape[2]==84):
+        return 'standard_image'
+    else:
+        return 'vector'
+
+def make_policy(obs_shape, num_subpolicy=3, output_action_space=gym.spaces.Discrete(5)):
+    return Policy(
+        obs_shape = obs_shape,
+        state_type = get_state_type(obs_shape),
+        input_action_space = gym.spaces.Discrete(num_subpolicy),
+        output_action_space = output_action_space,
+        recurrent_policy = False,
+        num_subpolicy = num_subpolicy,
+    )
+
+def make_transition_model(obs_shape, num_subpolicy=3):
+    return TransitionModel(
+        input_observation_shape = obs_shape,
+        state_type = get_state_type(obs_shape),
+        input_action_space = gym.spaces.Discrete(num_subpolicy),
+        output_observation_shape = obs_shape,
+        num_subpolicy = num_subpolicy,
+        mutual_information = False,
+    ).eval()
+
+def reference_predict_each_action(transition_model, now_states, action_onehot_each_action):
+    '''forwarding the observations repeated for each action, previously done in predict_to_downer_layer'''
+    num_actions, num_processes = action_onehot_each_action.size()[0], now_states.size()[0]
+    predicted_state, predicted_reward_bounty = transition_model(
+        inputs = now_states.repeat(num_actions,*([1]*(now_states.dim()-1))),
+        input_action = action_onehot_each_action.unsqueeze(1).expand(-1,num_processes,-1).contiguous().view(-1,num_actions),
+    )
+    return (
+        predicted_state.view(num_actions,num_processes,*predicted_state.size()[1:]),
+        predicted_reward_bounty.view(num_actions,num_processes,1),
+    )
+
+def reference_multi_linear(linears, x, action_index):
+    '''the per-subpolicy index_select and index_add_ loop previously used by the heads of Categorical, DiagGaussian and Policy'''
+    y = torch.zeros(x.size()[0], linears[0].out_features, device=x.device)
+    for dic_i in range(len(linears)):
+        index = (action_index==dic_i).nonzero().view(-1)
+        if index.size()[0] != 0:
+            y.index_add_(0, index, linears[dic_i](torch.index_select(x, 0, index)))
+    return y
+
+def reference_inverse_mask(m, last_states, now_states):
+    '''the per-grid loop previously used in get_alpha, get_e and alpha_to_mask of InverseMaskModel m,
+    return the predicted action log probs and the mask'''
+    conved_last_states, conved_now_states = last_states/255.0, now_states/255.0
+    alpha_bar, e = [], []
+    for i in range(m.num_grid):
+        for j in range(m.num_grid):
+            alpha_bar += [m.mlp_alpha(flatten(m.slice_grid(conved_now_states, i, j)))]
+            e += [m.mlp_e(torch.cat([
+                flatten(m.slice_grid(conved_now_states, i, j)-m.slice_grid(conved_last_states, i, j)),
+                flatten(m.slice_grid(conved_now_states, i, j)),
+            ], dim=1)).unsqueeze(1)]
+    alpha = F.softmax(torch.cat(alpha_bar, 1), dim=1)
+    e = torch.cat(e, dim=1)
+    mask = alpha.unsqueeze(2).expand(-1,-1,m.size_grid)
+    mask = mask.contiguous().view(mask.size()[0], m.num_grid, -1)
+    mask = torch.cat([mask]*m.size_grid,dim=2).view(mask.size()[0],m.size_grid*m.num_grid,m.size_grid*m.num_grid)
+    return m.get_predicted_action_log_probs(e, alpha), mask
+
+@pytest.mark.parametrize('obs_shape', [(1,2,2), (1,84,84)])
+def test_predict_each_action(obs_shape):
+    '''encoding observations once should predict as forwarding the observations repeated for each action'''
+    torch.manual_seed(0)
+    num_processes, num_actions = 3, 4
+    transition_model = make_transition_model(obs_shape, num_actions)
+    now_states = (torch.rand(num_processes, *obs_shape)*255.0).floor()
+    action_onehot_each_action = torch.eye(num_actions)
+    with torch.no_grad():
+        reference = reference_predict_each_action(transition_model, now_states, action_onehot_each_action)
+        new = transition_model.predict_each_action(now_states, action_onehot_each_action)
+    for reference_i, new_i in zip(reference, new):
+        np.testing.assert_allclose(new_i.numpy(), reference_i.numpy(), rtol=1e-4, atol=1e-3)
+
+def test_multi_linear():
+    torch.manual_seed(0)
+    num_subpolicy, batch_size = 4, 33
+    linears = torch.nn.ModuleList([torch.nn.Linear(16, 5) for _ in range(num_subpolicy)])
+    multi_linear = utils.MultiLinear(linears)
+    x = torch.randn(batch_size, 16)
+    action_index = torch.randint(0, num_subpolicy, (batch_size,))
+    with torch.no_grad():
+        reference = reference_multi_linear(linears, x, action_index)
+        new = multi_linear(x, action_index)
+    np.testing.assert_allclose(new.numpy(), reference.numpy(), rtol=1e-4, atol=1e-5)
+
+def test_inverse_mask():
+    torch.manual_seed(0)
+    m = InverseMaskModel(predicted_action_space=5, num_grid=4)
+    last_states = torch.randint(0, 256, (2, 1, 84, 84)).float()
+    now_states = torch.randint(0, 256, (2, 1, 84, 84)).float()
+    with torch.no_grad():
+        reference = reference_inverse_mask(m, last_states, now_states)
+        new = (m(last_states, now_states)[0], m.alpha_to_mask(m.get_alpha(now_states/255.0)))
+    for reference_i, new_i in zip(reference, new):
+        np.testing.assert_allclose(new_i.numpy(), reference_i.numpy(), rtol=1e-4, atol=1e-5)
+
+@pytest.mark.parametrize('obs_shape', [(1,2,2), (1,84,84)])
+def test_acting_policy(obs_shape):
+    '''the traced ActingPolicy should act as Policy.act deterministically, also on a batch of other size'''
+    torch.manual_seed(0)
+    num_processes, num_subpolicy = 4, 3
+    actor_critic = make_policy(obs_shape, num_subpolicy)
+    acting_policy, _ = trace_acting_policy(actor_critic, obs_shape, num_processes, torch.device('cpu'))
+    for batch_size in [num_processes, 2]:
+        inputs = (torch.rand(batch_size, *obs_shape)*255.0).floor()
+        states = torch.zeros(batch_size, actor_critic.state_size)
+        masks = torch.ones(batch_size, 1)
+        input_action_index = torch.randint(0, num_subpolicy, (batch_size,))
+        with torch.no_grad():
+            reference = actor_critic.act(inputs, states, masks, deterministic=True, input_action=torch.eye(num_subpolicy)[input_action_index])
+            new = acting_policy(inputs, states, masks, input_action_index, torch.zeros(1))
+        for reference_i, new_i in zip(reference, new):
+            np.testing.assert_allclose(new_i.numpy(), reference_i.numpy(), rtol=1e-4, atol=1e-5)
+
+def test_memo():
+    '''memoized acting and predicting should match the plain ones, for frames interned in an ObservationTable,
+    and should be invalidated when the version of the model is bumped after an update'''
+    from storage import ObservationTable
+    torch.manual_seed(0)
+    np.random.seed(0)
+    num_processes, num_subpolicy, frame_shape = 4, 3, (1,2,2)
+    actor_critic = make_policy(frame_shape, num_subpolicy)
+    transition_model = make_transition_model(frame_shape, num_subpolicy)
+    table = ObservationTable(capacity=num_processes, num_processes=num_processes, frame_shape=frame_shape)
+    pool = np.floor(np.random.rand(5, *frame_shape)*10.0)
+    states = torch.zeros(num_processes, actor_critic.state_size)
+    masks = torch.ones(num_processes, 1)
+    input_action = torch.eye(num_subpolicy)[torch.randint(0, num_subpolicy, (num_processes,))]
+    action_onehot_each_action = torch.eye(num_subpolicy)
+
+    def run(observation_ids):
+        return (
+            actor_critic.act(inputs, states, masks, deterministic=True, input_action=input_action, observation_ids=observation_ids),
+            transition_model.predict_each_action(inputs, action_onehot_each_action, observation_ids=observation_ids),
+        )
+
+    actor_critic.feature_memo = utils.LRUMemo(8, torch.device('cpu'))
+    transition_model.prediction_memo = utils.LRUMemo(8, torch.device('cpu'))
+    with torch.no_grad():
+        for step_i in range(20):
+            if step_i in [10]:
+                '''as after an update'''
+                for model in [actor_critic, transition_model]:
+                    for parameter in model.parameters():
+                        parameter.add_(0.1)
+                    model.version += 1
+            slot = table.intern(pool[np.random.randint(0, pool.shape[0], num_processes)])
+            inputs = table.frames_of(slot)
+            reference, new = run(None), run(slot)
+            for reference_i, new_i in zip(list(reference[0])+list(reference[1]), list(new[0])+list(new[1])):
+                np.testing.assert_allclose(new_i.numpy(), reference_i.numpy(), rtol=1e-4, atol=1e-5)
+    assert actor_critic.feature_memo.hit_rate() > 0.0
+
+def test_memo_with_reset():
+    '''step rollouts of interned frames as HierarchyLayer.interact_one_step does, with one env reset mid-rollout
+    and all envs reset by the top layer mid-rollout, acting with ids of rollouts.get_observation_ids(step)
+    should match acting on rollouts.get_observations(step) without the memo at every step'''
+    from storage import ObservationTable, FrameStack
+    from tests.test_storage import make_rollouts, insert
+    torch.manual_seed(0)
+    np.random.seed(0)
+    num_steps, num_processes, num_subpolicy, frame_shape = 5, 3, 3, (1,2,2)
+    actor_critic = make_policy(frame_shape, num_subpolicy)
+    actor_critic.feature_memo = utils.LRUMemo(8, torch.device('cpu'))
+    table = ObservationTable(capacity=num_processes, num_processes=num_processes, frame_shape=frame_shape)
+    rollouts = make_rollouts(num_steps, num_processes, frame_shape, 1, store=table)
+    frame_stack = FrameStack(num_processes, frame_shape, 1, store=table)
+    pool = np.floor(np.random.rand(6, *frame_shape)*10.0)
+    '''frames of envs just reset'''
+    reset_frames = pool[np.zeros(num_processes, dtype=np.int64)]
+    states = torch.zeros(num_processes, actor_critic.state_size)
+    input_action = torch.eye(num_subpolicy)[torch.randint(0, num_subpolicy, (num_processes,))]
+
+    def push(frames):
+        slot = table.intern(frames)
+        frame_stack.push(table.frames_of(slot), slot=slot)
+
+    push(reset_frames)
+    rollouts.set_observations(0, frame_stack)
+    step_i = 0
+    with torch.no_grad():
+        for global_step_i in range(4*num_steps):
+            inputs = rollouts.get_observations(step_i)
+            masks = rollouts.masks[step_i]
+            reference = actor_critic.act(inputs, states, masks, deterministic=True, input_action=input_action)
+            new = actor_critic.act(inputs, states, masks, deterministic=True, input_action=input_action,
+                observation_ids = rollouts.get_observation_ids(step_i))
+            for reference_i, new_i in zip(reference, new):
+                np.testing.assert_allclose(new_i.numpy(), reference_i.numpy(), rtol=1e-4, atol=1e-5)
+
+            frames = pool[np.random.randint(1, pool.shape[0], num_processes)]
+            masks = torch.ones(num_processes, 1)
+            if global_step_i in [7]:
+                '''env 1 is done and reset, as by AutoResetAfterDone'''
+                masks[1] = 0.0
+                frames[1] = reset_frames[1]
+            if global_step_i in [12]:
+                '''all envs are done, the top layer resets them, see HierarchyLayer.reset'''
+                masks[:] = 0.0
+                push(reset_frames)
+                rollouts.set_observations(0, frame_stack)
+                frames = reset_frames
+            frame_stack.clear(masks)
+            push(frames)
+            insert(rollouts, frame_stack, masks)
+            step_i += 1
+            if step_i == num_steps:
+                rollouts.after_update()
+                step_i = 0
+    assert actor_critic.feature_memo.hit_rate() > 0.0
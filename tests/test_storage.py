@@ -0,0 +1,199 @@
+import gym
+import numpy as np
+import pytest
+import torch
+
+import storage
+from storage import RolloutStorage, FrameStack, ObservationStore, ObservationTable
+
+def reference_compute_returns(rollouts, next_value, use_gae, gamma, tau):
+    '''the per-step loop previously used in RolloutStorage.compute_returns'''
+    returns = torch.zeros_like(rollouts.returns)
+    value_preds = rollouts.value_preds.clone()
+    masks = rollouts.to_float(rollouts.masks)
+    if use_gae:
+        value_preds[-1] = next_value
+        gae = 0
+        for step in reversed(range(rollouts.rewards.size(0))):
+            delta = rollouts.rewards[step] + gamma * value_preds[step + 1] * masks[step + 1] - value_preds[step]
+            gae = delta + gamma * tau * masks[step + 1] * gae
+            returns[step] = gae + value_preds[step]
+    else:
+        returns[-1] = next_value
+        for step in reversed(range(rollouts.rewards.size(0))):
+            returns[step] = returns[step + 1] * \
+                gamma * masks[step + 1] + rollouts.rewards[step]
+    return returns[:-1]
+
+def reference_stack(frames, masks, num_stack, out=None):
+    '''shifting the stacked observation, previously done in HierarchyLayer.update_current_obs,
+    for frames [num_steps, num_processes, ...] and masks [num_steps, num_processes, 1].
+    Return the stacked observation of each step, or copy each of them into out if it is given'''
+    frame_shape = frames.size()[2:]
+    current_obs = torch.zeros(frames.size()[1], frame_shape[0]*num_stack, *frame_shape[1:], device=frames.device)
+    stacked = []
+    for step_i in range(frames.size()[0]):
+        current_obs *= masks[step_i].view(-1,*([1]*(current_obs.dim()-1)))
+        if num_stack > 1:
+            current_obs[:, :-frame_shape[0]] = current_obs[:, frame_shape[0]:]
+        current_obs[:, -frame_shape[0]:] = frames[step_i]
+        if out is None:
+            stacked += [current_obs.clone()]
+        else:
+            out.copy_(current_obs)
+    return stacked
+
+def make_rollouts(num_steps, num_processes, frame_shape, num_stack, store=None, compact=False):
+    observation_space = gym.spaces.Box(low=-255.0, high=255.0, shape=frame_shape, dtype=np.float32)
+    action_space = gym.spaces.Discrete(3)
+    return RolloutStorage(
+        num_steps = num_steps,
+        num_processes = num_processes,
+        obs_shape = (frame_shape[0]*num_stack, *frame_shape[1:]),
+        input_actions = action_space,
+        action_space = action_space,
+        state_size = 1,
+        observation_space = observation_space,
+        compact = compact,
+        store = store,
+    )
+
+def insert(rollouts, frame_stack, masks):
+    zeros = torch.zeros(masks.size()[0], 1)
+    rollouts.insert(frame_stack, zeros, zeros, zeros, zeros, zeros, masks)
+
+@pytest.mark.parametrize('use_gae', [True, False])
+@pytest.mark.parametrize('num_steps', [1, 5, 37])
+@pytest.mark.parametrize('compact', [False, True])
+def test_compute_returns(use_gae, num_steps, compact):
+    torch.manual_seed(0)
+    rollouts = make_rollouts(num_steps, 3, (2,), 1, compact=compact)
+    rollouts.rewards.normal_()
+    rollouts.value_preds.normal_()
+    rollouts.masks.copy_(torch.rand(rollouts.masks.size()) > 0.2)
+    next_value = torch.randn(3, 1)
+    reference = reference_compute_returns(rollouts, next_value, use_gae, 0.99, 0.95)
+    rollouts.compute_returns(next_value, use_gae, 0.99, 0.95, block_size=4)
+    np.testing.assert_allclose(rollouts.returns[:-1].numpy(), reference.numpy(), rtol=1e-4, atol=1e-4)
+
+@pytest.mark.parametrize('num_stack', [1, 2, 4])
+@pytest.mark.parametrize('frame_shape', [(1,2,2), (1,8,8), (2,)])
+@pytest.mark.parametrize('ring', [False, True])
+def test_frame_stack(num_stack, frame_shape, ring, monkeypatch):
+    torch.manual_seed(0)
+    if ring:
+        monkeypatch.setattr(storage, 'RING_MIN_STACKED_NUMEL', 0)
+    num_steps, num_processes = 24, 3
+    frames = (torch.rand(num_steps, num_processes, *frame_shape)*255.0).floor()
+    masks = (torch.rand(num_steps, num_processes, 1) > 0.2).float()
+    frame_stack = FrameStack(num_processes, frame_shape, num_stack)
+    assert frame_stack.shift == ((num_stack == 1) or (not ring))
+    out = torch.zeros(num_processes, frame_shape[0]*num_stack, *frame_shape[1:])
+    for step_i, reference in enumerate(reference_stack(frames, masks, num_stack)):
+        frame_stack.clear(masks[step_i])
+        '''the frame should be copied, not kept by reference'''
+        frame = frames[step_i].clone()
+        frame_stack.push(frame)
+        frame.fill_(-1.0)
+        np.testing.assert_array_equal(frame_stack.stacked(out=out).numpy(), reference.numpy())
+
+@pytest.mark.parametrize('num_stack', [1, 3])
+def test_observation_store(num_stack):
+    '''step 2 layers as in main.py, the upper layer steps once every 2 steps of the bottom layer,
+    rollouts keeping frames in a shared ObservationStore should have the observations of rollouts keeping copies'''
+    torch.manual_seed(0)
+    num_steps, num_processes, frame_shape, hierarchy_interval = 4, 3, (1,3,3), 2
+    store = ObservationStore(capacity=num_steps+num_stack+1, num_processes=num_processes, frame_shape=frame_shape)
+    layers = {
+        name: [{
+            'rollouts': make_rollouts(num_steps, num_processes, frame_shape, num_stack, store=layer_store),
+            'frame_stack': FrameStack(num_processes, frame_shape, num_stack, store=layer_store),
+        } for hierarchy_id in range(2)] for name, layer_store in [('copied', None), ('shared', store)]
+    }
+
+    def push(hierarchy_id, frame, slot, masks=None):
+        for name in ['copied', 'shared']:
+            layer = layers[name][hierarchy_id]
+            if masks is None:
+                layer['frame_stack'].push(frame, slot=slot)
+                layer['rollouts'].set_observations(0, layer['frame_stack'])
+            else:
+                layer['frame_stack'].clear(masks)
+                layer['frame_stack'].push(frame, slot=slot)
+                insert(layer['rollouts'], layer['frame_stack'], masks)
+        if (masks is not None) and (layers['shared'][hierarchy_id]['rollouts'].step == 0):
+            np.testing.assert_array_equal(
+                layers['shared'][hierarchy_id]['rollouts'].get_observations(slice(None)).numpy(),
+                layers['copied'][hierarchy_id]['rollouts'].get_observations(slice(None)).numpy(),
+            )
+            for name in ['copied', 'shared']:
+                layers[name][hierarchy_id]['rollouts'].after_update()
+
+    frame = (torch.rand(num_processes, *frame_shape)*255.0).floor()
+    slot = store.add(frame)
+    for hierarchy_id in range(2):
+        push(hierarchy_id, frame, slot)
+    for step_i in range(8*num_steps*hierarchy_interval):
+        frame = (torch.rand(num_processes, *frame_shape)*255.0).floor()
+        masks = (torch.rand(num_processes, 1) > 0.2).float()
+        slot = store.add(frame)
+        push(0, frame, slot, masks)
+        if step_i%hierarchy_interval == hierarchy_interval-1:
+            push(1, frame, slot, masks)
+    '''slots referenced by rollouts and frame stacks of both layers, they are all the slots not free'''
+    referenced = set([s for layer in layers['shared'] for slots in layer['rollouts'].observation_slots for s in slots])
+    referenced |= set([s for layer in layers['shared'] for s in layer['frame_stack'].slots])
+    referenced.discard(store.zero_slot)
+    assert store.capacity-len(store.free_slots) == len(referenced)
+
+def test_observation_store_unretained():
+    '''a slot not retained before the next add, e.g., the frame of the last step before the top layer resets all envs,
+    should be freed by the next add instead of growing the store'''
+    num_processes, frame_shape, num_stack = 2, (1,2,2), 2
+    store = ObservationStore(capacity=4, num_processes=num_processes, frame_shape=frame_shape)
+    frame_stack = FrameStack(num_processes, frame_shape, num_stack, store=store)
+    for step_i in range(64):
+        frame = torch.full((num_processes, *frame_shape), float(step_i))
+        slot = store.add(frame)
+        if step_i%3 != 0:
+            frame_stack.push(frame, slot=slot)
+    assert store.capacity == 4
+    '''the frames of the frame stack are referenced, and the last frame added is kept till the next add'''
+    assert store.capacity-len(store.free_slots) == num_stack+1
+
+@pytest.mark.parametrize('num_stack', [1, 2])
+def test_observation_table(num_stack):
+    '''rollouts keeping frames interned in an ObservationTable should have the observations of rollouts keeping copies,
+    frames are drawn from a small pool, so that each distinct frame is kept once'''
+    np.random.seed(0)
+    torch.manual_seed(0)
+    num_steps, num_processes, frame_shape = 5, 3, (1,2,2)
+    pool = np.floor(np.random.rand(6, *frame_shape)*10.0)
+    table = ObservationTable(capacity=num_processes, num_processes=num_processes, frame_shape=frame_shape)
+    layers = {
+        name: {
+            'rollouts': make_rollouts(num_steps, num_processes, frame_shape, num_stack, store=layer_store),
+            'frame_stack': FrameStack(num_processes, frame_shape, num_stack, store=layer_store),
+        } for name, layer_store in [('copied', None), ('interned', table)]
+    }
+    for step_i in range(4*num_steps+1):
+        frames = pool[np.random.randint(0, pool.shape[0], num_processes)]
+        masks = (torch.rand(num_processes, 1) > 0.2).float()
+        slot = table.intern(frames)
+        for name, layer in layers.items():
+            frame = torch.from_numpy(frames).float() if name in ['copied'] else table.frames_of(slot)
+            if step_i in [0]:
+                layer['frame_stack'].push(frame, slot=slot)
+                layer['rollouts'].set_observations(0, layer['frame_stack'])
+                continue
+            layer['frame_stack'].clear(masks)
+            layer['frame_stack'].push(frame, slot=slot)
+            insert(layer['rollouts'], layer['frame_stack'], masks)
+        if (step_i>0) and (step_i%num_steps==0):
+            np.testing.assert_array_equal(
+                layers['interned']['rollouts'].get_observations(slice(None)).numpy(),
+                layers['copied']['rollouts'].get_observations(slice(None)).numpy(),
+            )
+            for layer in layers.values():
+                layer['rollouts'].after_update()
+    assert table.num_frames-1 <= pool.shape[0]
@@ -0,0 +1,83 @@
+import random
+
+import gym
+import numpy as np
+import torch
+
+from transition_replay import TransitionReplayBuffer
+
+def make_replay(size, alpha=1.0):
+    return TransitionReplayBuffer(
+        size = size,
+        observation_shape = (2,),
+        next_observation_shape = (2,),
+        observation_dtype = torch.float32,
+        action_space = gym.spaces.Discrete(3),
+        alpha = alpha,
+        epsilon = 0.0,
+    )
+
+def make_dataset(start, num):
+    '''transitions numbered from start, observation i is [i, i], next observation is [i+0.5, i+0.5]'''
+    observations = torch.arange(start, start+num).float().unsqueeze(1).repeat(1,2)
+    action_onehot = torch.eye(3)[torch.arange(start, start+num)%3]
+    return observations, observations+0.5, action_onehot, observations[:,:1]*10.0
+
+def test_add_wraps_around():
+    replay = make_replay(size=5)
+    replay.add(*make_dataset(0, 3))
+    assert (len(replay), replay.next_index) == (3, 3)
+    replay.add(*make_dataset(3, 4))
+    assert (len(replay), replay.next_index) == (5, 2)
+    '''transitions 5 and 6 overwrite 0 and 1'''
+    np.testing.assert_array_equal(replay.observations[:,0].numpy(), [5, 6, 2, 3, 4])
+    np.testing.assert_array_equal(replay.next_observations[:,0].numpy(), [5.5, 6.5, 2.5, 3.5, 4.5])
+    np.testing.assert_array_equal(replay.actions.numpy(), [2, 0, 2, 0, 1])
+    np.testing.assert_array_equal(replay.reward_bounty_raw[:,0].numpy(), [50, 60, 20, 30, 40])
+    '''a dataset larger than the buffer keeps its last transitions'''
+    replay.add(*make_dataset(10, 7))
+    assert (len(replay), replay.next_index) == (5, 2)
+    np.testing.assert_array_equal(replay.observations[:,0].numpy(), [15, 16, 12, 13, 14])
+
+def test_sample_proportional_to_priorities():
+    random.seed(0)
+    replay = make_replay(size=4)
+    replay.add(*make_dataset(0, 4))
+    priorities = np.array([1.0, 2.0, 3.0, 4.0])
+    replay.update_priorities([0, 1, 2, 3], torch.from_numpy(priorities))
+    num_samples = 20000
+    _, _, _, _, _, idxes = replay.sample(num_samples, beta=0.4)
+    frequencies = np.bincount(idxes, minlength=4)/float(num_samples)
+    np.testing.assert_allclose(frequencies, priorities/priorities.sum(), atol=0.01)
+
+def test_sample_importance_weights():
+    random.seed(0)
+    beta = 0.5
+    replay = make_replay(size=4)
+    replay.add(*make_dataset(0, 4))
+    priorities = np.array([1.0, 2.0, 3.0, 4.0])
+    replay.update_priorities([0, 1, 2, 3], torch.from_numpy(priorities))
+    observations, next_observations, action_onehot, reward_bounty_raw, weights, idxes = replay.sample(64, beta=beta)
+    '''weights are (N*P(i))^-beta, normalized by the max weight, i.e., the one of the min priority'''
+    probabilities = priorities/priorities.sum()
+    reference = (4*probabilities[idxes])**(-beta)/(4*probabilities.min())**(-beta)
+    np.testing.assert_allclose(weights[:,0].numpy(), reference, rtol=1e-6)
+    assert weights.max().item() <= 1.0
+    '''sampled transitions are those at idxes'''
+    np.testing.assert_array_equal(observations[:,0].numpy(), idxes)
+    np.testing.assert_array_equal(next_observations[:,0].numpy(), np.array(idxes)+0.5)
+    np.testing.assert_array_equal(action_onehot.argmax(dim=1).numpy(), np.array(idxes)%3)
+    np.testing.assert_array_equal(reward_bounty_raw[:,0].numpy(), np.array(idxes)*10.0)
+
+def test_update_priorities():
+    replay = make_replay(size=4, alpha=0.5)
+    replay.add(*make_dataset(0, 2))
+    '''new transitions are given the max priority'''
+    assert (replay.it_sum[0], replay.it_sum[1]) == (1.0, 1.0)
+    replay.update_priorities([1], torch.tensor([[9.0]]))
+    assert replay.it_sum[1] == 9.0**0.5
+    assert replay.it_min.min() == 1.0
+    assert replay.max_priority == 9.0
+    replay.add(*make_dataset(2, 1))
+    assert replay.it_sum[2] == 9.0**0.5
+    assert replay.it_sum.sum(0, len(replay)) == 1.0+2*9.0**0.5
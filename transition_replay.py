@@ -0,0 +1,110 @@
+import random
+
+import numpy as np
+import torch
+
+from baselines.common.segment_tree import SumSegmentTree, MinSegmentTree
+
+import utils
+
+class TransitionReplayBuffer(object):
+    '''bounded replay buffer of (observation, next_observation, action, reward_bounty_raw) transitions
+    for training transition_model, sampled in proportion to the prediction error of each transition.
+    Transitions are kept on device in the dtypes of RolloutStorage (e.g., uint8 for image observations when compact),
+    actions are kept as indexes and converted to onehot when sampled'''
+    def __init__(self, size, observation_shape, next_observation_shape, observation_dtype, action_space, alpha, epsilon=1e-6):
+        self.size = size
+        self.alpha = alpha
+        self.epsilon = epsilon
+
+        self.observations = torch.zeros(size, *observation_shape, dtype=observation_dtype)
+        self.next_observations = torch.zeros(size, *next_observation_shape, dtype=observation_dtype)
+        self.actions = torch.zeros(size).long()
+        self.reward_bounty_raw = torch.zeros(size, 1)
+        '''onehot of each action, looked up when sampled'''
+        self.action_onehot = torch.eye(action_space.n)
+
+        self.num_stored = 0
+        self.next_index = 0
+
+        it_capacity = 1
+        while it_capacity < size:
+            it_capacity *= 2
+        self.it_sum = SumSegmentTree(it_capacity)
+        self.it_min = MinSegmentTree(it_capacity)
+        self.max_priority = 1.0
+
+    def to(self, device):
+        self.observations = self.observations.to(device)
+        self.next_observations = self.next_observations.to(device)
+        self.actions = self.actions.to(device)
+        self.reward_bounty_raw = self.reward_bounty_raw.to(device)
+        self.action_onehot = self.action_onehot.to(device)
+        return self
+
+    def cuda(self):
+        return self.to(torch.device('cuda'))
+
+    def __len__(self):
+        return self.num_stored
+
+    def add(self, observations, next_observations, action_onehot, reward_bounty_raw):
+        '''add a dataset from RolloutStorage.transition_model_dataset,
+        new transitions are given the max priority so that they are sampled at least once'''
+        num_added = min(observations.size()[0], self.size)
+        index = (torch.arange(num_added)+self.next_index)%self.size
+        index_device = index.to(self.actions.device)
+
+        self.observations     .index_copy_(0, index_device, observations     [-num_added:])
+        self.next_observations.index_copy_(0, index_device, next_observations[-num_added:])
+        self.actions          .index_copy_(0, index_device, action_onehot    [-num_added:].argmax(dim=1))
+        self.reward_bounty_raw.index_copy_(0, index_device, reward_bounty_raw[-num_added:])
+
+        for idx in index.tolist():
+            self.it_sum[idx] = self.max_priority ** self.alpha
+            self.it_min[idx] = self.max_priority ** self.alpha
+
+        self.next_index = (self.next_index+num_added)%self.size
+        self.num_stored = min(self.num_stored+num_added, self.size)
+
+    def sample_proportional(self, batch_size):
+        '''end of SumSegmentTree.sum is exclusive'''
+        total = self.it_sum.sum(0, self.num_stored)
+        return [self.it_sum.find_prefixsum_idx(random.random() * total) for _ in range(batch_size)]
+
+    def sample(self, batch_size, beta):
+        '''sample a minibatch, along with the importance weights and indexes of the sampled transitions'''
+        idxes = self.sample_proportional(batch_size)
+
+        p_min = self.it_min.min() / self.it_sum.sum()
+        max_weight = (p_min * self.num_stored) ** (-beta)
+        weights = np.array([
+            (self.it_sum[idx] / self.it_sum.sum() * self.num_stored) ** (-beta) / max_weight for idx in idxes
+        ])
+        weights = utils.to_device(weights, self.actions.device).unsqueeze(1)
+
+        index = torch.LongTensor(idxes).to(self.actions.device)
+        return (
+            self.observations     .index_select(0, index).float(),
+            self.next_observations.index_select(0, index).float(),
+            self.action_onehot    .index_select(0, self.actions.index_select(0, index)),
+            self.reward_bounty_raw.index_select(0, index),
+            weights,
+            idxes,
+        )
+
+    def update_priorities(self, idxes, priorities):
+        '''set priorities of the sampled transitions at idxes, priorities is a tensor of prediction errors'''
+        priorities = utils.to_host(priorities).reshape(-1) + self.epsilon
+        for idx, priority in zip(idxes, priorities):
+            self.it_sum[idx] = priority ** self.alpha
+            self.it_min[idx] = priority ** self.alpha
+            self.max_priority = max(self.max_priority, priority)
+
+    def feed_forward_generator(self, mini_batch_size, num_mini_batch, beta):
+        '''yield num_mini_batch minibatches for one epoch'''
+        if self.num_stored == 0:
+            yield None
+            return
+        for _ in range(num_mini_batch):
+            yield self.sample(min(mini_batch_size, self.num_stored), beta)
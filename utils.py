@@ -1,3 +1,5 @@
+import collections
+
 import torch
 import torch.nn as nn
 from PIL import Image
@@ -43,6 +45,77 @@ def gray_to_rgb(image):
     image = np.expand_dims(image,2)
     return np.concatenate((image,image,image),2)
 
+'''number of synchronous host<->device transfers made through to_device and to_host,
+it is logged as a metric so that extra round trips on the step path are noticed,
+nothing is transferred (nor counted) when the device is cpu'''
+num_host_device_transfers = 0
+
+def to_device(x, device, out=None):
+    '''move a numpy array to device as a float tensor,
+    or copy it into out, which is preallocated on device'''
+    global num_host_device_transfers
+    if device.type not in ['cpu']:
+        num_host_device_transfers += 1
+    x = torch.from_numpy(np.asarray(x))
+    if out is None:
+        return x.float().to(device)
+    else:
+        return out.copy_(x)
+
+def to_host(x):
+    '''move a tensor to the host as a numpy array'''
+    global num_host_device_transfers
+    if x.device.type not in ['cpu']:
+        num_host_device_transfers += 1
+    return x.detach().cpu().numpy()
+
+class LRUMemo(object):
+    '''memo of at most capacity entries, the least recently used entry is evicted first,
+    hits and misses are counted for the hit rate'''
+    def __init__(self, capacity, device):
+        self.capacity = capacity
+        self.device = device
+        self.entries = collections.OrderedDict()
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.num_misses += 1
+        else:
+            self.num_hits += 1
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def hit_rate(self):
+        num_lookups = self.num_hits+self.num_misses
+        return float(self.num_hits)/num_lookups if num_lookups > 0 else 0.0
+
+    def memoize_batch(self, keys, compute):
+        '''return the tuple of batched values of keys, compute(index) is called once on the index (on device)
+        of the keys missed, it returns a tuple of tensors batched along dim 0'''
+        global num_host_device_transfers
+        values = [self.get(key) for key in keys]
+        missed = [i for i in range(len(keys)) if values[i] is None]
+        if len(missed) > 0:
+            if self.device.type not in ['cpu']:
+                num_host_device_transfers += 1
+            computed = compute(torch.LongTensor(missed).to(self.device))
+            for j, i in enumerate(missed):
+                '''cloned, so that an entry does not keep the whole batch'''
+                values[i] = tuple(x[j].clone() for x in computed)
+                self.put(keys[i], values[i])
+        return tuple(
+            torch.stack([value[k] for value in values], 0) for k in range(len(values[0]))
+        )
+
 # Necessary for my KFAC implementation.
 class AddBias(nn.Module):
     def __init__(self, bias):
@@ -58,6 +131,64 @@ class AddBias(nn.Module):
         return x + bias
 
 
+class MultiLinear(nn.Module):
+    '''linears of all subpolicies stacked in one weight of [num_subpolicy, in_features, out_features],
+    built from a list of initialized nn.Linear. Each row of x is forwarded by the linear of its index,
+    all linears are evaluated in one matmul and the ones of index are gathered.
+    state_dict saved from a nn.ModuleList of nn.Linear can still be loaded'''
+    def __init__(self, linears):
+        super(MultiLinear, self).__init__()
+        self.weight = nn.Parameter(torch.stack([linear.weight.data.t() for linear in linears]))
+        self.bias = nn.Parameter(torch.stack([linear.bias.data for linear in linears]))
+
+    def forward(self, x, index):
+        num_subpolicy, in_features, out_features = self.weight.size()
+        y = x.mm(
+            self.weight.permute(1,0,2).contiguous().view(in_features, num_subpolicy*out_features)
+        ).view(-1, num_subpolicy, out_features) + self.bias
+        return y.gather(1, index.view(-1,1,1).expand(-1,1,out_features)).squeeze(1)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        '''convert state_dict of a nn.ModuleList of nn.Linear'''
+        if ((prefix+'weight') not in state_dict) and ((prefix+'0.weight') in state_dict):
+            state_dict[prefix+'weight'] = torch.stack([
+                state_dict.pop('{}{}.weight'.format(prefix,i)).t() for i in range(self.weight.size()[0])
+            ])
+            state_dict[prefix+'bias'] = torch.stack([
+                state_dict.pop('{}{}.bias'.format(prefix,i)) for i in range(self.bias.size()[0])
+            ])
+        super(MultiLinear, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+class MultiAddBias(nn.Module):
+    '''AddBias of all subpolicies stacked in one bias of [num_subpolicy, num_features],
+    each row of x is added by the bias of its index.
+    state_dict saved from a nn.ModuleList of AddBias can still be loaded'''
+    def __init__(self, biases):
+        super(MultiAddBias, self).__init__()
+        self._bias = nn.Parameter(torch.stack(biases))
+
+    def forward(self, x, index):
+        return x + self._bias.index_select(0, index)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        '''convert state_dict of a nn.ModuleList of AddBias'''
+        if ((prefix+'_bias') not in state_dict) and ((prefix+'0._bias') in state_dict):
+            state_dict[prefix+'_bias'] = torch.stack([
+                state_dict.pop('{}{}._bias'.format(prefix,i)).squeeze(1) for i in range(self._bias.size()[0])
+            ])
+        super(MultiAddBias, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+def quantize_for_inference(model):
+    '''return a copy of model with the nn.Linear and nn.GRUCell replaced by dynamic int8 quantized ones,
+    weights are quantized once, activations are quantized on the fly. Only for inference on cpu.
+    nn.Conv2d, MultiLinear and MultiAddBias are kept in float, since dynamic quantization does not support them'''
+    return torch.ao.quantization.quantize_dynamic(
+        model.eval(),
+        {nn.Linear, nn.GRUCell},
+        dtype = torch.qint8,
+    )
+
 def init(module, weight_init, bias_init, gain=1):
     weight_init(module.weight.data, gain=gain)
     bias_init(module.bias.data)